@@ -17,6 +17,10 @@ pkg_resources.require('Trac >= 1.2')
 
 import api
 import db
+import index
+import history
+import jobs
+import metrics
 import wiki
 import ticket
 import macros
@@ -7,14 +7,431 @@
 # you should have received as part of this distribution.
 #
 
+import csv
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
 from pkg_resources import parse_version
 
 from trac import __version__
+from trac.admin import AdminCommandError, IAdminCommandProvider
 from trac.admin import IAdminPanelProvider
-from trac.core import Component, implements
-from trac.web.chrome import Chrome, add_warning
+from trac.admin.api import get_dir_list
+from trac.config import BoolOption
+from trac.core import Component, TracError, implements
+from trac.util.datefmt import format_datetime, utc
+from trac.util.text import print_table, printout
+from trac.web.chrome import Chrome, add_notice, add_warning
 
 from tractags.api import TagSystem, _
+from tractags.history import TagHistoryCompactor
+from tractags.index import TagIndex
+from tractags.jobs import TagJobQueue
+from tractags.metrics import TagMetrics, TagMetricsRecorder
+from tractags.model import dump_rows, load_rows, prune_feed
+from tractags.ticket import TicketTagProvider
+
+# Field names of exported rows of the tags and tags_change tables.
+EXPORT_FIELDS = {
+    'tags': ('realm', 'id', 'tag'),
+    'tags_change': ('realm', 'id', 'time', 'author', 'oldtags', 'newtags'),
+}
+
+
+def parse_command_args(args, names):
+    """Split `--name=value` arguments from positional ones.
+
+    Returns the list of positional arguments and a dict of named ones.
+    """
+    positional = []
+    named = {}
+    for arg in args:
+        if arg.startswith('--'):
+            name, sep, value = arg[2:].partition('=')
+            if name not in names:
+                raise AdminCommandError(_("Unknown argument '%(arg)s'",
+                                          arg=arg))
+            named[name] = value
+        else:
+            positional.append(arg)
+    return positional, named
+
+
+def get_export_format(path, format=None):
+    """Return the export format given or implied by the file name."""
+    if not format:
+        format = 'jsonl' if path and path.endswith('.jsonl') else 'csv'
+    if format not in ('csv', 'jsonl'):
+        raise AdminCommandError(_("Unknown format '%(format)s'",
+                                  format=format))
+    return format
+
+
+def write_rows(out, format, fields, rows):
+    """Write rows as CSV with a header line or as JSON lines.
+
+    Returns the number of rows written.
+    """
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([unicode(value).encode('utf-8')
+                             if value is not None else '' for value in row])
+            count += 1
+    else:
+        for row in rows:
+            out.write(json.dumps(OrderedDict(zip(fields, row))) + '\n')
+            count += 1
+    return count
+
+
+def read_rows(f, format, fields):
+    """Yield rows read from CSV with a header line or from JSON lines."""
+    def _convert(values):
+        row = []
+        for name, value in zip(fields, values):
+            if name == 'time':
+                value = int(value)
+            elif isinstance(value, str):
+                value = value.decode('utf-8')
+            row.append(value)
+        return tuple(row)
+
+    try:
+        if format == 'csv':
+            reader = csv.reader(f)
+            header = next(reader, [])
+            try:
+                columns = [header.index(name) for name in fields]
+            except ValueError:
+                raise AdminCommandError(_("Expected CSV columns %(fields)s",
+                                          fields=', '.join(fields)))
+            for values in reader:
+                yield _convert([values[i] for i in columns])
+        else:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    yield _convert([item[name] for name in fields])
+    except (IndexError, KeyError, ValueError), e:
+        raise AdminCommandError(_("Invalid row: %(error)s", error=e))
+
+
+def format_progress(job):
+    """Format the number of processed items of a job."""
+    if job['total']:
+        return '%d/%d (%d%%)' % (job['done'], job['total'],
+                                 min(100, 100 * job['done'] / job['total']))
+    return str(job['done'])
+
+
+def as_count(value, name):
+    """Convert a command argument into a non-negative integer."""
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+    if count < 0:
+        raise AdminCommandError(_("Invalid value for '%(name)s': %(value)s",
+                                  name=name, value=value))
+    return count
+
+
+class TagAdminCommands(Component):
+    """[opt] Provides `trac-admin` commands for the tag system."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('tags compact',
+               '[--window=<seconds>] [--max-changes=<n>] [--max-age=<days>] '
+               '[realm]',
+               """Compact the tag change history
+
+               Merges consecutive changes by the same author within a time
+               window, drops changes older than a number of days except the
+               latest one per resource, and caps the number of changes per
+               resource. Omitted arguments default to the [tags]
+               history_merge_window, history_max_changes and history_max_age
+               options; removed changes are appended to the history_archive
+               file, if configured.
+               """,
+               self._complete_realm, self._do_compact)
+        yield ('tags export',
+               '[--format=csv|jsonl] [--history] [--realm=<realm>] [file]',
+               """Export tags or the tag change history
+
+               Rows are written as CSV or JSON Lines to the file, or to
+               standard output. The format defaults to JSON Lines for
+               files named *.jsonl and to CSV otherwise.
+               """,
+               self._complete_file, self._do_export)
+        yield ('tags feed prune', '[--max-age=<days>]',
+               """Delete old changes of the tag change feed
+
+               Deletes changes recorded more than 30 days ago by default.
+               Change feed clients with a cursor before them, like tag
+               indexes of processes, read all tags again.
+               """,
+               None, self._do_feed_prune)
+        yield ('tags import',
+               '[--format=csv|jsonl] [--history] [--batch-size=<n>] <file>',
+               """Import tags or the tag change history
+
+               Rows exported by `tags export` are merged into the tags or
+               tag change table, replacing rows with the same key. Rows
+               are written in batches of 10000 by default, each one in a
+               transaction of its own. Read standard input for file '-'.
+               """,
+               self._complete_file, self._do_import)
+        if self.env.is_component_enabled(TicketTagProvider):
+            yield ('tags check', '[--batch-size=<n>]',
+                   """Check ticket tags against ticket fields
+
+                   Reports tickets whose tags differ from the ticket fields
+                   exposed as tags, and tags of deleted tickets, without
+                   changing anything.
+                   """,
+                   None, self._do_check)
+            yield ('tags reindex', '[--batch-size=<n>]',
+                   """Rebuild ticket tags and tag caches
+
+                   Rewrites tags of tickets differing from the ticket fields
+                   in batches of 1000 tickets by default, removes tags of
+                   deleted tickets and rebuilds the tag caches.
+                   """,
+                   None, self._do_reindex)
+        if self.env.is_component_enabled(TagJobQueue):
+            yield ('tags job list', '',
+                   'List queued tag maintenance jobs',
+                   None, self._do_job_list)
+            yield ('tags job add', '<kind> [arguments]',
+                   """Queue a tag maintenance job
+
+                   Optional job arguments are given as a JSON object, i.e.
+                   '{"realm": "wiki"}' for a compact job.
+                   """,
+                   self._complete_job_kind, self._do_job_add)
+            yield ('tags job run', '[--batches=<n>]',
+                   """Run queued tag maintenance jobs
+
+                   Runs batches of pending jobs until none is left, or at most
+                   the given number of batches. Meant to be run periodically,
+                   i.e. by cron, one runner at a time.
+                   """,
+                   None, self._do_job_run)
+            yield ('tags job cancel', '<id>',
+                   'Cancel a pending tag maintenance job',
+                   None, self._do_job_cancel)
+            yield ('tags job prune', '[--max-age=<days>]',
+                   """Delete old tag maintenance jobs
+
+                   Deletes finished, failed and cancelled jobs last changed
+                   more than 30 days ago by default.
+                   """,
+                   None, self._do_job_prune)
+
+    # Internal methods
+
+    def _complete_file(self, args):
+        if args and not args[-1].startswith('--'):
+            return get_dir_list(args[-1])
+
+    def _complete_job_kind(self, args):
+        if len(args) == 1:
+            return TagJobQueue(self.env).get_job_kinds()
+
+    def _complete_realm(self, args):
+        if len(args) == 1:
+            return list(TagSystem(self.env).get_taggable_realms())
+
+    def _do_compact(self, *args):
+        args, kw = parse_command_args(args, ('window', 'max-changes',
+                                             'max-age'))
+        if len(args) > 1:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        policy = dict((name.replace('-', '_'), as_count(value, name))
+                      for name, value in kw.iteritems())
+        started = time.time()
+        stats, start = TagHistoryCompactor(self.env).compact(
+            args and args[0] or None, **policy)
+        printout(_("Compacted tag history of %(compacted)s of %(resources)s "
+                   "resources, removed %(removed)s changes and archived "
+                   "%(archived)s in %(seconds).1f seconds.",
+                   seconds=time.time() - started, **stats))
+
+    def _do_check(self, *args):
+        provider = TicketTagProvider(self.env)
+        started = time.time()
+        checked = drifted = 0
+        for count, drift in self._iter_tickets(args, provider.get_tag_drift):
+            checked += count
+            drifted += len(drift)
+            for id, expected, actual in drift:
+                printout(_("Ticket #%(id)s: missing %(missing)s, "
+                           "unexpected %(unexpected)s", id=id,
+                           missing=' '.join(sorted(expected - actual)) or '-',
+                           unexpected=' '.join(sorted(actual - expected))
+                                      or '-'))
+        orphaned = provider.get_orphaned_tags()
+        for name in orphaned:
+            printout(_("Ticket #%(id)s: tagged, but does not exist", id=name))
+        printout(_("Checked %(checked)s tickets, found %(drifted)s with "
+                   "differing tags and %(orphaned)s deleted in %(seconds).1f "
+                   "seconds.", checked=checked, drifted=drifted,
+                   orphaned=len(orphaned), seconds=time.time() - started))
+
+    def _do_reindex(self, *args):
+        provider = TicketTagProvider(self.env)
+        started = time.time()
+        checked = fixed = 0
+        for count, batch_fixed in self._iter_tickets(args,
+                                                     provider.reindex_tags):
+            checked += count
+            fixed += batch_fixed
+            printout(_("Checked %(checked)s tickets, fixed %(fixed)s "
+                       "(%(seconds).1f seconds)", checked=checked,
+                       fixed=fixed, seconds=time.time() - started))
+        removed = provider.remove_orphaned_tags()
+        printout(_("Removed tags of %(removed)s deleted tickets.",
+                   removed=removed))
+
+        rebuilt = time.time()
+        # Fixing tickets has invalidated caches, that are rebuilt on next
+        # use.  Only the snapshot of the query index is worth building here.
+        if self.env.is_component_enabled(TagIndex) and \
+                TagIndex(self.env).enabled:
+            TagIndex(self.env).run_tag_job('index_rebuild', {}, None, 1)
+        printout(_("Rebuilt tag caches in %(seconds).1f seconds.",
+                   seconds=time.time() - rebuilt))
+
+    def _iter_tickets(self, args, func):
+        args, kw = parse_command_args(args, ('batch-size',))
+        if args:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        size = as_count(kw.get('batch-size', '1000'), 'batch-size') or 1000
+        after = None
+        while True:
+            count, after, result = func(after, size)
+            yield count, result
+            if after is None:
+                break
+
+    def _do_export(self, *args):
+        args, kw = parse_command_args(args, ('format', 'history', 'realm'))
+        if len(args) > 1:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        path = args and args[0] or None
+        format = get_export_format(path, kw.get('format'))
+        table = 'tags_change' if 'history' in kw else 'tags'
+        started = time.time()
+        rows = dump_rows(self.env, table, kw.get('realm'))
+        if not path:
+            write_rows(sys.stdout, format, EXPORT_FIELDS[table], rows)
+            return
+        with open(path, 'wb') as f:
+            count = write_rows(f, format, EXPORT_FIELDS[table], rows)
+        printout(_("Exported %(count)s rows in %(seconds).1f seconds.",
+                   count=count, seconds=time.time() - started))
+
+    def _do_feed_prune(self, *args):
+        args, kw = parse_command_args(args, ('max-age',))
+        if args:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        max_age = as_count(kw.get('max-age', '30'), 'max-age')
+        count = prune_feed(self.env, datetime.now(utc) -
+                                     timedelta(days=max_age))
+        printout(_("Deleted %(count)s changes.", count=count))
+
+    def _do_import(self, *args):
+        args, kw = parse_command_args(args, ('format', 'history',
+                                             'batch-size'))
+        if len(args) != 1:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        path = args[0]
+        format = get_export_format(path, kw.get('format'))
+        table = 'tags_change' if 'history' in kw else 'tags'
+        batch_size = as_count(kw.get('batch-size', '10000'), 'batch-size') \
+                     or 10000
+        started = time.time()
+        if path == '-':
+            f = sys.stdin
+        elif os.path.isfile(path):
+            f = open(path, 'rb')
+        else:
+            raise AdminCommandError(_("File '%(path)s' not found",
+                                      path=path))
+        try:
+            count = load_rows(self.env, table,
+                              read_rows(f, format, EXPORT_FIELDS[table]),
+                              batch_size)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        printout(_("Imported %(count)s rows in %(seconds).1f seconds.",
+                   count=count, seconds=time.time() - started))
+
+    def _do_job_list(self):
+        print_table([(job['id'], job['kind'], job['state'],
+                      format_progress(job), format_datetime(job['changed']),
+                      job['message'] or '')
+                     for job in TagJobQueue(self.env).get_jobs()],
+                    [_("Id"), _("Kind"), _("State"), _("Progress"),
+                     _("Changed"), _("Message")])
+
+    def _do_job_add(self, kind, args=None):
+        try:
+            args = json.loads(args) if args else {}
+        except ValueError:
+            args = None
+        if not isinstance(args, dict):
+            raise AdminCommandError(_("Job arguments must be a JSON object"))
+        try:
+            id = TagJobQueue(self.env).enqueue(kind, args, 'admin')
+        except TracError, e:
+            raise AdminCommandError(e.message)
+        printout(_("Queued job #%(id)s", id=id))
+
+    def _do_job_run(self, *args):
+        args, kw = parse_command_args(args, ('batches',))
+        if args:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        batches = as_count(kw.get('batches', '0'), 'batches')
+        queue = TagJobQueue(self.env)
+        count = 0
+        while not batches or count < batches:
+            started = time.time()
+            job = queue.run_batch()
+            if job is None:
+                break
+            count += 1
+            printout(_("Job #%(id)s %(kind)s: %(progress)s, %(state)s "
+                       "(%(seconds).1f seconds)", id=job['id'],
+                       kind=job['kind'], progress=format_progress(job),
+                       state=job['state'], seconds=time.time() - started))
+            if job['message']:
+                printout(job['message'])
+
+    def _do_job_cancel(self, id):
+        if not TagJobQueue(self.env).cancel(as_count(id, 'id')):
+            raise AdminCommandError(_("No pending job #%(id)s", id=id))
+
+    def _do_job_prune(self, *args):
+        args, kw = parse_command_args(args, ('max-age',))
+        if args:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        max_age = as_count(kw.get('max-age', '30'), 'max-age')
+        count = TagJobQueue(self.env).prune(datetime.now(utc) -
+                                            timedelta(days=max_age))
+        printout(_("Deleted %(count)s jobs.", count=count))
 
 
 class TagChangeAdminPanel(Component):
@@ -22,6 +439,11 @@ class TagChangeAdminPanel(Component):
 
     implements(IAdminPanelProvider)
 
+    defer_ticket_replace = BoolOption('tags', 'defer_ticket_replace', False,
+        doc="""Whether tags of tickets are replaced by a queued
+            `ticket_replace` job of the `TagJobQueue` component, instead of
+            within the request.""")
+
     # AdminPanelProvider methods
     def get_admin_panels(self, req):
         if 'TAGS_ADMIN' in req.perm:
@@ -53,9 +475,21 @@ class TagChangeAdminPanel(Component):
             else:
                 comment = req.args.get('comment', u'')
                 old_tags = req.args.getlist('tag_name')
-                if old_tags:
+                realms = checked_realms
+                if old_tags and 'ticket' in realms and \
+                        self.defer_ticket_replace and \
+                        self.env.is_component_enabled(TagJobQueue):
+                    # Every ticket takes a ticket change, so run it later.
+                    id = TagJobQueue(self.env).enqueue('ticket_replace',
+                        dict(old_tags=old_tags, new_tag=new_tag,
+                             comment=comment, author=req.authname),
+                        req.authname)
+                    add_notice(req, _("Tags of tickets will be replaced by "
+                                      "job #%(id)s.", id=id))
+                    realms = [r for r in realms if r != 'ticket']
+                if old_tags and realms:
                     tag_system.replace_tag(req, old_tags, new_tag, comment,
-                                           allow_delete, filter=checked_realms)
+                                           allow_delete, filter=realms)
                 data['selected'] = new_tag
             req.redirect(req.href.admin('tags', 'replace'))
 
@@ -68,3 +502,82 @@ class TagChangeAdminPanel(Component):
             return 'admin_tag_change.html', data, None
         else:
             return 'admin_tag_change.html', data
+
+
+class TagJobAdminPanel(Component):
+    """[opt] Admin web-UI for queued tag maintenance jobs."""
+
+    implements(IAdminPanelProvider)
+
+    # AdminPanelProvider methods
+    def get_admin_panels(self, req):
+        if 'TAGS_ADMIN' in req.perm and \
+                self.env.is_component_enabled(TagJobQueue):
+            yield 'tags', _('Tag System'), 'jobs', _('Jobs')
+
+    def render_admin_panel(self, req, cat, page, version):
+        req.perm.require('TAGS_ADMIN')
+
+        queue = TagJobQueue(self.env)
+        if req.method == 'POST':
+            if 'add' in req.args:
+                id = queue.enqueue(req.args.get('kind'),
+                                   author=req.authname)
+                add_notice(req, _("Queued job #%(id)s.", id=id))
+            elif 'cancel' in req.args:
+                for id in req.args.getlist('sel'):
+                    try:
+                        queue.cancel(as_count(id, 'id'))
+                    except AdminCommandError, e:
+                        add_warning(req, e)
+            req.redirect(req.href.admin('tags', 'jobs'))
+
+        jobs = queue.get_jobs()
+        for job in jobs:
+            job['progress'] = format_progress(job)
+        data = dict(jobs=jobs, kinds=[kind for kind in queue.get_job_kinds()
+                                      if kind != 'ticket_replace'])
+        if hasattr(Chrome(self.env), 'jenv'):
+            return 'admin_tag_jobs.html', data, None
+        else:
+            return 'admin_tag_jobs.html', data
+
+
+class TagMetricsAdminPanel(Component):
+    """[opt] Admin web-UI showing recent timings and counters of the tag
+    system recorded by `TagMetricsRecorder`.
+    """
+
+    implements(IAdminPanelProvider)
+
+    # AdminPanelProvider methods
+    def get_admin_panels(self, req):
+        if 'TAGS_ADMIN' in req.perm:
+            yield 'tags', _('Tag System'), 'metrics', _('Metrics')
+
+    def render_admin_panel(self, req, cat, page, version):
+        req.perm.require('TAGS_ADMIN')
+
+        recorder = None
+        for sink in TagMetrics(self.env).sinks:
+            if isinstance(sink, TagMetricsRecorder):
+                recorder = sink
+        if req.method == 'POST':
+            if recorder and 'reset' in req.args:
+                recorder.reset()
+                add_notice(req, _("Recorded metrics have been reset."))
+            req.redirect(req.href.admin('tags', 'metrics'))
+
+        data = dict(recording=recorder is not None, timings=[], counts=[])
+        if recorder:
+            format_ms = lambda seconds: '%.1f' % (seconds * 1000)
+            data['timings'] = [dict(name=name, samples=samples,
+                                    percentiles=map(format_ms, percentiles),
+                                    max=format_ms(max_))
+                               for name, samples, percentiles, max_
+                               in recorder.get_timings()]
+            data['counts'] = recorder.get_counts()
+        if hasattr(Chrome(self.env), 'jenv'):
+            return 'admin_tag_metrics.html', data, None
+        else:
+            return 'admin_tag_metrics.html', data
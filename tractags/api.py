@@ -9,6 +9,8 @@
 # you should have received as part of this distribution.
 #
 
+import heapq
+import inspect
 import re
 try:
     import threading
@@ -16,6 +18,7 @@ except ImportError:
     import dummy_threading as threading
     threading._get_ident = lambda: 0
 
+from itertools import chain
 from operator import itemgetter
 from pkg_resources import resource_filename
 
@@ -24,7 +27,7 @@ from trac.core import Component, ExtensionPoint, Interface, TracError
 from trac.core import implements
 from trac.perm import IPermissionPolicy, IPermissionRequestor
 from trac.perm import PermissionError, PermissionSystem
-from trac.resource import IResourceManager, get_resource_url
+from trac.resource import IResourceManager, Resource, get_resource_url
 from trac.resource import get_resource_description
 from trac.util import get_reporter_id
 from trac.util.text import to_unicode
@@ -37,7 +40,10 @@ add_domain, _, N_, gettext, ngettext, tag_, tagn_ = \
                                   'ngettext', 'tag_', 'tagn_'))
 dgettext = None
 
-from tractags.model import resource_tags, tag_frequency, tag_resource
+from tractags.metrics import SlowTagQueryLog, TagMetrics
+from tractags.model import TaggedResource, resource_tags, resources_tags
+from tractags.model import replace_tags, tag_exists, tag_frequency
+from tractags.model import tag_feed, tag_resource, tag_resources
 from tractags.model import tagged_resources
 # Now call module importing i18n methods from here.
 from tractags.query import *
@@ -166,6 +172,15 @@ class InvalidTagRealm(TracError):
     pass
 
 
+def _accepts_arg(method, name):
+    """Return whether a method accepts a keyword argument."""
+    try:
+        spec = inspect.getargspec(method)
+    except TypeError:
+        return False
+    return name in spec.args or spec.keywords is not None
+
+
 class ITagProvider(Interface):
     """The interface for Components providing per-realm tag storage and
     manipulation methods.
@@ -203,6 +218,21 @@ class ITagProvider(Interface):
     def set_resource_tags(req, resource, tags, comment=u'', when=None):
         """Set tags for a resource."""
 
+    def set_resource_tags_many(req, resources_tags, comment=u'', when=None):
+        """Set tags for many resources given as `(resource, tags)` pairs.
+
+        Optional, `TagSystem.set_tags_many()` falls back to calling
+        `set_resource_tags()` for each resource.
+        """
+
+    def replace_resource_tags(req, old_tags, new_tag=None, comment=u''):
+        """Replace `old_tags` by `new_tag` on all resources of the realm,
+        or delete them if `new_tag` is `None`.
+
+        Optional, `TagSystem.replace_tag()` falls back to calling
+        `set_resource_tags()` for each resource tagged with `old_tags`.
+        """
+
     def reparent_resource_tags(req, resource, old_id, comment=u''):
         """Move tags, typically when renaming an existing resource."""
 
@@ -213,6 +243,20 @@ class ITagProvider(Interface):
         """Return a one line description of the tagged resource."""
 
 
+class ITagChangeListener(Interface):
+    """Extension point interface for components that require notification
+    when tags stored in the `tags` db table are changed, i.e. for keeping
+    derived data current.
+    """
+
+    def tags_changed(realm, names=None):
+        """Called after tags of resources in a realm have been changed.
+
+        :param names: IDs of the affected resources, or `None` for changes
+                      to an unknown set of resources.
+        """
+
+
 class DefaultTagProvider(Component):
     """An abstract base tag provider that stores tags in the database.
 
@@ -258,12 +302,17 @@ class DefaultTagProvider(Component):
         return tagged_resources(self.env, self.check_permission, req.perm,
                                 self.realm, tags, filter)
 
-    def get_all_tags(self, req, filter=None):
+    def get_all_tags(self, req, filter=None, mincount=None):
         all_tags = Counter()
-        for tag, count in tag_frequency(self.env, self.realm, filter):
+        for tag, count in tag_frequency(self.env, self.realm, filter,
+                                        mincount=mincount):
             all_tags[tag] = count
         return all_tags
 
+    def tag_exists(self, req, tag, filter=None):
+        """Return whether a tag is used on any resource of the realm."""
+        return tag_exists(self.env, self.realm, tag, filter)
+
     def get_resource_tags(self, req, resource, when=None):
         assert resource.realm == self.realm
         if not self.check_permission(req.perm(resource), 'view'):
@@ -274,6 +323,12 @@ class DefaultTagProvider(Component):
         assert resource.realm == self.realm
         return resource_tags(self.env, resource)
 
+    def resources_tags(self, resources):
+        """Return a dict of tags by resource ID with one query."""
+        ids = dict((to_unicode(r.id), r.id) for r in resources)
+        return dict((ids[name], tags) for name, tags
+                    in resources_tags(self.env, self.realm, ids).iteritems())
+
     def set_resource_tags(self, req, resource, tags, comment=u'', when=None):
         assert resource.realm == self.realm
         if not self.check_permission(req.perm(resource), 'modify'):
@@ -281,6 +336,32 @@ class DefaultTagProvider(Component):
         tag_resource(self.env, resource, author=self._get_author(req),
                      tags=tags, log=self.revisable, when=when)
 
+    def set_resource_tags_many(self, req, resources_tags, comment=u'',
+                               when=None):
+        resources_tags = list(resources_tags)
+        for resource, tags in resources_tags:
+            assert resource.realm == self.realm
+            if not self.check_permission(req.perm(resource), 'modify'):
+                raise PermissionError(resource=resource, env=self.env)
+        return tag_resources(self.env, self.realm,
+                             [(resource.id, tags)
+                              for resource, tags in resources_tags],
+                             author=self._get_author(req),
+                             log=self.revisable, when=when)
+
+    def replace_resource_tags(self, req, old_tags, new_tag=None, comment=u'',
+                              filter=None):
+        if not self.check_permission(req.perm, 'view'):
+            return 0
+        def check(names):
+            for name in names:
+                resource = Resource(self.realm, name)
+                if not self.check_permission(req.perm(resource), 'modify'):
+                    raise PermissionError(resource=resource, env=self.env)
+        return replace_tags(self.env, self.realm, old_tags, new_tag,
+                            author=self._get_author(req), log=self.revisable,
+                            filter=filter, check=check)
+
     def reparent_resource_tags(self, req, resource, old_id, comment=u''):
         assert resource.realm == self.realm
         if not self.check_permission(req.perm(resource), 'modify'):
@@ -298,6 +379,22 @@ class DefaultTagProvider(Component):
     def describe_tagged_resource(self, req, resource):
         raise NotImplementedError
 
+    def filter_tagged_resources(self, req, tagged):
+        """Return resources from `(name, tags)` pairs with view permission.
+
+        Used for query results resolved from the `TagIndex`, so this must
+        apply the same checks as `get_tagged_resources()`.
+        """
+        if not self.check_permission(req.perm, 'view'):
+            return
+        checks = 0
+        for name, tags in tagged:
+            resource = Resource(self.realm, name)
+            checks += 1
+            if self.check_permission(req.perm(resource), 'view'):
+                yield TaggedResource(self.realm, name, tags)
+        TagMetrics(self.env).count('perm_checks.' + self.realm, checks)
+
     def _get_author(self, req):
         return get_reporter_id(req, 'author')
 
@@ -373,7 +470,11 @@ class TagSystem(Component):
     # Public methods
 
     def query(self, req, query='', attribute_handlers=None):
-        """Returns a sequence of (resource, tags) tuples matching a query.
+        """Returns a sequence of (resource, tags) pairs matching a query.
+
+        Pairs are `TaggedResource` records, that unpack like tuples.  Use
+        `query_tagged()` for access to realm and ID without creating
+        `Resource` objects.
 
         Query syntax is described in tractags.query.
 
@@ -381,28 +482,57 @@ class TagSystem(Component):
                                    handlers. See Query documentation for more
                                    information.
         """
-        def realm_handler(_, node, context):
-            return query.match(node, [context.realm])
+        return self.query_tagged(req, query, attribute_handlers)
 
-        all_attribute_handlers = {
-            'realm': realm_handler,
-        }
-        all_attribute_handlers.update(attribute_handlers or {})
-        query = Query(query, attribute_handlers=all_attribute_handlers)
-        providers = set()
-        for m in REALM_RE.finditer(query.as_string()):
-            realm = m.group(1)
-            providers.add(self._get_provider(realm))
-        if not providers:
-            providers = self.tag_providers
+    def query_tagged(self, req, query='', attribute_handlers=None):
+        """Returns a sequence of `TaggedResource` records matching a query.
 
-        query_tags = set(query.terms())
-        for provider in providers:
-            self.env.log.debug('Querying ' + repr(provider))
-            for resource, tags in provider.get_tagged_resources(req,
-                                                          query_tags) or []:
-                if query(tags, context=resource):
-                    yield resource, tags
+        Records provide `realm`, `id` and `tags` attributes, the `Resource`
+        object is only created on access of the `resource` attribute.
+
+        Custom attribute handlers get `Resource` objects as context,
+        otherwise the handlers only get the record.
+        """
+        trace = SlowTagQueryLog(self.env).start(query)
+        records = chain.from_iterable(records for provider, records in
+                                      self._query_providers(
+                                          req, query, attribute_handlers,
+                                          trace))
+        if trace:
+            records = self._traced(trace, records)
+        return TagMetrics(self.env).timed('query', records)
+
+    def query_tagged_page(self, req, query='', limit=None, after=None):
+        """Returns a list of up to `limit` `TaggedResource` records matching
+        a query, ordered by realm and id.
+
+        Only records following the `(realm, id)` key `after` are returned,
+        so the key of the last record continues with the next page.  Each
+        realm is scanned keeping only the records of the page in memory.
+        """
+        key = lambda record: to_unicode(record.id)
+        page = []
+        query_log = SlowTagQueryLog(self.env)
+        trace = query_log.start(query)
+        providers = sorted(self._query_providers(req, query, trace=trace),
+                           key=lambda item: item[0].get_taggable_realm())
+        for provider, records in providers:
+            realm = provider.get_taggable_realm()
+            if trace:
+                records = trace.iterate(records)
+            if after and realm < after[0]:
+                continue
+            if after and realm == after[0]:
+                records = (r for r in records
+                           if key(r) > to_unicode(after[1]))
+            if limit:
+                page.extend(heapq.nsmallest(limit - len(page), records, key))
+                if len(page) == limit:
+                    break
+            else:
+                page.extend(sorted(records, key=key))
+        query_log.finish(trace)
+        return page
 
     def get_taggable_realms(self, perm=None):
         """Returns the names of available taggable realms as set.
@@ -416,34 +546,136 @@ class TagSystem(Component):
                    if perm is None or not hasattr(p, 'check_permission') or
                        p.check_permission(perm, 'view'))
 
-    def get_all_tags(self, req, realms=[]):
+    def get_all_tags(self, req, realms=[], mincount=None, limit=None):
         """Get all tags for all supported realms or only for specified ones.
 
         Returns a Counter object (special dict) with tag name as key and tag
-        frequency as value.
+        frequency as value.  Tags with a frequency below `mincount` are
+        omitted, and `limit` keeps only that many most frequent tags.
         """
+        with TagMetrics(self.env).timer('get_all_tags'):
+            return self._get_all_tags(req, realms, mincount, limit)
+
+    def _get_all_tags(self, req, realms, mincount, limit):
         all_tags = Counter()
         all_realms = self.get_taggable_realms(req.perm)
         if not realms or set(realms) == all_realms:
             realms = all_realms
-        for provider in self.tag_providers:
-            if provider.get_taggable_realm() in realms:
+        providers = [p for p in self.tag_providers
+                     if p.get_taggable_realm() in realms]
+        if len(providers) == 1 and \
+                isinstance(providers[0], DefaultTagProvider) and \
+                _accepts_arg(providers[0].get_all_tags, 'mincount'):
+            # Let the database skip infrequent tags.  With more realms this
+            # is only correct after summing up tag frequencies.  Subclasses
+            # may still override the method without the argument.
+            all_tags = providers[0].get_all_tags(req, mincount=mincount)
+            providers = []
+            mincount = None
+        for provider in providers:
+            try:
+                all_tags += provider.get_all_tags(req)
+            except AttributeError:
+                # Fallback for older providers.
                 try:
-                    all_tags += provider.get_all_tags(req)
-                except AttributeError:
-                    # Fallback for older providers.
-                    try:
-                        for resource, tags in \
-                            provider.get_tagged_resources(req):
-                                all_tags.update(tags)
-                    except TypeError:
-                        # Defense against loose ITagProvider implementations,
-                        # that might become obsolete in the future.
-                        self.env.log.warning('ITagProvider %r has outdated'
-                                             'get_tagged_resources() method' %
-                                             provider)
+                    for resource, tags in \
+                        provider.get_tagged_resources(req):
+                            all_tags.update(tags)
+                except TypeError:
+                    # Defense against loose ITagProvider implementations,
+                    # that might become obsolete in the future.
+                    self.env.log.warning('ITagProvider %r has outdated'
+                                         'get_tagged_resources() method' %
+                                         provider)
+        if mincount > 1:
+            all_tags = Counter(dict((tag, count)
+                                    for tag, count in all_tags.iteritems()
+                                    if count >= mincount))
+        if limit and len(all_tags) > limit:
+            top = heapq.nsmallest(limit, all_tags.iteritems(),
+                                  key=lambda t: (-t[1], t[0]))
+            all_tags = Counter(dict(top))
         return all_tags
 
+    def exists(self, req, query):
+        """Returns whether a tag query yields at least one match.
+
+        A query for a single tag is answered like a lookup in the result of
+        `get_all_tags()`, otherwise the query is evaluated until the first
+        match.  Results are remembered for the current request.
+        """
+        parsed = Query(query)
+        if parsed.type == parsed.TERM:
+            return self.tag_exists(req, parsed.value)
+        memo = self._get_exists_memo(req)
+        key = ('query', query)
+        if key not in memo:
+            memo[key] = False
+            for record in self.query_tagged(req, query):
+                memo[key] = True
+                break
+        return memo[key]
+
+    def tag_exists(self, req, tag, realms=[]):
+        """Returns whether a tag exists in all or the specified realms.
+
+        This is a shortcut for `tag in get_all_tags(req, realms)` remembered
+        for the current request.
+        """
+        memo = self._get_exists_memo(req)
+        key = ('tag', tag, tuple(sorted(realms)))
+        if key not in memo:
+            memo[key] = False
+            all_realms = self.get_taggable_realms(req.perm)
+            for provider in self.tag_providers:
+                realm = provider.get_taggable_realm()
+                if realm not in all_realms or realms and realm not in realms:
+                    continue
+                if isinstance(provider, DefaultTagProvider):
+                    exists = provider.tag_exists(req, tag)
+                else:
+                    exists = tag in self.get_all_tags(req, [realm])
+                if exists:
+                    memo[key] = True
+                    break
+        return memo[key]
+
+    def get_related_tags(self, req, tag, realms=[], limit=None):
+        """Returns tags used together with a tag, most frequent first.
+
+        Returns a list of `(tag, count)` tuples, where count is the number
+        of resources having both tags.  Precomputed co-occurrence counts are
+        used for realms covered by `TagCompletionIndex`, unless permission
+        policies other than the default ones may restrict viewing single
+        resources.  Then only resources the user may view are counted.
+        """
+        # Import here, because the index depends on this module.
+        from tractags.index import TagCompletionIndex
+        index = self.env.is_enabled(TagCompletionIndex) and \
+                not self._has_resource_permissions() and \
+                TagCompletionIndex(self.env) or None
+        all_realms = self.get_taggable_realms(req.perm)
+        related = []
+        for provider in self.tag_providers:
+            realm = provider.get_taggable_realm()
+            if realm not in all_realms or realms and realm not in realms:
+                continue
+            pairs = index and index.get_related(realm, tag)
+            if pairs is None:
+                counts = Counter()
+                for resource, tags in provider.get_tagged_resources(req,
+                                                                    [tag]):
+                    counts.update(t for t in tags if t != tag)
+                pairs = sorted(counts.iteritems(),
+                               key=lambda t: (-t[1], t[0]))
+            related.append(pairs)
+        if len(related) == 1:
+            return related[0][:limit]
+        counts = Counter()
+        for pairs in related:
+            counts.update(dict(pairs))
+        return sorted(counts.iteritems(), key=lambda t: (-t[1], t[0]))[:limit]
+
     def get_tags(self, req, resource, when=None):
         """Get tags for resource."""
         if not req:
@@ -454,6 +686,74 @@ class TagSystem(Component):
         return set(self._get_provider(resource.realm) \
                    .get_resource_tags(req, resource, when=when))
 
+    def changes_since(self, req, cursor=0, limit=100):
+        """Return resources with tags changed after a change feed cursor.
+
+        Returns a list of `(seq, realm, id, tags)` tuples ordered by the
+        sequence number `seq`, and the cursor to continue from.  Resources
+        are listed once per call with their current tags.  An id of `None`
+        means, that an unknown set of resources of the realm has changed, so
+        the whole realm needs to be read again, like all realms for a cursor
+        before pruned changes.  Changes of resources, that can't be viewed,
+        are skipped.  Changes after a recent gap in the sequence are held
+        back, see `tag_feed()`.
+        """
+        feed, next = tag_feed(self.env, cursor, limit)
+        feed = [row for row in feed if row[0] <= next]
+        if not feed:
+            return [], cursor
+        latest = {}
+        for seq, realm, name in feed:
+            latest[realm, name] = seq
+        if req:
+            realms = self.get_taggable_realms(req.perm)
+        else:
+            realms = self.get_taggable_realms()
+        tags = self.get_tags_many(req, [Resource(realm, name)
+                                        for realm, name in latest
+                                        if name and realm in realms])
+        changes = []
+        for (realm, name), seq in sorted(latest.iteritems(),
+                                         key=itemgetter(1)):
+            if realm is None:
+                changes.extend((seq, realm, None, None)
+                               for realm in sorted(realms))
+            elif not name:
+                if realm in realms:
+                    changes.append((seq, realm, None, None))
+            elif (realm, name) in tags:
+                changes.append((seq, realm, name, tags[realm, name]))
+        return changes, next
+
+    def get_tags_many(self, req, resources):
+        """Get tags for many resources at once.
+
+        Returns a dict of tag sets by `(realm, id)` tuple.  Tags of resources
+        from realms of `DefaultTagProvider` are loaded with one query per
+        realm.  Like for `get_tags()` permission checks are bypassed, if no
+        request is given.
+        """
+        by_realm = {}
+        for resource in resources:
+            by_realm.setdefault(resource.realm, []).append(resource)
+        all_tags = {}
+        for realm, realm_resources in by_realm.iteritems():
+            provider = self._get_provider(realm)
+            if req:
+                realm_resources = [r for r in realm_resources if
+                                   provider.check_permission(req.perm(r),
+                                                             'view')]
+            if isinstance(provider, DefaultTagProvider):
+                tags = provider.resources_tags(realm_resources)
+                for resource in realm_resources:
+                    all_tags[realm, resource.id] = tags.get(resource.id,
+                                                            set())
+            else:
+                for resource in realm_resources:
+                    all_tags[realm, resource.id] = \
+                        set(provider.resource_tags(resource))
+        return all_tags
+
     def set_tags(self, req, resource, tags, comment=u'', when=None):
         """Set tags on a resource.
 
@@ -467,6 +767,23 @@ class TagSystem(Component):
             return self._get_provider(resource.realm) \
                    .set_resource_tags(req, resource, set(tags))
 
+    def set_tags_many(self, req, resources_tags, comment=u'', when=None):
+        """Set tags on many resources given as `(resource, tags)` pairs.
+
+        Existing tags are replaced.  Providers supporting it save all
+        resources of their realm in batches, others one by one.
+        """
+        by_realm = {}
+        for resource, tags in resources_tags:
+            by_realm.setdefault(resource.realm, []).append((resource, tags))
+        for realm, items in by_realm.iteritems():
+            provider = self._get_provider(realm)
+            if hasattr(provider, 'set_resource_tags_many'):
+                provider.set_resource_tags_many(req, items, comment, when)
+            else:
+                for resource, tags in items:
+                    self.set_tags(req, resource, tags, comment, when)
+
     def add_tags(self, req, resource, tags, comment=u''):
         """Add to existing tags on a resource."""
         tags = set(tags)
@@ -490,11 +807,17 @@ class TagSystem(Component):
         """Replace one or more tags in all resources it exists/they exist in.
 
         Tagged resources may be filtered by realm and tag deletion is
-        optionally allowed for convenience as well.
+        optionally allowed for convenience as well.  Providers implementing
+        `replace_resource_tags()` do the replacement in one go.
         """
         # Provide list regardless of attribute type.
         for provider in [p for p in self.tag_providers
                          if not filter or p.get_taggable_realm() in filter]:
+            replace = getattr(provider, 'replace_resource_tags', None)
+            if replace is not None:
+                if new_tag or allow_delete:
+                    replace(req, old_tags, new_tag, comment)
+                continue
             for resource, tags in \
                     provider.get_tagged_resources(req, old_tags):
                 old_tags = set(old_tags)
@@ -580,6 +903,31 @@ class TagSystem(Component):
 
     # Internal methods
 
+    def _get_exists_memo(self, req):
+        try:
+            return req._tags_exists_memo
+        except AttributeError:
+            memo = req._tags_exists_memo = {}
+            return memo
+
+    def _has_resource_permissions(self):
+        """Whether permission policies other than the default ones are
+        enabled, that may grant different permissions for single resources
+        than for their realm.
+        """
+        default_policies = self.config.defaults().get('trac', {}) \
+                                      .get('permission_policies')
+        return not all(p in default_policies for p in
+                       self.config.getlist('trac', 'permission_policies'))
+
+    def _get_index(self):
+        # Import here, because the index depends on this module.
+        from tractags.index import TagIndex
+        if self.env.is_enabled(TagIndex):
+            index = TagIndex(self.env)
+            if index.enabled:
+                return index
+
     def _populate_provider_map(self):
         if self._realm_provider_map is None:
             # Only use the map once it is fully initialized.
@@ -587,6 +935,77 @@ class TagSystem(Component):
                        for provider in self.tag_providers)
             self._realm_provider_map = map
 
+    def _query_providers(self, req, query, attribute_handlers=None,
+                         trace=None):
+        """Yield tag providers with iterators of their records matching a
+        query.
+
+        Realms and record counts are added to the `QueryTrace` `trace`, if
+        given.
+        """
+        def realm_handler(_, node, context):
+            return query.match(node, [context.realm])
+
+        all_attribute_handlers = {
+            'realm': realm_handler,
+        }
+        all_attribute_handlers.update(attribute_handlers or {})
+        query = Query(query, attribute_handlers=all_attribute_handlers)
+        providers = set()
+        for m in REALM_RE.finditer(query.as_string()):
+            realm = m.group(1)
+            providers.add(self._get_provider(realm))
+        if not providers:
+            providers = self.tag_providers
+        if trace:
+            trace.realms = sorted(p.get_taggable_realm() for p in providers)
+
+        # Custom attribute handlers can't be resolved from the tag index.
+        index = not attribute_handlers and self._get_index() or None
+        query_tags = set(query.terms())
+
+        def _records(provider):
+            self.env.log.debug('Querying ' + repr(provider))
+            if index and isinstance(provider, DefaultTagProvider):
+                tagged = index.query(provider.get_taggable_realm(), query)
+                if tagged is not None:
+                    for record in \
+                            provider.filter_tagged_resources(req, tagged):
+                        if trace:
+                            trace.candidates += 1
+                            trace.matched += 1
+                        yield record
+                    return
+            for record in provider.get_tagged_resources(req,
+                                                        query_tags) or []:
+                if trace:
+                    trace.candidates += 1
+                if not isinstance(record, TaggedResource):
+                    # Convert pairs from providers not using records.
+                    resource, tags = record
+                    record = TaggedResource(resource.realm, resource.id,
+                                            tags)
+                context = attribute_handlers and record.resource or record
+                if query(record.tags, context=context):
+                    if trace:
+                        trace.matched += 1
+                    yield record
+
+        metrics = TagMetrics(self.env)
+        for provider in providers:
+            realm = provider.get_taggable_realm()
+            yield provider, metrics.timed('query.' + realm,
+                                          _records(provider),
+                                          'query.%s.matched' % realm)
+
+    def _traced(self, trace, records):
+        # Finish on close too, as results are often used up to a limit.
+        try:
+            for record in trace.iterate(records):
+                yield record
+        finally:
+            SlowTagQueryLog(self.env).finish(trace)
+
     def _get_provider(self, realm):
         try:
             return self._realm_provider_map[realm]
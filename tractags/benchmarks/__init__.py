@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Benchmarks of the tag system on synthetic tag corpora.
+
+Run them from the command line like so:
+  $> PYTHONPATH=$PWD python -m tractags.benchmarks --resources=10000 \
+         --output=results.json
+
+and compare the results of a later run against them with
+`--compare=results.json`.  See `--help` for the shape of the corpus.
+"""
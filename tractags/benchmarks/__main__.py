@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import sys
+
+from tractags.benchmarks.runner import main
+
+sys.exit(main())
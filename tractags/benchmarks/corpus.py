@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import random
+from bisect import bisect
+from collections import OrderedDict
+from datetime import datetime
+
+from trac.util.datefmt import to_utimestamp, utc
+
+from tractags.model import notify_tags_changed
+from tractags.ticket import TicketTagProvider
+
+# Parameters of the generated corpus and their defaults.
+CORPUS_DEFAULTS = [
+    ('realms', ['wiki', 'ticket']),
+    ('resources', 1000),        # per realm
+    ('tags', 500),              # number of distinct tags
+    ('tags_per_resource', 5),
+    ('zipf', 1.1),              # exponent of the tag distribution
+    ('history', 2),             # tag changes recorded per resource
+    ('seed', 0),
+]
+
+
+def tag_name(rank):
+    """Return the name of the tag with the given popularity rank (1-based).
+    """
+    return u'tag%d' % rank
+
+
+def resource_name(realm, i):
+    if realm == 'ticket':
+        return unicode(i)
+    return u'BenchPage%06d' % i
+
+
+class ZipfSampler(object):
+    """Draw tag ranks from `1` to `n` following Zipf's law, so the tag of
+    rank `k` is used with a frequency proportional to `1 / k ** s`.
+    """
+
+    def __init__(self, n, s, random):
+        self.random = random
+        self.cumulative = []
+        total = 0.0
+        for k in xrange(1, n + 1):
+            total += 1.0 / k ** s
+            self.cumulative.append(total)
+
+    def sample(self, size):
+        """Return `size` distinct ranks."""
+        size = min(size, len(self.cumulative))
+        total = self.cumulative[-1]
+        ranks = set()
+        while len(ranks) < size:
+            ranks.add(bisect(self.cumulative, self.random.random() * total)
+                      + 1)
+        return sorted(ranks)
+
+
+def generate_corpus(env, **params):
+    """Populate the database of `env` with a synthetic tag corpus.
+
+    Keyword arguments override the `CORPUS_DEFAULTS`.  The corpus is
+    reproducible for equal parameters.  Tickets are created with tags in
+    their keywords field and synchronized like on plugin setup, resources
+    of other realms are tagged directly.  Returns the parameters used.
+    """
+    params = OrderedDict((name, params.get(name, default))
+                         for name, default in CORPUS_DEFAULTS)
+    rnd = random.Random(params['seed'])
+    sampler = ZipfSampler(params['tags'], params['zipf'], rnd)
+    now = to_utimestamp(datetime.now(utc))
+
+    for realm in params['realms']:
+        items = [(resource_name(realm, i),
+                  [tag_name(rank) for rank in
+                   sampler.sample(params['tags_per_resource'])])
+                 for i in xrange(1, params['resources'] + 1)]
+        changes = []
+        for name, tags in items:
+            # Walk back in time from the current tags to initial tagging.
+            newtags = tags
+            for depth in xrange(1, params['history'] + 1):
+                oldtags = [tag_name(rank) for rank in
+                           sampler.sample(params['tags_per_resource'])] \
+                          if depth < params['history'] else []
+                changes.append((realm, name, now - depth * 1000000,
+                                'bench', ' '.join(oldtags), ' '.join(newtags)))
+                newtags = oldtags
+        with env.db_transaction as db:
+            if realm == 'ticket':
+                db.executemany("""
+                    INSERT INTO ticket (id, type, time, changetime, summary,
+                                        reporter, status, keywords)
+                    VALUES (%s,'defect',%s,%s,%s,'bench','new',%s)
+                    """, [(int(name), now, now, 'Ticket %s' % name,
+                           ' '.join(tags)) for name, tags in items])
+            else:
+                db.executemany("""
+                    INSERT INTO tags (tagspace, name, tag) VALUES (%s,%s,%s)
+                    """, [(realm, name, tag) for name, tags in items
+                                             for tag in tags])
+            db.executemany("""
+                INSERT INTO tags_change
+                 (tagspace, name, time, author, oldtags, newtags)
+                VALUES (%s,%s,%s,%s,%s,%s)
+                """, changes)
+        if realm == 'ticket':
+            with env.db_transaction:
+                TicketTagProvider(env)._fetch_tkt_tags()
+        else:
+            notify_tags_changed(env, realm)
+    return params
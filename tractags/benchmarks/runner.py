@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import trac
+from trac.db.sqlite_backend import sqlite_version_string
+from trac.env import Environment
+from trac.perm import PermissionSystem
+from trac.test import MockRequest
+from trac.web.chrome import web_context
+from trac.wiki.formatter import Formatter
+
+from tractags.api import TagSystem
+from tractags.benchmarks.corpus import CORPUS_DEFAULTS, generate_corpus
+from tractags.benchmarks.corpus import tag_name
+from tractags.db import TagSetup
+from tractags.macros import TagWikiMacros
+from tractags.model import tagged_resources
+from tractags.ticket import TicketTagProvider
+
+# Version of the JSON results format.
+RESULTS_VERSION = 1
+
+
+def create_environment(path):
+    """Create a Trac environment with a SQLite database and the tags
+    plugin set up in the directory `path`.
+    """
+    env = Environment(path, create=True,
+                      options=[('components', 'tractags.*', 'enabled'),
+                               ('logging', 'log_type', 'none')])
+    TagSetup(env).upgrade_environment()
+    # Used for modifying tags in the corpus.
+    PermissionSystem(env).grant_permission('bench', 'TRAC_ADMIN')
+    return env
+
+
+# Benchmarks
+#
+# Each benchmark returns the function to time, and a function called before
+# each run, that is not timed, or `None`.  Queries are done anonymously,
+# changes by the 'bench' user.
+
+def _formatter(env):
+    req = MockRequest(env, authname='anonymous')
+    return Formatter(env, web_context(req, 'wiki', 'WikiStart'))
+
+def bench_query(env, corpus):
+    req = MockRequest(env, authname='anonymous')
+    return lambda: list(TagSystem(env).query(req, tag_name(1))), None
+
+def bench_query_expression(env, corpus):
+    req = MockRequest(env, authname='anonymous')
+    query = '(%s or %s) -%s' % (tag_name(2), tag_name(3), tag_name(1))
+    return lambda: list(TagSystem(env).query(req, query)), None
+
+def bench_get_all_tags(env, corpus):
+    req = MockRequest(env, authname='anonymous')
+    return lambda: TagSystem(env).get_all_tags(req), None
+
+def bench_tagged_resources(env, corpus):
+    req = MockRequest(env, authname='anonymous')
+    realm = corpus['realms'][0]
+    check = TagSystem(env)._get_provider(realm).check_permission
+    return lambda: list(tagged_resources(env, check, req.perm, realm,
+                                         [tag_name(1)])), None
+
+def bench_list_tagged(env, corpus):
+    formatter = _formatter(env)
+    return lambda: unicode(TagWikiMacros(env).expand_macro(
+                               formatter, 'ListTagged', tag_name(1))), None
+
+def bench_tag_cloud(env, corpus):
+    formatter = _formatter(env)
+    return lambda: unicode(TagWikiMacros(env).expand_macro(
+                               formatter, 'TagCloud', '')), None
+
+def bench_fetch_ticket_tags(env, corpus):
+    def setup():
+        env.db_transaction("DELETE FROM tags WHERE tagspace='ticket'")
+    def run():
+        with env.db_transaction:
+            TicketTagProvider(env)._fetch_tkt_tags()
+    return run, setup
+
+def bench_replace_tag(env, corpus):
+    req = MockRequest(env, authname='bench')
+    tag = tag_name(max(1, corpus['tags'] // 20))
+    def setup():
+        # Restore the tag replaced by the previous run.
+        TagSystem(env).replace_tag(req, ['benchtag'], tag)
+    return lambda: TagSystem(env).replace_tag(req, [tag], 'benchtag'), setup
+
+BENCHMARKS = OrderedDict([
+    ('query', bench_query),
+    ('query_expression', bench_query_expression),
+    ('get_all_tags', bench_get_all_tags),
+    ('tagged_resources', bench_tagged_resources),
+    ('list_tagged', bench_list_tagged),
+    ('tag_cloud', bench_tag_cloud),
+    ('fetch_ticket_tags', bench_fetch_ticket_tags),
+    ('replace_tag', bench_replace_tag),
+])
+
+
+def run_benchmarks(env, corpus, names=None, repeat=5):
+    """Time benchmarks on the corpus generated with parameters `corpus`.
+
+    Returns a dict of the run times in seconds by benchmark name.  The
+    ticket synchronization is skipped without tickets in the corpus.
+    """
+    results = OrderedDict()
+    for name, bench in BENCHMARKS.iteritems():
+        if names and name not in names or \
+                name == 'fetch_ticket_tags' and \
+                'ticket' not in corpus['realms']:
+            continue
+        func, setup = bench(env, corpus)
+        runs = []
+        for i in xrange(repeat):
+            if setup:
+                setup()
+            started = time.time()
+            func()
+            runs.append(time.time() - started)
+        results[name] = _stats(runs)
+    return results
+
+
+def compare_results(baseline, results, tolerance=0.1):
+    """Compare median run times of benchmarks with a baseline.
+
+    Returns a list of `(name, baseline, current, ratio, regressed)` tuples
+    for benchmarks in both results, where a benchmark regressed, if it is
+    slower than the baseline by more than `tolerance`.
+    """
+    compared = []
+    for name, stats in results['results'].iteritems():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = stats['median'] / base['median'] if base['median'] else 1.0
+        compared.append((name, base['median'], stats['median'], ratio,
+                         ratio > 1 + tolerance))
+    return compared
+
+
+def _stats(runs):
+    ordered = sorted(runs)
+    return OrderedDict([('min', ordered[0]),
+                        ('median', ordered[len(ordered) // 2]),
+                        ('max', ordered[-1]),
+                        ('runs', runs)])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tractags.benchmarks',
+        description="Time the tag system on a synthetic tag corpus.")
+    defaults = dict(CORPUS_DEFAULTS)
+    parser.add_argument('--realms', default=','.join(defaults['realms']),
+                        help="comma separated realms to tag "
+                             "(default: %(default)s)")
+    for name, type_, help in [
+            ('resources', int, "tagged resources per realm"),
+            ('tags', int, "number of distinct tags"),
+            ('tags-per-resource', int, "tags of each resource"),
+            ('zipf', float, "exponent of the Zipf distribution of tags"),
+            ('history', int, "tag changes recorded per resource"),
+            ('seed', int, "seed of the random generator")]:
+        parser.add_argument('--' + name, type=type_,
+                            default=defaults[name.replace('-', '_')],
+                            help=help + " (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each benchmark (default: %(default)s)")
+    parser.add_argument('--benchmark', action='append',
+                        choices=list(BENCHMARKS),
+                        help="benchmark to run, may be repeated "
+                             "(default: all)")
+    parser.add_argument('--env',
+                        help="new directory for the Trac environment, kept "
+                             "after the run (default: a temporary one)")
+    parser.add_argument('--output',
+                        help="file to write JSON results to "
+                             "(default: standard output)")
+    parser.add_argument('--compare',
+                        help="JSON results of an earlier run to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="slowdown reported as regression "
+                             "(default: %(default)s)")
+    options = parser.parse_args(args)
+
+    path = options.env or tempfile.mkdtemp(prefix='tractags-bench-')
+    env = create_environment(path)
+    try:
+        started = time.time()
+        corpus = generate_corpus(env,
+            realms=[realm.strip() for realm in options.realms.split(',')],
+            resources=options.resources, tags=options.tags,
+            tags_per_resource=options.tags_per_resource, zipf=options.zipf,
+            history=options.history, seed=options.seed)
+        sys.stderr.write("Generated corpus in %.1f seconds\n"
+                         % (time.time() - started))
+        results = OrderedDict([
+            ('version', RESULTS_VERSION),
+            ('platform', OrderedDict([
+                ('python', sys.version.split()[0]),
+                ('trac', trac.__version__),
+                ('sqlite', sqlite_version_string)])),
+            ('corpus', corpus),
+            ('results', run_benchmarks(env, corpus, options.benchmark,
+                                       options.repeat))])
+    finally:
+        env.shutdown()
+        if not options.env:
+            shutil.rmtree(path)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressed = False
+        for name, base, current, ratio, slower in \
+                compare_results(baseline, results, options.tolerance):
+            sys.stderr.write("%-20s %9.4fs %9.4fs %6.2fx%s\n"
+                             % (name, base, current, ratio,
+                                '  REGRESSION' if slower else ''))
+            regressed |= slower
+        return 1 if regressed else 0
+    return 0
@@ -8,7 +8,7 @@
 
 from trac.db import Table, Column, Index
 
-schema_version = 4
+schema_version = 7
 
 
 schema = [
@@ -26,6 +26,28 @@ schema = [
         Column('author'),
         Column('oldtags'),
         Column('newtags'),
+        Index(['time']),
+        Index(['author']),
+    ],
+    Table('tags_job', key='id')[
+        Column('id', auto_increment=True),
+        Column('kind'),
+        Column('args'),
+        Column('state'),
+        Column('position'),
+        Column('done', type='int'),
+        Column('total', type='int'),
+        Column('message'),
+        Column('author'),
+        Column('created', type='int64'),
+        Column('changed', type='int64'),
+        Index(['state']),
+    ],
+    Table('tags_feed', key='id')[
+        Column('id', auto_increment=True),
+        Column('tagspace'),
+        Column('name'),
+        Column('time', type='int64'),
     ]
 ]
 
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+from datetime import datetime, timedelta
+
+from trac.config import IntOption, Option
+from trac.core import Component, implements
+from trac.util.datefmt import to_utimestamp, utc
+from trac.util.presentation import to_json
+
+from tractags.jobs import ITagJobHandler
+
+
+def plan_compaction(rows, window=0, max_changes=0, cutoff=None):
+    """Compute the compacted tag history of a single resource.
+
+    `rows` are `(time, author, oldtags, newtags)` tuples in chronological
+    order.  Consecutive changes by the same author less than `window`
+    microseconds apart are merged into the latest one of them.  Of all
+    changes before `cutoff` only the latest one is kept, and at most
+    `max_changes` of the most recent changes are kept in total.
+
+    Returns the kept rows and the original rows removed.  Every kept row
+    still records the tags after that change, so point-in-time lookups
+    remain correct from the oldest kept change onwards.
+    """
+    kept = []
+    removed = []
+    for row in rows:
+        if window and kept and kept[-1][1] == row[1] and \
+                row[0] - kept[-1][0] < window:
+            previous = kept.pop()
+            removed.append(previous[0])
+            row = (row[0], row[1], previous[2], row[3])
+        kept.append(row)
+    if cutoff is not None:
+        old = len([row for row in kept if row[0] < cutoff])
+        if old > 1:
+            removed.extend(row[0] for row in kept[:old - 1])
+            kept = kept[old - 1:]
+    if max_changes and len(kept) > max_changes:
+        removed.extend(row[0] for row in kept[:-max_changes])
+        kept = kept[-max_changes:]
+    removed = set(removed)
+    return kept, [row for row in rows if row[0] in removed]
+
+
+class TagHistoryCompactor(Component):
+    """[opt] Compacts the tag change history of revisable realms.
+
+    Run it through `trac-admin <env> tags compact`, queue a `compact` job,
+    or call `compact()` repeatedly for incremental batches.
+    """
+
+    implements(ITagJobHandler)
+
+    merge_window = IntOption('tags', 'history_merge_window', 0,
+        """Number of seconds within which consecutive tag changes by the
+        same author are merged by history compaction. Set to 0 to
+        disable.""")
+
+    max_changes = IntOption('tags', 'history_max_changes', 0,
+        """Maximum number of tag changes kept per resource by history
+        compaction. Set to 0 for no limit.""")
+
+    max_age = IntOption('tags', 'history_max_age', 0,
+        """Number of days after which tag changes are dropped by history
+        compaction, except the latest one of each resource. Set to 0 to keep
+        all changes.""")
+
+    archive = Option('tags', 'history_archive', '',
+        """File to append tag changes removed by history compaction to, as
+        JSON lines. Relative paths are resolved against the environment's
+        `files` directory. Leave empty to discard removed changes.""")
+
+    batch_size = IntOption('tags', 'history_batch_size', 100,
+        """Number of resources compacted per database transaction.""")
+
+    # Public methods
+
+    def compact(self, realm=None, start=None, limit=None, window=None,
+                max_changes=None, max_age=None):
+        """Compact the tag history of resources in batches.
+
+        Resources are processed in `(realm, name)` order beginning after
+        the `start` key, at most `limit` of them if given.  Policy arguments
+        default to the configured values.
+
+        Returns a dict of statistics and the key to continue from, which is
+        `None` after the last resource.
+        """
+        if window is None:
+            window = self.merge_window
+        if max_changes is None:
+            max_changes = self.max_changes
+        if max_age is None:
+            max_age = self.max_age
+        cutoff = None
+        if max_age:
+            cutoff = to_utimestamp(datetime.now(utc) -
+                                   timedelta(days=max_age))
+        stats = dict(resources=0, compacted=0, removed=0, archived=0)
+        while limit is None or stats['resources'] < limit:
+            size = self.batch_size
+            if limit is not None:
+                size = min(size, limit - stats['resources'])
+            keys = self._next_resources(realm, start, size)
+            if not keys:
+                return stats, None
+            with self.env.db_transaction as db:
+                archived = []
+                for tagspace, name in keys:
+                    rows = db("""
+                        SELECT time, author, oldtags, newtags
+                        FROM tags_change WHERE tagspace=%s AND name=%s
+                        ORDER BY time
+                        """, (tagspace, name))
+                    original = set(rows)
+                    kept, removed = plan_compaction(rows, window * 1000000,
+                                                    max_changes, cutoff)
+                    if not removed:
+                        continue
+                    db.executemany("""
+                        DELETE FROM tags_change
+                        WHERE tagspace=%s AND name=%s AND time=%s
+                        """, [(tagspace, name, row[0]) for row in removed])
+                    db.executemany("""
+                        UPDATE tags_change SET oldtags=%s
+                        WHERE tagspace=%s AND name=%s AND time=%s
+                        """, [(row[2], tagspace, name, row[0])
+                              for row in kept if row not in original])
+                    stats['compacted'] += 1
+                    stats['removed'] += len(removed)
+                    archived.extend((tagspace, name) + tuple(row)
+                                    for row in removed)
+                # Written before commit, a failure keeps the history intact.
+                if archived and self.archive:
+                    self._archive(archived)
+                    stats['archived'] += len(archived)
+            stats['resources'] += len(keys)
+            start = keys[-1]
+        return stats, start
+
+    # ITagJobHandler methods
+
+    def get_tag_job_kinds(self):
+        return ('compact',)
+
+    def count_tag_job(self, kind, args):
+        sql = "SELECT DISTINCT tagspace, name FROM tags_change"
+        sql_args = []
+        if args.get('realm'):
+            sql += " WHERE tagspace=%s"
+            sql_args.append(args['realm'])
+        for count, in self.env.db_query("""
+                SELECT COUNT(*) FROM (%s) AS s
+                """ % sql, sql_args):
+            return count
+
+    def run_tag_job(self, kind, args, position, size):
+        stats, start = self.compact(args.get('realm'),
+                                    position and tuple(position), size,
+                                    args.get('window'),
+                                    args.get('max_changes'),
+                                    args.get('max_age'))
+        return stats['resources'], start and list(start)
+
+    # Internal methods
+
+    def _next_resources(self, realm, start, size):
+        args = []
+        where = []
+        if realm:
+            where.append("tagspace=%s")
+            args.append(realm)
+        if start:
+            where.append("(tagspace>%s OR tagspace=%s AND name>%s)")
+            args.extend([start[0], start[0], start[1]])
+        return [tuple(row) for row in self.env.db_query("""
+            SELECT DISTINCT tagspace, name FROM tags_change %s
+            ORDER BY tagspace, name LIMIT %d
+            """ % (where and 'WHERE ' + ' AND '.join(where) or '', size),
+            args)]
+
+    def _archive(self, rows):
+        path = os.path.join(self.env.path, 'files', self.archive)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'ab') as f:
+            for tagspace, name, time, author, oldtags, newtags in rows:
+                f.write(to_json(dict(realm=tagspace, id=name, time=time,
+                                     author=author, oldtags=oldtags,
+                                     newtags=newtags)) + '\n')
@@ -0,0 +1,1079 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Mapping, OrderedDict
+from itertools import chain, groupby
+
+from trac.cache import cached
+from trac.config import BoolOption
+from trac.core import Component, implements
+from trac.util.text import exception_to_unicode
+
+from tractags.api import Counter, DefaultTagProvider, ITagChangeListener
+from tractags.api import TagSystem
+from tractags.jobs import ITagJobHandler
+from tractags.metrics import TagMetrics
+from tractags.model import TagPool, changed_resources, feed_cursor
+from tractags.model import resources_tags
+from tractags.util import MockReq, split_into_tags
+
+
+# Marker for "all resources of a realm", saves building the full set
+# for the very common 'realm:<realm>' query term.
+_ALL = object()
+
+
+class _Unindexable(Exception):
+    """Raised for query nodes, that can't be resolved from the index."""
+
+
+class RealmIndex(object):
+    """Inverted tag index for all tagged resources of a single realm.
+
+    Resources are referenced by ordinals, that follow the resource name
+    order of the `tags` table, while resources added by `updated()` are
+    appended.  Posting lists are sorted arrays of these ordinals for each
+    tag, kept as sets too for tags once used in a query.
+    """
+
+    __slots__ = ('realm', 'names', 'tags', 'postings', '_ordinals', '_sets',
+                 '_live')
+
+    def __init__(self, realm):
+        self.realm = realm
+        # Ordinal -> resource ID.
+        self.names = []
+        # Ordinal -> frozenset of resource tags, empty if untagged.
+        self.tags = []
+        # Tag -> sorted array of ordinals.
+        self.postings = {}
+        # Resource ID -> ordinal, built on the first update.
+        self._ordinals = None
+        # Tag -> frozenset of ordinals.
+        self._sets = {}
+        # Frozenset of ordinals of tagged resources.
+        self._live = None
+
+    def add(self, name, tags):
+        """Append a resource, call in resource name order only.
+
+        Tags should be a frozenset, preferably shared by a `TagPool`.
+        """
+        ordinal = len(self.names)
+        self.names.append(name)
+        self.tags.append(tags)
+        for tag in tags:
+            try:
+                self.postings[tag].append(ordinal)
+            except KeyError:
+                self.postings[tag] = array('I', [ordinal])
+
+    def updated(self, tagged):
+        """Return a copy with tags of resources replaced, given as
+        `(name, tags)` pairs with empty tags for untagged resources.
+
+        The index itself is left unchanged for concurrent queries.  The copy
+        only holds the changed resources and posting lists over the data of
+        the index, that may be mapped from a snapshot file.
+        """
+        if self._ordinals is None:
+            if isinstance(self.names, _MappedStrings):
+                # Resource IDs of snapshots are found by bisection.
+                self._ordinals = {}
+            else:
+                self._ordinals = dict((name, i) for i, name
+                                      in enumerate(self.names))
+        index = RealmIndex(self.realm)
+        index.names = _Overlay(self.names)
+        index.tags = _Overlay(self.tags)
+        index.postings = _PostingsOverlay(self.postings)
+        index._ordinals = dict(self._ordinals)
+        index._sets = dict(self._sets)
+        index._live = self._live
+        added = {}
+        removed = {}
+        for name, tags in tagged:
+            tags = tags or frozenset()
+            ordinal = index._find(name)
+            if ordinal is None:
+                if not tags:
+                    continue
+                ordinal = index._ordinals[name] = len(index.names)
+                index.names.append(name)
+                index.tags.append(frozenset())
+            old_tags = index.tags[ordinal]
+            if bool(old_tags) != bool(tags):
+                index._live = None
+            index.tags[ordinal] = tags
+            for tag in old_tags - tags:
+                removed.setdefault(tag, set()).add(ordinal)
+            for tag in tags - old_tags:
+                added.setdefault(tag, set()).add(ordinal)
+        for tag in set(added).union(removed):
+            ordinals = set(index.postings.get(tag, ()))
+            ordinals.difference_update(removed.get(tag, ()))
+            ordinals.update(added.get(tag, ()))
+            if ordinals:
+                index.postings[tag] = array('I', sorted(ordinals))
+            elif tag in index.postings:
+                del index.postings[tag]
+            index._sets.pop(tag, None)
+        return index
+
+    def compacted(self):
+        """Return the index without untagged resources in name order, a
+        copy if it has been updated.
+        """
+        if self._ordinals is None:
+            return self
+        index = RealmIndex(self.realm)
+        for name, ordinal in sorted((name, i) for i, name
+                                    in enumerate(self.names)
+                                    if self.tags[i]):
+            index.add(name, self.tags[ordinal])
+        return index
+
+    def match(self, query):
+        """Return sorted `(name, tags)` pairs matching a tag query.
+
+        Like the row-by-row evaluation in `TagSystem.query()` only resources
+        with at least one of the (not negated) query terms are considered
+        candidates, or all resources, if there is no such term.
+        """
+        def _set(ordinals):
+            if ordinals is _ALL:
+                return self._get_live()
+            return ordinals
+
+        def _eval(node):
+            if not node or node.type in (None, node.NULL):
+                return _ALL
+            elif node.type == node.TERM:
+                return self._get_set(node.value)
+            elif node.type == node.AND:
+                left = _eval(node.left)
+                if not left:
+                    return left
+                right = _eval(node.right)
+                if left is _ALL:
+                    return right
+                if right is _ALL:
+                    return left
+                return left & right
+            elif node.type == node.OR:
+                left = _eval(node.left)
+                if left is _ALL:
+                    return left
+                right = _eval(node.right)
+                if right is _ALL:
+                    return right
+                return left | right
+            elif node.type == node.NOT:
+                left = _eval(node.left)
+                if left is _ALL:
+                    return frozenset()
+                return self._get_live() - left
+            elif node.type == node.ATTR and node.left.value == 'realm':
+                if query.match(node.right, [self.realm]):
+                    return _ALL
+                return frozenset()
+            raise _Unindexable(node.type)
+
+        result = _eval(query)
+        terms = set(query.terms())
+        if terms:
+            candidates = frozenset().union(*[self._get_set(term)
+                                             for term in terms])
+            if result is _ALL:
+                result = candidates
+            else:
+                result &= candidates
+        return sorted((self.names[i], self.tags[i]) for i in _set(result))
+
+    def _get_set(self, tag):
+        try:
+            return self._sets[tag]
+        except KeyError:
+            if tag not in self.postings:
+                return frozenset()
+            ordinals = self._sets[tag] = frozenset(self.postings[tag])
+            return ordinals
+
+    def _get_live(self):
+        if self._live is None:
+            self._live = frozenset(chain.from_iterable(
+                self.postings.itervalues()))
+        return self._live
+
+    def _find(self, name):
+        ordinal = self._ordinals.get(name)
+        if ordinal is None:
+            names = getattr(self.names, 'base', self.names)
+            if isinstance(names, _MappedStrings):
+                ordinal = names.find(name)
+        return ordinal
+
+
+class _Overlay(object):
+    """Sequence of items changed or appended over a base sequence, that is
+    left unchanged.
+    """
+
+    __slots__ = ('base', 'changes', 'length')
+
+    def __init__(self, items):
+        if isinstance(items, _Overlay):
+            self.base = items.base
+            self.changes = dict(items.changes)
+            self.length = items.length
+        else:
+            self.base = items
+            self.changes = {}
+            self.length = len(items)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        try:
+            return self.changes[i]
+        except KeyError:
+            return self.base[i]
+
+    def __setitem__(self, i, value):
+        self.changes[i] = value
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+    def append(self, value):
+        self.changes[self.length] = value
+        self.length += 1
+
+
+class _PostingsOverlay(Mapping):
+    """Posting lists changed over base posting lists, that are left
+    unchanged.  Removed tags are kept as `None`.
+    """
+
+    def __init__(self, postings):
+        if isinstance(postings, _PostingsOverlay):
+            self.base = postings.base
+            self.changes = dict(postings.changes)
+        else:
+            self.base = postings
+            self.changes = {}
+
+    def __getitem__(self, tag):
+        if tag in self.changes:
+            postings = self.changes[tag]
+            if postings is None:
+                raise KeyError(tag)
+            return postings
+        return self.base[tag]
+
+    def __setitem__(self, tag, postings):
+        self.changes[tag] = postings
+
+    def __delitem__(self, tag):
+        self.changes[tag] = None
+
+    def __contains__(self, tag):
+        if tag in self.changes:
+            return self.changes[tag] is not None
+        return tag in self.base
+
+    def __iter__(self):
+        for tag in self.base:
+            if tag not in self.changes:
+                yield tag
+        for tag, postings in self.changes.iteritems():
+            if postings is not None:
+                yield tag
+
+    def __len__(self):
+        return sum(1 for tag in self)
+
+
+# Snapshot file layout: header with the change feed cursor, then for each
+# realm its name, resource IDs and tag names as string tables, the posting
+# lists of tags and the tags of resources as offset and value arrays.  All
+# integers are little-endian, strings are UTF-8 encoded.
+SNAPSHOT_MAGIC = 'TRACTAGS'
+SNAPSHOT_VERSION = 3
+
+_HEADER = struct.Struct('<8sIqI')
+_UINT = struct.Struct('<I')
+
+
+class _MappedArray(object):
+    """Read-only array of unsigned integers in a snapshot buffer."""
+
+    __slots__ = ('buf', 'pos', 'length')
+
+    def __init__(self, buf, pos, length):
+        self.buf = buf
+        self.pos = pos
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return _UINT.unpack_from(self.buf, self.pos + i * 4)[0]
+
+    def slice(self, start, stop):
+        """Return a copy of the values from `start` to `stop`."""
+        values = array('I')
+        values.fromstring(self.buf[self.pos + start * 4:self.pos + stop * 4])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+
+class _MappedStrings(object):
+    """Read-only sequence of strings in a snapshot buffer, decoded on
+    access.
+    """
+
+    __slots__ = ('buf', 'pos', 'offsets')
+
+    def __init__(self, buf, pos, offsets):
+        self.buf = buf
+        self.pos = pos
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.buf[self.pos + self.offsets[i]:
+                        self.pos + self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def find(self, s):
+        """Return the position of a string, if sorted, or `None`."""
+        i = bisect_left(self, s)
+        if i < len(self) and self[i] == s:
+            return i
+
+
+class _MappedTags(object):
+    """Read-only sequence of resource tags in a snapshot buffer."""
+
+    __slots__ = ('tags', 'offsets', 'values')
+
+    def __init__(self, tags, offsets, values):
+        self.tags = tags
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return frozenset(self.tags[j] for j in
+                         self.values.slice(self.offsets[i],
+                                           self.offsets[i + 1]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class _MappedPostings(Mapping):
+    """Read-only posting lists of tags in a snapshot buffer, copied on
+    access.
+    """
+
+    def __init__(self, tags, offsets, ordinals):
+        self.tags = tags
+        self.offsets = offsets
+        self.ordinals = ordinals
+
+    def __getitem__(self, tag):
+        j = self.tags.find(tag)
+        if j is None:
+            raise KeyError(tag)
+        return self.ordinals.slice(self.offsets[j], self.offsets[j + 1])
+
+    def __contains__(self, tag):
+        return self.tags.find(tag) is not None
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    def __len__(self):
+        return len(self.tags)
+
+
+def _pack_array(values):
+    values = array('I', values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return _UINT.pack(len(values)) + values.tostring()
+
+
+def _pack_strings(strings):
+    blobs = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return _pack_array(offsets) + ''.join(blobs)
+
+
+def _read_array(buf, pos):
+    length = _UINT.unpack_from(buf, pos)[0]
+    pos += _UINT.size
+    return _MappedArray(buf, pos, length), pos + length * 4
+
+
+def _read_strings(buf, pos):
+    offsets, pos = _read_array(buf, pos)
+    if not len(offsets):
+        raise ValueError("Invalid string table at %d" % pos)
+    return _MappedStrings(buf, pos, offsets), pos + offsets[len(offsets) - 1]
+
+
+def write_snapshot(path, cursor, indexes):
+    """Write realm indexes to a snapshot file, replacing it atomically."""
+    chunks = [_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, cursor,
+                           len(indexes))]
+    for realm, index in sorted(indexes.iteritems()):
+        index = index.compacted()
+        tags = sorted(index.postings)
+        positions = dict((tag, j) for j, tag in enumerate(tags))
+        offsets = [0]
+        ordinals = array('I')
+        for tag in tags:
+            ordinals.extend(index.postings[tag])
+            offsets.append(len(ordinals))
+        tag_offsets = [0]
+        tag_values = array('I')
+        for resource_tags in index.tags:
+            tag_values.extend(sorted(positions[tag]
+                                     for tag in resource_tags))
+            tag_offsets.append(len(tag_values))
+        chunks.extend([_pack_strings([realm]), _pack_strings(index.names),
+                       _pack_strings(tags), _pack_array(offsets),
+                       _pack_array(ordinals), _pack_array(tag_offsets),
+                       _pack_array(tag_values)])
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.writelines(chunks)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def read_snapshot(path):
+    """Map realm indexes of a snapshot file into memory.
+
+    Resource IDs, tags and posting lists are read from the file on access,
+    so processes share them through the page cache instead of holding a
+    copy each.  Returns a `(cursor, indexes)` tuple, with `indexes` being
+    `None` for snapshots of other format versions.
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, cursor, count = _HEADER.unpack_from(buf, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a tag index snapshot: %s" % path)
+    if version != SNAPSHOT_VERSION:
+        return cursor, None
+    pos = _HEADER.size
+    indexes = {}
+    for i in xrange(count):
+        realm, pos = _read_strings(buf, pos)
+        names, pos = _read_strings(buf, pos)
+        tags, pos = _read_strings(buf, pos)
+        offsets, pos = _read_array(buf, pos)
+        ordinals, pos = _read_array(buf, pos)
+        tag_offsets, pos = _read_array(buf, pos)
+        tag_values, pos = _read_array(buf, pos)
+        if len(offsets) != len(tags) + 1 or \
+                len(tag_offsets) != len(names) + 1:
+            raise ValueError("Invalid tag index snapshot: %s" % path)
+        index = indexes[realm[0]] = RealmIndex(realm[0])
+        index.names = names
+        index.tags = _MappedTags(tags, tag_offsets, tag_values)
+        index.postings = _MappedPostings(tags, offsets, ordinals)
+    if pos != len(buf):
+        raise ValueError("Truncated tag index snapshot: %s" % path)
+    return cursor, indexes
+
+
+class TagIndex(Component):
+    """[extra] In-memory inverted tag index for fast tag queries.
+
+    Tag queries for realms of tag providers based on the `tags` db table
+    are resolved by set operations on per-tag posting lists instead of
+    evaluating the query against each tagged resource.  The index is built
+    from the `tags` db table once per process and updated by the changed
+    resources of the change feed.  A queued `index_rebuild` job refreshes
+    the snapshot file outside of request threads.
+    """
+
+    implements(ITagChangeListener, ITagJobHandler)
+
+    enabled = BoolOption('tags', 'query_index', False,
+        doc="Whether to resolve tag queries from an in-memory tag index.")
+    snapshot = BoolOption('tags', 'query_index_snapshot', False,
+        doc="""Whether to share the tag index between processes through a
+            snapshot file in the environment's `files` directory.  Processes
+            map the snapshot into memory and keep only later changes of
+            their own, instead of building the index from the database.""")
+
+    # Maximum number of changes applied to the index, instead of building
+    # it again.
+    max_changes = 1000
+
+    def __init__(self):
+        # Change feed cursor and realm indexes last read by the process.
+        self._loaded = None
+
+    # Public methods
+
+    def query(self, realm, query):
+        """Return sorted `(name, tags)` pairs of `realm` matching a query.
+
+        Returns `None`, if the query can't be resolved from the index, i.e.
+        because of attributes other than 'realm'.
+        """
+        TagMetrics(self.env).count('cache.tag_index.lookup')
+        index = self._realm_indexes.get(realm)
+        if index is None:
+            return []
+        try:
+            return index.match(query)
+        except _Unindexable:
+            return None
+
+    # ITagChangeListener methods
+
+    def tags_changed(self, realm, names=None):
+        # Invalidate even if disabled, or an index from before would be used
+        # without the change after enabling the index again.
+        del self._realm_indexes
+
+    # ITagJobHandler methods
+
+    def get_tag_job_kinds(self):
+        return ('index_rebuild',)
+
+    def count_tag_job(self, kind, args):
+        return 1
+
+    def run_tag_job(self, kind, args, position, size):
+        cursor = feed_cursor(self.env)
+        indexes = self._build_indexes()
+        self._write_snapshot(cursor, indexes)
+        self._loaded = cursor, indexes
+        del self._realm_indexes
+        return 1, None
+
+    # Internal methods
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.env.path, 'files', 'tags-index.snapshot')
+
+    @cached
+    def _realm_indexes(self):
+        TagMetrics(self.env).count('cache.tag_index.miss')
+        changed = None
+        if self._loaded is not None:
+            cursor, indexes = self._loaded
+            changed, cursor = changed_resources(self.env, cursor,
+                                                self.max_changes)
+        elif self.snapshot and os.path.isfile(self.snapshot_path):
+            try:
+                cursor, indexes = read_snapshot(self.snapshot_path)
+            except (EnvironmentError, ValueError, struct.error), e:
+                self.log.warning("Can't read tag index snapshot: %s",
+                                 exception_to_unicode(e))
+            else:
+                if indexes is not None:
+                    self.log.debug("Loaded tag index snapshot %s",
+                                   self.snapshot_path)
+                    changed, cursor = changed_resources(self.env, cursor,
+                                                        self.max_changes)
+        if changed is None:
+            cursor = feed_cursor(self.env)
+            indexes = self._build_indexes()
+            self._write_snapshot(cursor, indexes)
+        elif changed:
+            indexes = dict(indexes)
+            for realm, names in changed.iteritems():
+                if names is None:
+                    index = self._build_indexes(realm).get(realm)
+                else:
+                    tags = resources_tags(self.env, realm, names)
+                    index = indexes.get(realm, RealmIndex(realm)).updated(
+                        [(name, frozenset(tags.get(name, ())))
+                         for name in names])
+                if index is None:
+                    indexes.pop(realm, None)
+                else:
+                    indexes[realm] = index
+        self._loaded = cursor, indexes
+        return indexes
+
+    def _write_snapshot(self, cursor, indexes):
+        if self.snapshot:
+            try:
+                write_snapshot(self.snapshot_path, cursor, indexes)
+            except EnvironmentError, e:
+                self.log.warning("Can't write tag index snapshot: %s",
+                                 exception_to_unicode(e))
+
+    def _build_indexes(self, realm=None):
+        """Build per-realm inverted indexes from the tags db table."""
+        indexes = {}
+        sql = "SELECT tagspace, name, tag FROM tags"
+        args = []
+        if realm is not None:
+            sql += " WHERE tagspace=%s"
+            args.append(realm)
+        rows = self.env.db_query(sql + " ORDER BY tagspace, name", args)
+        pool = TagPool()
+        for realm, realm_rows in groupby(rows, lambda row: row[0]):
+            index = indexes[realm] = RealmIndex(realm)
+            for name, name_rows in groupby(realm_rows, lambda row: row[1]):
+                index.add(name, pool([row[2] for row in name_rows]))
+        return indexes
+
+
+class CompletionIndex(object):
+    """Tag completion index over tags and their frequencies.
+
+    Tags are kept in a case-insensitively sorted array for prefix matches
+    by bisection, and in an n-gram index for substring matches.  Matches
+    are ranked by frequency, then by name.
+    """
+
+    __slots__ = ('tags', 'keys', 'counts', 'ranks', 'ranked', 'grams',
+                 'max_count')
+
+    # Maximum length of indexed substrings.
+    gram_size = 3
+
+    def __init__(self, counts):
+        items = sorted(counts.iteritems(), key=lambda t: (t[0].lower(), t[0]))
+        self.tags = [tag for tag, count in items]
+        self.keys = [tag.lower() for tag in self.tags]
+        self.counts = array('I', [count for tag, count in items])
+        # Position of tags in order of decreasing frequency and vice versa.
+        self.ranked = array('I', sorted(xrange(len(items)),
+                                        key=lambda i: (-self.counts[i],
+                                                       self.tags[i])))
+        self.ranks = array('I', [0] * len(items))
+        for rank, i in enumerate(self.ranked):
+            self.ranks[i] = rank
+        self.max_count = self.ranked and self.counts[self.ranked[0]] or 0
+        self.grams = {}
+        for i, key in enumerate(self.keys):
+            for gram in self._grams(key, all_sizes=True):
+                postings = self.grams.setdefault(gram, array('I'))
+                if not postings or postings[-1] != i:
+                    postings.append(i)
+
+    def complete(self, term, limit=None, contains=False):
+        """Return `(tag, count)` pairs for the best matches of a term."""
+        term = term.lower()
+        if not term:
+            candidates = None
+        elif contains:
+            candidates = None
+            for gram in self._grams(term):
+                postings = self.grams.get(gram, ())
+                if candidates is None:
+                    candidates = set(postings)
+                else:
+                    candidates.intersection_update(postings)
+                if not candidates:
+                    return []
+            if len(term) > self.gram_size:
+                candidates = [i for i in candidates if term in self.keys[i]]
+        else:
+            start = bisect_left(self.keys, term)
+            candidates = xrange(start,
+                                bisect_left(self.keys, term + u'\uffff',
+                                            start))
+        if candidates is None:
+            ranked = self.ranked[:limit]
+        elif limit is None:
+            ranked = sorted(candidates, key=self.ranks.__getitem__)
+        else:
+            ranked = heapq.nsmallest(limit, candidates,
+                                     key=self.ranks.__getitem__)
+        return [(self.tags[i], self.counts[i]) for i in ranked]
+
+    def count(self, tag):
+        """Return the frequency of a tag, or 0 for unknown tags."""
+        key = tag.lower()
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.tags[i] == tag:
+                return self.counts[i]
+            i += 1
+        return 0
+
+    def _grams(self, key, all_sizes=False):
+        size = min(len(key), self.gram_size)
+        sizes = all_sizes and range(1, size + 1) or [size]
+        for n in sizes:
+            for i in xrange(len(key) - n + 1):
+                yield key[i:i + n]
+
+
+class CompletionData(object):
+    """Precomputed data for scoring tag suggestions.
+
+    Holds resource tags, tag frequencies and co-occurrence counts of tags
+    db table based realms, and lazily built completion indexes for
+    combinations of realms as well as recently used tags of authors.
+    Changes are applied to a `copy()`, while other threads may still use
+    the original.
+    """
+
+    __slots__ = ('realm_tags', 'realm_counts', 'realm_pairs', 'indexes',
+                 'related', 'recent')
+
+    def __init__(self):
+        self.realm_tags = {}
+        self.realm_counts = {}
+        self.realm_pairs = {}
+        self.indexes = {}
+        self.related = {}
+        self.recent = OrderedDict()
+
+    def add_realm(self, realm, tagged):
+        """Add a realm with `(name, tags)` pairs of its tagged resources."""
+        self.realm_tags[realm] = {}
+        self.realm_counts[realm] = Counter()
+        self.realm_pairs[realm] = {}
+        self.update(realm, tagged)
+
+    def remove_realm(self, realm):
+        for realms in (self.realm_tags, self.realm_counts, self.realm_pairs):
+            realms.pop(realm, None)
+
+    def copy(self, realms):
+        """Return a copy for changing the data of `realms`.
+
+        Derived data of these realms and recently used tags are dropped.
+        """
+        data = CompletionData()
+        data.realm_tags = dict(self.realm_tags)
+        data.realm_counts = dict(self.realm_counts)
+        data.realm_pairs = dict(self.realm_pairs)
+        for realm in set(realms).intersection(self.realm_tags):
+            data.realm_tags[realm] = dict(self.realm_tags[realm])
+            data.realm_counts[realm] = Counter(self.realm_counts[realm])
+            data.realm_pairs[realm] = dict(self.realm_pairs[realm])
+        data.indexes = dict((key, index) for key, index
+                            in self.indexes.iteritems()
+                            if key.isdisjoint(realms))
+        data.related = dict((key, related) for key, related
+                            in self.related.iteritems()
+                            if key[0] not in realms)
+        return data
+
+    def update(self, realm, tagged):
+        """Replace tags of resources of a realm, given as `(name, tags)`
+        pairs with empty tags for untagged resources.
+
+        Only rows of co-occurrence counts of tags of these resources are
+        copied and changed.
+        """
+        resource_tags = self.realm_tags[realm]
+        counts = self.realm_counts[realm]
+        pairs = self.realm_pairs[realm]
+        copied = set()
+
+        def _count(tags, delta):
+            for tag in tags:
+                count = counts.get(tag, 0) + delta
+                if count:
+                    counts[tag] = count
+                else:
+                    del counts[tag]
+                if tag in copied:
+                    row = pairs.setdefault(tag, {})
+                else:
+                    row = pairs[tag] = dict(pairs.get(tag, ()))
+                    copied.add(tag)
+                for other in tags:
+                    if other != tag:
+                        count = row.get(other, 0) + delta
+                        if count:
+                            row[other] = count
+                        else:
+                            del row[other]
+                if not row:
+                    del pairs[tag]
+
+        for name, tags in tagged:
+            _count(resource_tags.pop(name, ()), -1)
+            if tags:
+                resource_tags[name] = tags
+                _count(tags, 1)
+
+    def get_related(self, realm, tag):
+        """Return `(tag, count)` pairs of tags used together with a tag
+        on resources of a realm, most frequent first.
+        """
+        try:
+            return self.related[realm, tag]
+        except KeyError:
+            row = self.realm_pairs[realm].get(tag, {})
+            related = self.related[realm, tag] = \
+                sorted(row.iteritems(), key=lambda t: (-t[1], t[0]))
+            return related
+
+
+class TagCompletionIndex(Component):
+    """[opt] Server-side index for tag input completion.
+
+    Provides prefix and substring matches over all tags of permitted
+    realms, updated by the changed resources of the change feed.
+    Suggestions are ranked by a score combining tag frequency, recent use
+    by the current user and co-occurrence with tags already entered.
+
+    Tag counts are taken without checking permissions on single resources.
+    """
+
+    implements(ITagChangeListener)
+
+    # Maximum number of changes applied to the completion data, instead of
+    # reading all tags again.
+    max_changes = 1000
+
+    # Relative weights of score components, each ranging from 0 to 1.
+    frequency_weight = 1.0
+    recency_weight = 1.0
+    cooccurrence_weight = 2.0
+
+    # Number of most recent tag changes of an author to consider.
+    recent_changes = 50
+
+    # Number of authors, whose recent tag changes are kept in memory.
+    recent_authors = 100
+
+    def __init__(self):
+        # Change feed cursor and completion data last read by the process.
+        self._loaded = None
+        self._recent_lock = threading.Lock()
+
+    # Public methods
+
+    def complete(self, req, term, limit=None, contains=False):
+        """Return `(tag, count)` pairs for the best matches of a term.
+
+        Only tags from realms with view permission are considered.
+        """
+        return self._get_index(req, self._data)[1].complete(term, limit,
+                                                            contains)
+
+    def get_all_tags(self, req):
+        """Return all tags of permitted realms sorted case-insensitively."""
+        return self._get_index(req, self._data)[1].tags
+
+    def get_related(self, realm, tag):
+        """Return `(tag, count)` pairs of tags used together with a tag in
+        a realm, most frequent first, or `None` for realms not covered.
+
+        Resources are counted regardless of permissions, so with
+        fine-grained permission policies `TagSystem.get_related_tags()`
+        counts viewable resources instead.
+        """
+        data = self._data
+        if realm in data.realm_pairs:
+            return data.get_related(realm, tag)
+
+    def suggest(self, req, term, limit=None, contains=False, context=()):
+        """Return tags matching the term, best suggestions first.
+
+        Tags in `context`, usually the tags already entered, are not
+        suggested again, but tags often used together with them rank
+        higher.  Only a bounded number of candidates gets scored, so the
+        cost does not depend on the number of tags.
+        """
+        data = self._data
+        realms, index = self._get_index(req, data)
+        context = set(context)
+        if limit is None:
+            limit = len(index.tags)
+        term = term.lower()
+        if contains:
+            matches = lambda key: term in key
+        else:
+            matches = lambda key: key.startswith(term)
+
+        # Boosted tags may rank higher than more frequent tags.
+        recent = self._get_recent_tags(req.authname, realms, data)
+        related = {}
+        for tag in context:
+            count = index.count(tag)
+            if not count:
+                continue
+            for realm in realms.intersection(data.realm_pairs):
+                for other, pairs in data.get_related(realm, tag)[:limit]:
+                    related[other] = related.get(other, 0) + \
+                                     float(pairs) / count / len(context)
+
+        # Unboosted tags beyond the most frequent matches rank lower anyway.
+        candidates = dict(index.complete(term, limit + len(context),
+                                         contains))
+        for tag in set(recent).union(related):
+            if tag not in candidates and matches(tag.lower()):
+                count = index.count(tag)
+                if count:
+                    candidates[tag] = count
+        max_count = index.max_count
+
+        def score(tag):
+            frequency = math.log1p(candidates[tag]) / math.log1p(max_count)
+            return self.frequency_weight * frequency + \
+                   self.recency_weight * recent.get(tag, 0) + \
+                   self.cooccurrence_weight * related.get(tag, 0)
+        ranked = sorted(((-score(tag), tag) for tag in candidates
+                         if tag not in context))
+        return [tag for score, tag in ranked[:limit]]
+
+    # ITagChangeListener methods
+
+    def tags_changed(self, realm, names=None):
+        del self._data
+
+    # Internal methods
+
+    def _get_index(self, req, data):
+        tag_system = TagSystem(self.env)
+        realms = frozenset(tag_system.get_taggable_realms(req.perm))
+        # Other tag providers may depend on the request or not tell about
+        # changes, so their tags are never cached.
+        uncached = realms.difference(data.realm_counts)
+        if uncached:
+            counts = tag_system.get_all_tags(req, uncached)
+            for realm in realms.intersection(data.realm_counts):
+                counts.update(data.realm_counts[realm])
+            return realms, CompletionIndex(counts)
+        try:
+            return realms, data.indexes[realms]
+        except KeyError:
+            counts = Counter()
+            for realm in realms:
+                counts.update(data.realm_counts[realm])
+            index = data.indexes[realms] = CompletionIndex(counts)
+            return realms, index
+
+    def _get_recent_tags(self, author, realms, data):
+        """Return tags recently added by an author with a recency score."""
+        if author == 'anonymous':
+            return {}
+        with self._recent_lock:
+            changes = data.recent.pop(author, None)
+        if changes is None:
+            changes = []
+            for realm, oldtags, newtags in self.env.db_query("""
+                    SELECT tagspace, oldtags, newtags FROM tags_change
+                    WHERE author=%s ORDER BY time DESC LIMIT %s
+                    """, (author, self.recent_changes)):
+                added = split_into_tags(newtags or '') - \
+                        split_into_tags(oldtags or '')
+                changes.append((realm, added))
+        # Keep the most recently active authors only.
+        with self._recent_lock:
+            data.recent[author] = changes
+            while len(data.recent) > self.recent_authors:
+                data.recent.popitem(last=False)
+        recent = {}
+        for age, (realm, added) in enumerate(changes):
+            if realm in realms:
+                for tag in added:
+                    if tag not in recent:
+                        recent[tag] = 1 - float(age) / self.recent_changes
+        return recent
+
+    @cached
+    def _data(self):
+        """Tag frequencies and co-occurrences of tags db table based realms
+        without permission checks.
+
+        Resources changed since the last read in this process are updated
+        by their entries in the change feed.
+        """
+        providers = dict((provider.get_taggable_realm(), provider)
+                         for provider in TagSystem(self.env).tag_providers
+                         if isinstance(provider, DefaultTagProvider))
+        changed = None
+        if self._loaded is not None:
+            cursor, data = self._loaded
+            changed, cursor = changed_resources(self.env, cursor,
+                                                self.max_changes)
+        if changed is None:
+            cursor = feed_cursor(self.env)
+            data = CompletionData()
+            changed = dict.fromkeys(providers)
+        else:
+            # Realms of tag providers enabled meanwhile are read entirely.
+            changed.update(dict.fromkeys(set(providers)
+                                         .difference(data.realm_tags)))
+            for realm in set(data.realm_tags).difference(providers):
+                changed[realm] = ()
+            if not changed:
+                self._loaded = cursor, data
+                return data
+            data = data.copy(changed)
+        req = MockReq()
+        for realm, names in changed.iteritems():
+            provider = providers.get(realm)
+            if provider is None:
+                data.remove_realm(realm)
+            elif names is None:
+                data.add_realm(realm, [(resource.id, tags) for resource, tags
+                                       in provider.get_tagged_resources(req)
+                                       or ()])
+            elif realm in data.realm_tags:
+                # Skip resources, that the provider doesn't list.
+                tagged = dict((record.id, record.tags) for record
+                              in provider.filter_tagged_resources(req, [
+                                  (name, frozenset(tags)) for name, tags
+                                  in resources_tags(self.env, realm,
+                                                    names).iteritems()]))
+                data.update(realm, [(name, tagged.get(name))
+                                    for name in names])
+        self._loaded = cursor, data
+        return data
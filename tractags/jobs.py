@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+from datetime import datetime
+
+from trac.config import IntOption
+from trac.core import Component, ExtensionPoint, Interface, TracError
+from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
+from trac.util.presentation import to_json
+from trac.util.text import exception_to_unicode
+
+from tractags.api import _
+
+
+class ITagJobHandler(Interface):
+    """Extension point interface for components running tag maintenance
+    jobs in resumable batches, queued with `TagJobQueue`.
+    """
+
+    def get_tag_job_kinds():
+        """Return the names of the job kinds handled by the component."""
+
+    def count_tag_job(kind, args):
+        """Return the number of items a job will process, or `None` if it
+        is not known in advance.
+        """
+
+    def run_tag_job(kind, args, position, size):
+        """Process the next batch of at most `size` items of a job.
+
+        `position` is `None` for the first batch, and the value returned by
+        the previous batch otherwise.  Returns the number of items processed
+        and the JSON serializable position to continue from, or `None` after
+        the last batch.
+        """
+
+
+class TagJobQueue(Component):
+    """[opt] Persistent queue for long running tag maintenance jobs.
+
+    Jobs are processed in batches by `trac-admin <env> tags job run`, i.e.
+    from a cron job, never by a request thread.  Each batch is committed
+    together with the position to resume from, so an interrupted runner
+    just continues with the next batch.  Run a single runner at a time.
+    """
+
+    handlers = ExtensionPoint(ITagJobHandler)
+
+    batch_size = IntOption('tags', 'job_batch_size', 100,
+        """Number of items processed per batch of a tag maintenance job.""")
+
+    # Public methods
+
+    def get_job_kinds(self):
+        """Return a sorted list of job kinds of all handlers."""
+        return sorted(kind for handler in self.handlers
+                           for kind in handler.get_tag_job_kinds())
+
+    def enqueue(self, kind, args=None, author='anonymous', unique=False):
+        """Queue a job and return its id.
+
+        An identical job still pending is reused instead, or with `unique`
+        any pending or running job of the same kind.
+        """
+        args = args or {}
+        handler = self._get_handler(kind)
+        if handler is None:
+            raise TracError(_("Unknown tag job '%(kind)s'", kind=kind))
+        total = handler.count_tag_job(kind, args)
+        now = to_utimestamp(datetime.now(utc))
+        with self.env.db_transaction as db:
+            id = self._find_job(kind, args, unique)
+            if id is not None:
+                return id
+            cursor = db.cursor()
+            if unique:
+                # Processes may queue the job concurrently, so only insert
+                # it if there is none right then.
+                cursor.execute("""
+                    INSERT INTO tags_job
+                     (kind, args, state, done, total, author, created,
+                      changed)
+                    SELECT %s,%s,'pending',0,%s,%s,%s,%s
+                    FROM (SELECT COUNT(*) AS jobs FROM tags_job
+                          WHERE kind=%s AND state IN ('pending','running'))
+                         AS queued
+                    WHERE jobs=0
+                    """, (kind, to_json(args), total, author, now, now,
+                          kind))
+                if not cursor.rowcount:
+                    return self._find_job(kind, args, unique)
+            else:
+                cursor.execute("""
+                    INSERT INTO tags_job
+                     (kind, args, state, done, total, author, created,
+                      changed)
+                    VALUES (%s,%s,'pending',0,%s,%s,%s,%s)
+                    """, (kind, to_json(args), total, author, now, now))
+            id = db.get_last_id(cursor, 'tags_job')
+        self.log.info("Queued tag job #%s '%s'", id, kind)
+        return id
+
+    def get_jobs(self, states=None):
+        """Return jobs as dicts, the oldest first."""
+        args = []
+        sql = """
+            SELECT id, kind, args, state, position, done, total, message,
+                   author, created, changed
+            FROM tags_job"""
+        if states:
+            sql += " WHERE state IN (%s)" % ','.join(['%s'] * len(states))
+            args += states
+        sql += " ORDER BY id"
+        return [self._make_job(row) for row in self.env.db_query(sql, args)]
+
+    def get_job(self, id):
+        for job in self.get_jobs():
+            if job['id'] == id:
+                return job
+
+    def cancel(self, id):
+        """Cancel a pending job.  Returns whether the job was pending."""
+        job = self.get_job(id)
+        if job is None or job['state'] != 'pending':
+            return False
+        job['state'] = 'cancelled'
+        with self.env.db_transaction as db:
+            self._save_job(db, job)
+        return True
+
+    def prune(self, before):
+        """Delete finished, failed and cancelled jobs last changed before a
+        datetime.  Returns the number of deleted jobs.
+        """
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                DELETE FROM tags_job
+                WHERE state IN ('done','failed','cancelled') AND changed < %s
+                """, (to_utimestamp(before),))
+            return cursor.rowcount
+
+    def run_batch(self):
+        """Run the next batch of the oldest pending job.
+
+        Returns the updated job, or `None` if no job is pending.  A failing
+        batch is rolled back and marks the job as failed.
+        """
+        jobs = self.get_jobs(['pending'])
+        if not jobs:
+            return None
+        job = jobs[0]
+        kind = job['kind']
+        handler = self._get_handler(kind)
+        try:
+            if handler is None:
+                raise TracError(_("Unknown tag job '%(kind)s'", kind=kind))
+            with self.env.db_transaction as db:
+                done, position = handler.run_tag_job(kind, job['args'],
+                                                     job['position'],
+                                                     self.batch_size)
+                job['done'] += done
+                job['position'] = position
+                if position is None:
+                    job['state'] = 'done'
+                self._save_job(db, job)
+        except Exception, e:
+            self.log.error("Tag job #%s '%s' failed: %s", job['id'], kind,
+                           exception_to_unicode(e, traceback=True))
+            job['state'] = 'failed'
+            job['message'] = exception_to_unicode(e)
+            with self.env.db_transaction as db:
+                self._save_job(db, job)
+        return job
+
+    # Internal methods
+
+    def _find_job(self, kind, args, unique):
+        for job in self.get_jobs(unique and ['pending', 'running'] or
+                                 ['pending']):
+            if job['kind'] == kind and (unique or job['args'] == args):
+                return job['id']
+
+    def _get_handler(self, kind):
+        for handler in self.handlers:
+            if kind in handler.get_tag_job_kinds():
+                return handler
+
+    def _make_job(self, row):
+        (id, kind, args, state, position, done, total, message, author,
+         created, changed) = row
+        return dict(id=id, kind=kind, args=json.loads(args), state=state,
+                    position=json.loads(position) if position else None,
+                    done=done, total=total, message=message, author=author,
+                    created=from_utimestamp(created),
+                    changed=from_utimestamp(changed))
+
+    def _save_job(self, db, job):
+        job['changed'] = datetime.now(utc)
+        position = job['position']
+        db("""
+            UPDATE tags_job
+            SET state=%s, position=%s, done=%s, message=%s, changed=%s
+            WHERE id=%s
+            """, (job['state'],
+                  to_json(position) if position is not None else None,
+                  job['done'], job['message'],
+                  to_utimestamp(job['changed']), job['id']))
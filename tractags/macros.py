@@ -9,6 +9,7 @@
 # you should have received as part of this distribution.
 #
 
+import heapq
 import re
 
 from fnmatch import fnmatchcase
@@ -92,12 +93,17 @@ class TagWikiMacros(TagTemplateProvider):
     Usage:
 
     {{{
-    [[TagCloud(<query>[,caseless_sort=<bool>][,mincount=<n>])]]
+    [[TagCloud(<query>[,caseless_sort=<bool>][,mincount=<n>][,limit=<n>][,related=<tag>])]]
     }}}
     caseless_sort::
       Whether the tag cloud should be sorted case-sensitive.
     mincount::
       Optional integer threshold to hide tags with smaller count.
+    limit::
+      Optional maximum number of tags to show, most frequent ones first.
+    related::
+      Show tags used together with the given tag instead, sized by the
+      number of resources having both tags.
 
     See tags documentation for the query syntax.
     """)
@@ -166,18 +172,25 @@ class TagWikiMacros(TagTemplateProvider):
             # Set implicit 'all tagged realms' as default.
             if not realms:
                 realms = all_realms
-            if query:
+            mincount = as_int(kw.get('mincount'), None)
+            limit = as_int(kw.get('limit'), None)
+            if 'related' in kw:
+                all_tags = dict(tag_system.get_related_tags(req, kw['related'],
+                                                            realms=realms))
+            elif query:
                 all_tags = Counter()
                 # Require per resource query including view permission checks.
-                for resource, tags in tag_system.query(req, query):
-                    all_tags.update(tags)
+                for tagged in tag_system.query_tagged(req, query):
+                    all_tags.update(tagged.tags)
             else:
                 # Allow faster per tag query, side steps permission checks.
-                all_tags = tag_system.get_all_tags(req, realms=realms)
-            mincount = 'mincount' in kw and kw['mincount'] or None
+                all_tags = tag_system.get_all_tags(req, realms=realms,
+                                                   mincount=mincount,
+                                                   limit=limit)
             return self.render_cloud(req, all_tags,
                                      caseless_sort=self.caseless_sort,
-                                     mincount=mincount, realms=realms)
+                                     mincount=mincount, realms=realms,
+                                     limit=limit)
         elif name == 'ListTagged':
             if content and _OBSOLETE_ARGS_RE.search(content):
                 data = {'warning': 'obsolete_args'}
@@ -194,14 +207,14 @@ class TagWikiMacros(TagTemplateProvider):
                     return ''
             query = '(%s) (%s)' % (query or '', ' or '.join(['realm:%s' % (r)
                                                              for r in realms]))
-            query_result = tag_system.query(req, query)
+            # Resources are created for the displayed page of results only.
+            query_result = tag_system.query_tagged(req, query)
             excludes = [exc.strip()
                         for exc in kw.get('exclude', '' ).split(':')
                         if exc.strip()]
             if excludes and query_result:
-                filtered_result = [(resource, tags)
-                                   for resource, tags in query_result
-                                   if not any(fnmatchcase(resource.id, exc)
+                filtered_result = [tagged for tagged in query_result
+                                   if not any(fnmatchcase(tagged.id, exc)
                                               for exc in excludes)]
                 query_result = filtered_result
             if not query_result:
@@ -242,7 +255,7 @@ class TagWikiMacros(TagTemplateProvider):
 
             try:
                 results = sorted(query_result, key=lambda r:
-                                 embedded_numbers(to_unicode(r[0].id)))
+                                 embedded_numbers(to_unicode(r.id)))
             except (InvalidQuery, InvalidTagRealm), e:
                 return system_message(_("ListTagged macro error"), e)
             results = self._paginate(req, results, realms)
@@ -314,7 +327,7 @@ class TagWikiMacros(TagTemplateProvider):
                         listtagged_page=page, **kwargs)
 
     def render_cloud(self, req, cloud, renderer=None, caseless_sort=False,
-                     mincount=None, realms=()):
+                     mincount=None, realms=(), limit=None):
         """Render a tag cloud.
 
         :cloud: Dictionary of {object: count} representing the cloud.
@@ -323,6 +336,7 @@ class TagWikiMacros(TagTemplateProvider):
         :param caseless_sort: Boolean, whether tag cloud should be sorted
                               case-sensitive.
         :param mincount: Integer threshold to hide tags with smaller count.
+        :param limit: Integer maximum number of most frequent tags to show.
         """
         min_px = 10.0
         max_px = 30.0
@@ -336,24 +350,28 @@ class TagWikiMacros(TagTemplateProvider):
                                  % int(min_px + percent * (max_px - min_px)))
             renderer = default_renderer
 
-        # A LUT from count to n/len(cloud)
+        # Drop tags with too low count before sorting.
+        mincount = as_int(mincount, 1)
+        items = [(tag, count) for tag, count in cloud.iteritems()
+                 if count >= mincount]
+        if limit and len(items) > limit:
+            items = heapq.nsmallest(limit, items, key=lambda t: (-t[1], t[0]))
+
+        # A LUT from count to n/len(cloud), over only few distinct counts.
         size_lut = dict([(c, float(i)) for i, c in
-                         enumerate(sorted(set([r for r in cloud.values()])))])
+                         enumerate(sorted(set([r for t, r in items])))])
         if size_lut:
             scale = 1.0 / len(size_lut)
 
         if caseless_sort:
             # Preserve upper-case precedence within similar tags.
-            items = reversed(sorted(cloud.iteritems(),
-                                    key=lambda t: t[0].lower(), reverse=True))
+            items = reversed(sorted(items, key=lambda t: t[0].lower(),
+                                    reverse=True))
         else:
-            items = sorted(cloud.iteritems())
+            items = sorted(items)
         ul = li = None
-        for i, (tag, count) in enumerate(items):
+        for tag, count in items:
             percent = size_lut[count] * scale
-            if mincount and count < as_int(mincount, 1):
-                # Tag count is too low.
-                continue
             if ul:
                 # Found new tag for cloud; now add previously prepared one.
                 ul('\n', li)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Timings and counters of tag system hot paths.
+
+Metrics are named by dotted strings, most of them suffixed by the realm:
+
+ `query`, `query.<realm>`:: time of tag queries over all and per tag
+ provider, with the count `query.<realm>.matched` of resulting resources
+ `get_all_tags`, `tag_frequency.<realm>`, `tagged_resources.<realm>`::
+ time of listing tags and tagged resources
+ `perm_checks.<realm>`:: count of resource permission checks
+ `cache.<name>.lookup`, `cache.<name>.miss`:: count of cache lookups and
+ rebuilds of the cached ticket tags and of the tag index
+
+Nothing is measured without a sink configured in `[tags] metrics_sinks`.
+
+Independently tag queries slower than `[tags] slow_query_threshold` are
+logged by `SlowTagQueryLog`.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from trac.config import IntOption, OrderedExtensionsOption
+from trac.core import Component, Interface, implements
+from trac.db.api import DatabaseManager
+from trac.util.text import exception_to_unicode, shorten_line
+
+# Maximum number of distinct SQL statements kept by a `QueryTrace`.
+_MAX_TRACED_STATEMENTS = 10
+
+
+class ITagMetricsSink(Interface):
+    """Extension point interface for components receiving timings and
+    counters of the tag system.
+    """
+
+    def record_timing(name, seconds):
+        """Called with the duration of an operation in seconds."""
+
+    def record_count(name, value):
+        """Called with a number to add to a counter."""
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted `values`."""
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class TagMetrics(Component):
+    """[main] Measures hot paths of the tag system for metrics sinks."""
+
+    sinks = OrderedExtensionsOption('tags', 'metrics_sinks', ITagMetricsSink,
+        '', include_missing=False,
+        doc="""Metrics sinks receiving timings and counters of the tag
+            system, i.e. `TagMetricsLogger` and `TagMetricsRecorder`.""")
+
+    def __init__(self):
+        # Option value and sinks resolved from it.
+        self._sinks = None
+
+    # Public methods
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager recording the time spent within as `name`."""
+        sinks = self._get_sinks()
+        if not sinks:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            for sink in sinks:
+                sink.record_timing(name, seconds)
+
+    def timed(self, name, iterable, count=None):
+        """Return an iterator over `iterable`, that records the time spent
+        producing the items as `name` and the number of items as counter
+        `count`, if given, when exhausted.
+        """
+        sinks = self._get_sinks()
+        if not sinks:
+            return iter(iterable)
+        return self._timed(sinks, name, iterable, count)
+
+    def count(self, name, value=1):
+        """Add `value` to the counter `name`."""
+        sinks = self._get_sinks()
+        if not sinks:
+            return
+        for sink in sinks:
+            sink.record_count(name, value)
+
+    # Internal methods
+
+    def _get_sinks(self):
+        # Resolving extensions for every measurement is too expensive, so
+        # sinks are only resolved again after the option changed.
+        value = self.config.get('tags', 'metrics_sinks')
+        cached = self._sinks
+        if cached is None or cached[0] != value:
+            cached = self._sinks = (value,
+                                    self.sinks if value.strip() else [])
+        return cached[1]
+
+    def _timed(self, sinks, name, iterable, count):
+        seconds = 0.0
+        items = 0
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.time() - started
+            items += 1
+            yield item
+        for sink in sinks:
+            sink.record_timing(name, seconds)
+            if count:
+                sink.record_count(count, items)
+
+
+class TagMetricsLogger(Component):
+    """[extra] Metrics sink writing all timings and counters to the log."""
+
+    implements(ITagMetricsSink)
+
+    # ITagMetricsSink methods
+
+    def record_timing(self, name, seconds):
+        self.log.info("Tag metrics: %s took %.2f ms", name, seconds * 1000)
+
+    def record_count(self, name, value):
+        self.log.info("Tag metrics: %s counted %d", name, value)
+
+
+class TagMetricsRecorder(Component):
+    """[extra] Metrics sink keeping recent timings and counter totals in
+    memory for the admin panel.
+
+    Metrics are kept separately by each process since its start.
+    """
+
+    implements(ITagMetricsSink)
+
+    max_samples = IntOption('tags', 'metrics_samples', 1000,
+        doc="Number of recent timings kept per metric by the recorder.")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    # Public methods
+
+    def get_timings(self, percents=(50, 90, 99)):
+        """Return a sorted list of `(name, samples, percentiles, max)`
+        tuples of timings in seconds.
+        """
+        with self._lock:
+            timings = [(name, sorted(samples))
+                       for name, samples in self._timings.iteritems()]
+        return [(name, len(samples),
+                 [percentile(samples, p) for p in percents], samples[-1])
+                for name, samples in sorted(timings)]
+
+    def get_counts(self):
+        """Return a sorted list of `(name, total)` counter tuples."""
+        with self._lock:
+            return sorted(self._counts.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._timings = {}
+            self._counts = {}
+
+    # ITagMetricsSink methods
+
+    def record_timing(self, name, seconds):
+        with self._lock:
+            samples = self._timings.get(name)
+            if samples is None:
+                samples = self._timings[name] = \
+                    deque(maxlen=max(self.max_samples, 1))
+            samples.append(seconds)
+
+    def record_count(self, name, value):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+
+class QueryTrace(object):
+    """Time, record counts and SQL statements of a tag query.
+
+    Time is only taken within the context of the trace, so iterating over
+    lazily produced query results within it excludes the time spent by the
+    consumer of the results.  SQL statements are recorded by `trace_sql()`
+    within the context.
+    """
+
+    _active = threading.local()
+
+    def __init__(self, query, realms=()):
+        self.query = query
+        self.realms = sorted(realms)
+        self.seconds = 0.0
+        self.candidates = 0
+        self.matched = 0
+        self.statements = []
+
+    def __enter__(self):
+        self._outer = getattr(self._active, 'trace', None)
+        self._active.trace = self
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.time() - self._started
+        self._active.trace = self._outer
+
+    def iterate(self, iterable):
+        """Iterate over `iterable` within the context of the trace."""
+        iterator = iter(iterable)
+        while True:
+            with self:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+def trace_sql(sql, args=()):
+    """Record an SQL statement issued for the currently traced tag query.
+    """
+    trace = getattr(QueryTrace._active, 'trace', None)
+    if trace is not None and \
+            len(trace.statements) < _MAX_TRACED_STATEMENTS and \
+            sql not in [statement for statement, args_ in trace.statements]:
+        trace.statements.append((sql, list(args)))
+
+
+class SlowTagQueryLog(Component):
+    """[opt] Logs slow tag queries with their SQL statements and query
+    plans.
+    """
+
+    threshold = IntOption('tags', 'slow_query_threshold', 0,
+        doc="""Tag queries taking longer than this number of milliseconds
+            are logged as warning with the SQL statements issued and, for
+            SQLite and PostgreSQL, their query plans.  0 disables the
+            log.""")
+
+    # Public methods
+
+    def start(self, query, realms=()):
+        """Return a `QueryTrace` for a tag query, or `None` if slow queries
+        aren't logged.
+        """
+        if self.threshold > 0:
+            return QueryTrace(query, realms)
+
+    def finish(self, trace):
+        """Log a traced tag query, if it has been slow."""
+        if trace is None or trace.seconds * 1000 < self.threshold:
+            return
+        lines = ["Slow tag query '%s' in realms %s: %d ms, %d candidates, "
+                 "%d matched" % (trace.query, ', '.join(trace.realms),
+                                 trace.seconds * 1000, trace.candidates,
+                                 trace.matched)]
+        for sql, args in trace.statements:
+            lines.append("  SQL: %s" % shorten_line(' '.join(sql.split()),
+                                                    500))
+            if args:
+                lines.append("  Args: %s" % shorten_line(repr(args), 200))
+            for line in self._explain(sql, args):
+                lines.append("  Plan: %s" % line)
+        self.log.warning('\n'.join(lines))
+
+    @contextmanager
+    def trace(self, query, realms=()):
+        """Context manager tracing a tag query evaluated within.
+
+        Yields the `QueryTrace` for counting records, or `None` if slow
+        queries aren't logged.
+        """
+        trace = self.start(query, realms)
+        if trace is None:
+            yield None
+            return
+        with trace:
+            yield trace
+        self.finish(trace)
+
+    # Internal methods
+
+    def _explain(self, sql, args):
+        scheme = DatabaseManager(self.env).connection_uri.split(':', 1)[0]
+        if scheme == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        elif scheme == 'postgres':
+            explain = 'EXPLAIN '
+        else:
+            return []
+        try:
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                cursor.execute(explain + sql, args)
+                return [unicode(row[-1]) for row in cursor]
+        except Exception, e:
+            return ["not available: %s" % exception_to_unicode(e)]
@@ -8,14 +8,85 @@
 # you should have received as part of this distribution.
 
 from datetime import datetime
-from itertools import groupby
+from itertools import groupby, islice
 
+from trac.core import ExtensionPoint
 from trac.resource import Resource
 from trac.util.datefmt import to_datetime, to_utimestamp, utc
 from trac.util.text import to_unicode
 
+from tractags.metrics import TagMetrics, trace_sql
 from tractags.util import split_into_tags
 
+# Maximum number of parameters for an SQL 'IN' expression.
+_IN_CHUNK_SIZE = 500
+
+# Seconds to wait for gaps in the change feed to get filled.
+FEED_GRACE_PERIOD = 60
+
+# Maximum number of resources recorded in the change feed by a single
+# change, more are recorded as a change to the whole realm.
+FEED_MAX_NAMES = 1000
+
+# Columns of tag tables in dump order, the leading ones form the key.
+_DUMP_COLUMNS = {
+    'tags': (('tagspace', 'name', 'tag'), 3),
+    'tags_change': (('tagspace', 'name', 'time', 'author', 'oldtags',
+                     'newtags'), 3),
+}
+
+
+class TaggedResource(object):
+    """Compact record of a tagged resource and its tags.
+
+    Unpacks like the `(resource, tags)` tuples of the `ITagProvider` API,
+    but creates the `Resource` object only on access.  Tags are stored as
+    frozenset, that can be shared between records with equal tags.
+    """
+
+    __slots__ = ('realm', 'id', 'tags')
+
+    def __init__(self, realm, id, tags):
+        self.realm = realm
+        self.id = id
+        self.tags = tags if isinstance(tags, frozenset) else frozenset(tags)
+
+    @property
+    def resource(self):
+        return Resource(self.realm, self.id)
+
+    def __iter__(self):
+        return iter((self.resource, self.tags))
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (self.resource, self.tags)[index]
+
+    def __repr__(self):
+        return '<TaggedResource %s:%s %r>' % (self.realm, self.id,
+                                              sorted(self.tags))
+
+
+class TagPool(object):
+    """Share equal tags and tag sets between records of a large result.
+
+    Tag names are read from the database as separate strings for each row,
+    and most resources have one of only a few distinct tag combinations.
+    """
+
+    __slots__ = ('tags', 'tagsets')
+
+    def __init__(self):
+        self.tags = {}
+        self.tagsets = {}
+
+    def __call__(self, tags):
+        setdefault = self.tags.setdefault
+        tags = frozenset([setdefault(tag, tag) for tag in tags])
+        return self.tagsets.setdefault(tags, tags)
+
 
 # Public functions (not yet)
 
@@ -27,52 +98,275 @@ def delete_tags(env, resource, tags=None, purge=False):
 
     :param purge: if `True`, delete the change history.
     """
-    args = [resource.realm, to_unicode(resource.id)]
-    sql = ''
-    if tags:
-        args += list(tags)
-        sql += " AND tags.tag IN (%s)" % ','.join(['%s'] * len(tags))
     with env.db_transaction as db:
-        db("""DELETE FROM tags
-              WHERE tagspace=%%s AND name=%%s%s
-              """ % sql, args)
+        _delete_tags(db, resource, tags)
         if purge:
             # Call outside of another db transaction means resource destruction,
             # so purge change records too.
             db("""DELETE FROM tags_change
                   WHERE tagspace=%s AND name=%s
                   """, (resource.realm, to_unicode(resource.id)))
+        notify_tags_changed(env, resource.realm, [to_unicode(resource.id)])
+
+
+def _delete_tags(db, resource, tags=None):
+    args = [resource.realm, to_unicode(resource.id)]
+    sql = ''
+    if tags:
+        args += list(tags)
+        sql += " AND tags.tag IN (%s)" % ','.join(['%s'] * len(tags))
+    db("""DELETE FROM tags
+          WHERE tagspace=%%s AND name=%%s%s
+          """ % sql, args)
+
+
+def notify_tags_changed(env, realm, names=None):
+    """Notify `ITagChangeListener` components about changed tags.
+
+    Changed resources are recorded in the change feed as well, a change to
+    an unknown set or more than `FEED_MAX_NAMES` resources with an empty
+    name.
+    """
+    now = to_utimestamp(datetime.now(utc))
+    if names is not None and len(names) <= FEED_MAX_NAMES:
+        feed = [(realm, name, now) for name in names]
+    else:
+        feed = [(realm, u'', now)]
+    if feed:
+        env.db_transaction.executemany("""
+            INSERT INTO tags_feed (tagspace, name, time) VALUES (%s,%s,%s)
+            """, feed)
+    # Import here, because the tag system depends on this module.
+    from tractags.api import ITagChangeListener
+    for listener in ExtensionPoint(ITagChangeListener).extensions(env):
+        listener.tags_changed(realm, names)
 
 
 def tag_changes(env, resource, start=None, stop=None):
     """Return tag history for one or all tagged Trac resources."""
     if resource:
         # Resource changelog events query.
-        return [(to_datetime(row[0]), row[1], row[2], row[3])
-                for row in env.db_query("""
-                    SELECT time,author,oldtags,newtags FROM tags_change
-                    WHERE tagspace=%s AND name=%s
-                    ORDER BY time DESC
-                    """, (resource.realm, to_unicode(resource.id)))]
+        return list(iter_tag_changes(env, resource))
     # Timeline events query.
-    return [(to_datetime(row[0]), row[1], row[2], row[3], row[4], row[5])
-            for row in env.db_query("""
+    return iter_tag_changes(env, None, start, stop)
+
+
+def iter_tag_changes(env, resource, start=None, stop=None):
+    """Yield tag history for one or all tagged Trac resources, newest first.
+
+    Rows are streamed from a database cursor.  Resource history is read
+    along the primary key, the time range of all changes along the index
+    on time.
+    """
+    with env.db_query as db:
+        cursor = db.cursor()
+        if resource:
+            cursor.execute("""
+                SELECT time,author,oldtags,newtags FROM tags_change
+                WHERE tagspace=%s AND name=%s
+                ORDER BY time DESC
+                """, (resource.realm, to_unicode(resource.id)))
+            for row in cursor:
+                yield to_datetime(row[0]), row[1], row[2], row[3]
+        else:
+            cursor.execute("""
                 SELECT time,author,tagspace,name,oldtags,newtags
                 FROM tags_change WHERE time>%s AND time<%s
-                """, (to_utimestamp(start), to_utimestamp(stop)))]
+                ORDER BY time DESC
+                """, (to_utimestamp(start), to_utimestamp(stop)))
+            for row in cursor:
+                yield (to_datetime(row[0]), row[1], row[2], row[3], row[4],
+                       row[5])
+
 
+def dump_rows(env, table, realm=None):
+    """Yield all rows of the `tags` or `tags_change` table in key order.
+
+    Rows are streamed from a database cursor.
+    """
+    columns, size = _DUMP_COLUMNS[table]
+    sql = "SELECT %s FROM %s" % (','.join(columns), table)
+    args = []
+    if realm:
+        sql += " WHERE tagspace=%s"
+        args.append(realm)
+    sql += " ORDER BY %s" % ','.join(columns[:size])
+    with env.db_query as db:
+        cursor = db.cursor()
+        cursor.execute(sql, args)
+        for row in cursor:
+            yield row
+
+
+def load_rows(env, table, rows, batch_size=10000):
+    """Merge rows into the `tags` or `tags_change` table.
+
+    Rows replace existing ones with the same key, later rows earlier ones
+    of the same batch.  Each batch of
+    `batch_size` rows is written with `executemany()` in a transaction of
+    its own.  Returns the number of rows loaded.
+    """
+    columns, size = _DUMP_COLUMNS[table]
+    where = ' AND '.join('%s=%%s' % c for c in columns[:size])
+    count = 0
+    rows = iter(rows)
+    realms = set()
+    while True:
+        batch = dict((tuple(row[:size]), tuple(row))
+                     for row in islice(rows, batch_size)).values()
+        if not batch:
+            break
+        with env.db_transaction as db:
+            db.executemany("DELETE FROM %s WHERE %s" % (table, where),
+                           [row[:size] for row in batch])
+            db.executemany("INSERT INTO %s (%s) VALUES (%s)"
+                           % (table, ','.join(columns),
+                              ','.join(['%s'] * len(columns))), batch)
+        realms.update(row[0] for row in batch)
+        count += len(batch)
+    if table == 'tags':
+        for realm in sorted(realms):
+            notify_tags_changed(env, realm)
+    return count
+
+
+def tag_feed(env, cursor=0, limit=None):
+    """Return changes recorded in the change feed after `cursor`.
+
+    Returns a list of `(seq, realm, name)` tuples in order of the
+    sequence number `seq`, and the cursor to continue from.  An empty name
+    denotes a change to an unknown set of resources of the realm.  For a
+    cursor before changes deleted by `prune_feed()` a single change with
+    `None` as realm is returned, that means a change to all realms.
+
+    Sequence numbers are taken on insert, but become visible on commit, so
+    a gap in the sequence may still get filled by a concurrent transaction.
+    The returned cursor never moves past a gap followed by changes younger
+    than `FEED_GRACE_PERIOD` seconds, the changes after it are returned
+    again for that cursor.  Changes of transactions committing even later
+    are missed.
+    """
+    pruned = _feed_pruned(env)
+    if cursor < pruned:
+        return [(pruned, None, u'')], pruned
+    sql = """
+        SELECT id, tagspace, name, time FROM tags_feed
+        WHERE id>%s ORDER BY id"""
+    if limit:
+        sql += " LIMIT %d" % limit
+    rows = env.db_query(sql, (cursor,))
+    recent = to_utimestamp(datetime.now(utc)) - FEED_GRACE_PERIOD * 1000000
+    next = cursor
+    for seq, realm, name, time in rows:
+        if seq != next + 1 and time > recent:
+            break
+        next = seq
+    return [tuple(row[:3]) for row in rows], next
+
+
+def feed_cursor(env):
+    """Return a change feed cursor for following changes from now on.
+
+    The cursor is taken before the grace period of `tag_feed()`, so recent
+    changes are read again rather than missed.
+    """
+    recent = to_utimestamp(datetime.now(utc)) - FEED_GRACE_PERIOD * 1000000
+    for seq, in env.db_query("""
+            SELECT id FROM tags_feed WHERE time<=%s
+            ORDER BY id DESC LIMIT 1
+            """, (recent,)):
+        return seq
+    return _feed_pruned(env)
 
-def tag_frequency(env, realm, filter=None, db=None):
-    """Return tags and numbers of their occurrence."""
+
+def prune_feed(env, before):
+    """Delete changes recorded in the change feed before a datetime.
+
+    Changes recorded later, but with a lower sequence number are deleted
+    too.  Returns the number of deleted changes.
+    """
+    with env.db_transaction as db:
+        for last, in db("""
+                SELECT MAX(id) FROM tags_feed WHERE time<%s
+                """, (to_utimestamp(before),)):
+            break
+        if last is None:
+            return 0
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM tags_feed WHERE id<=%s", (last,))
+        count = cursor.rowcount
+        if db("SELECT 1 FROM system WHERE name='tags_feed_pruned'"):
+            db("UPDATE system SET value=%s WHERE name='tags_feed_pruned'",
+               (str(last),))
+        else:
+            db("INSERT INTO system (name, value) VALUES (%s,%s)",
+               ('tags_feed_pruned', str(last)))
+    return count
+
+
+def changed_resources(env, cursor, limit=None):
+    """Return names of resources changed after a change feed cursor.
+
+    Returns a dict of name sets by realm, with `None` for realms changed as
+    a whole, and the cursor to continue from.  Both are `None`, if there
+    are more than `limit` changes or changes after the cursor have been
+    pruned.
+    """
+    feed, next = tag_feed(env, cursor, limit and limit + 1)
+    if limit and len(feed) > limit:
+        return None, None
+    changed = {}
+    for seq, realm, name in feed:
+        if realm is None:
+            return None, None
+        elif not name:
+            changed[realm] = None
+        elif changed.get(realm, ()) is not None:
+            changed.setdefault(realm, set()).add(name)
+    return changed, next
+
+
+def _feed_pruned(env):
+    """Return the sequence number of the last pruned change, or 0."""
+    for value, in env.db_query("""
+            SELECT value FROM system WHERE name='tags_feed_pruned'
+            """):
+        return int(value)
+    return 0
+
+
+def tag_frequency(env, realm, filter=None, db=None, mincount=None):
+    """Return tags and numbers of their occurrence.
+
+    Tags occurring less than `mincount` times are skipped by the database.
+    """
     if filter:
         sql = ''.join(" AND %s" % f for f in filter)
-    for row in env.db_query("""
+    args = [realm]
+    having = ''
+    if mincount > 1:
+        having = " HAVING count(tag)>=%s"
+        args.append(mincount)
+    with TagMetrics(env).timer('tag_frequency.' + realm):
+        rows = env.db_query("""
             SELECT tag,count(tag) FROM tags
-            WHERE tagspace=%%s%s GROUP BY tag
-            """ % (filter and sql or ''), (realm,)):
+            WHERE tagspace=%%s%s GROUP BY tag%s
+            """ % (filter and sql or '', having), args)
+    for row in rows:
         yield row[0], row[1]
 
 
+def tag_exists(env, realm, tag, filter=None):
+    """Return whether a tag is used at least once in a realm."""
+    sql = filter and ''.join(" AND %s" % f for f in filter) or ''
+    for row in env.db_query("""
+            SELECT 1 FROM tags
+            WHERE tagspace=%%s AND tag=%%s%s LIMIT 1
+            """ % sql, (realm, tag)):
+        return True
+    return False
+
+
 def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                  log=False, when=None):
     """Save tags and tag changes for a Trac resource.
@@ -98,6 +392,8 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                WHERE tagspace=%s AND name=%s
                """, (to_unicode(resource.id), resource.realm,
                      to_unicode(old_id)))
+            notify_tags_changed(env, resource.realm,
+                                [to_unicode(old_id), to_unicode(resource.id)])
     else:
         # Calculate effective tag changes.
         old_tags = set(resource_tags(env, resource))
@@ -106,10 +402,10 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
         with env.db_transaction as db:
             if remove:
                 if tags:
-                    delete_tags(env, resource, remove)
+                    _delete_tags(db, resource, remove)
                 else:
                     # Delete all resource's tags - simplified transaction.
-                    delete_tags(env, resource)
+                    _delete_tags(db, resource)
             add = tags - old_tags
             if add:
                 db.executemany("""
@@ -117,6 +413,9 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                     VALUES (%s,%s,%s)
                     """, [(resource.realm, to_unicode(resource.id), tag)
                           for tag in add])
+            if remove or add:
+                notify_tags_changed(env, resource.realm,
+                                    [to_unicode(resource.id)])
             if log:
                 db("""
                   INSERT INTO tags_change
@@ -128,12 +427,156 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                         u' '.join(sorted(map(to_unicode, tags))),))
 
 
+def tag_resources(env, realm, items, author='anonymous', log=False,
+                  when=None, batch_size=1000):
+    """Save tags and tag changes for many Trac resources of a realm.
+
+    `items` is an iterable of `(id, tags)` pairs, of which the last one
+    counts for resources listed more than once.  For each batch
+    of `batch_size` resources the current tags are read with one query,
+    and all deletions, insertions and change records are written with
+    `executemany()` in one transaction.
+
+    Returns the number of resources with changed tags.
+    """
+    if when is None:
+        when = datetime.now(utc)
+    if isinstance(when, datetime):
+        when = to_utimestamp(when)
+
+    # Later tags for the same resource win, also across batches, which
+    # would otherwise record two changes of a resource at the same time.
+    items = dict((to_unicode(id), set(tags)) for id, tags in items)
+    # Bulk changes are recorded as changes to the whole realm, rather than
+    # filling the change feed batch by batch.
+    bulk = len(items) > FEED_MAX_NAMES
+    changed = 0
+    items = items.iteritems()
+    while True:
+        batch = dict(islice(items, batch_size))
+        if not batch:
+            return changed
+        with env.db_transaction as db:
+            current = resources_tags(env, realm, batch)
+            remove = []
+            add = []
+            changes = []
+            for name, tags in batch.iteritems():
+                old_tags = current.get(name, set())
+                if tags == old_tags:
+                    continue
+                remove.extend((realm, name, tag) for tag in old_tags - tags)
+                add.extend((realm, name, tag) for tag in tags - old_tags)
+                changes.append((realm, name, when, author,
+                                u' '.join(sorted(map(to_unicode, old_tags))),
+                                u' '.join(sorted(map(to_unicode, tags)))))
+            if remove:
+                db.executemany("""
+                    DELETE FROM tags WHERE tagspace=%s AND name=%s AND tag=%s
+                    """, remove)
+            if add:
+                db.executemany("""
+                    INSERT INTO tags (tagspace, name, tag)
+                    VALUES (%s,%s,%s)
+                    """, add)
+            if log and changes:
+                db.executemany("""
+                    INSERT INTO tags_change
+                     (tagspace, name, time, author, oldtags, newtags)
+                    VALUES (%s,%s,%s,%s,%s,%s)
+                    """, changes)
+            if changes:
+                notify_tags_changed(env, realm, None if bulk else
+                                    [row[1] for row in changes])
+        changed += len(changes)
+
+
+def replace_tags(env, realm, old_tags, new_tag=None, author='anonymous',
+                 log=False, when=None, filter=None, check=None):
+    """Replace or delete tags of all resources of a realm in SQL.
+
+    Resources tagged with any of `old_tags` get `new_tag` instead, or just
+    lose the old tags if `new_tag` is `None`.  The new tag is inserted once
+    per resource, skipping resources that already have it, before the old
+    tags are deleted, so merging tags never violates the primary key.
+
+    `filter` is a list of SQL conditions on `name` selecting the resources
+    to change.  `check` is called with the names of affected resources
+    before anything is written; raising an exception aborts the
+    replacement.  Tag changes are recorded with one `executemany()`.
+
+    Returns the number of resources with changed tags.
+    """
+    old_tags = set(map(to_unicode, old_tags))
+    if new_tag:
+        new_tag = to_unicode(new_tag)
+        old_tags.discard(new_tag)
+    if not old_tags:
+        return 0
+    if when is None:
+        when = datetime.now(utc)
+    if isinstance(when, datetime):
+        when = to_utimestamp(when)
+
+    old_tags = sorted(old_tags)
+    match = "tagspace=%%s AND tag IN (%s)" % ', '.join(['%s'] * len(old_tags))
+    if filter:
+        match += ''.join([" AND %s" % f for f in filter])
+    match_args = [realm] + old_tags
+
+    with env.db_transaction as db:
+        current = {}
+        for name, tag in db("""
+                SELECT name, tag FROM tags
+                WHERE tagspace=%%s AND name IN (SELECT name FROM tags
+                                                WHERE %s)
+                """ % match, [realm] + match_args):
+            current.setdefault(name, set()).add(tag)
+        if not current:
+            return 0
+        if check is not None:
+            check(sorted(current))
+
+        if new_tag:
+            db("""
+                INSERT INTO tags (tagspace, name, tag)
+                SELECT DISTINCT tagspace, name, %%s FROM tags
+                WHERE %s AND NOT EXISTS (SELECT * FROM tags t
+                                         WHERE t.tagspace=tags.tagspace
+                                          AND t.name=tags.name AND t.tag=%%s)
+                """ % match, [new_tag] + match_args + [new_tag])
+        db("DELETE FROM tags WHERE %s" % match, match_args)
+
+        if log:
+            changes = []
+            for name, tags in sorted(current.iteritems()):
+                new_tags = tags.difference(old_tags)
+                if new_tag:
+                    new_tags.add(new_tag)
+                changes.append((realm, name, when, author,
+                                u' '.join(sorted(tags)),
+                                u' '.join(sorted(new_tags))))
+            db.executemany("""
+                INSERT INTO tags_change
+                 (tagspace, name, time, author, oldtags, newtags)
+                VALUES (%s,%s,%s,%s,%s,%s)
+                """, changes)
+        notify_tags_changed(env, realm, sorted(current))
+    return len(current)
+
+
 def tagged_resources(env, perm_check, perm, realm, tags=None, filter=None,
                      db=None):
-    """Return Trac resources including their associated tags.
+    """Return `TaggedResource` records of Trac resources in a realm.
 
     This is currently known to be a major performance hog.
     """
+    return TagMetrics(env).timed('tagged_resources.' + realm,
+                                 _tagged_resources(env, perm_check, perm,
+                                                   realm, tags, filter))
+
+
+def _tagged_resources(env, perm_check, perm, realm, tags, filter):
     args = [realm]
     sql = """
         SELECT DISTINCT name
@@ -147,24 +590,48 @@ def tagged_resources(env, perm_check, perm, realm, tags=None, filter=None,
     sql += " ORDER by name"
 
     # Inline permission check for efficiency.
-    resources = {}
+    resources = set()
+    checks = 0
+    trace_sql(sql, args)
     for name, in env.db_query(sql, args):
-        resource = Resource(realm, name)
-        if perm_check(perm(resource), 'view'):
-            resources[resource.id] = resource
+        checks += 1
+        if perm_check(perm(Resource(realm, name)), 'view'):
+            resources.add(name)
+    TagMetrics(env).count('perm_checks.' + realm, checks)
     if not resources:
         return
 
     # DEVEL: Is this going to be excruciatingly slow?
     #        The explicite resource ID list might even grow beyond some limit.
-    for name, tags in groupby(env.db_query("""
-            SELECT DISTINCT name, tag FROM tags
+    sql = """
+        SELECT DISTINCT name, tag FROM tags
+        WHERE tagspace=%%s AND name IN (%s)
+        ORDER BY name
+        """ % ', '.join(['%s'] * len(resources))
+    args = [realm] + list(resources)
+    trace_sql(sql, args)
+    for name, tags in groupby(env.db_query(sql, args), lambda row: row[0]):
+        yield TaggedResource(realm, name, [tag[1] for tag in tags])
+
+
+def resources_tags(env, realm, names):
+    """Return a dict of current tags by name for resources of a realm.
+
+    Tags of untagged resources are missing.  Names are looked up in chunks
+    to keep the number of query parameters bounded.
+    """
+    names = sorted(set(to_unicode(name) for name in names))
+    tags = {}
+    for i in xrange(0, len(names), _IN_CHUNK_SIZE):
+        chunk = names[i:i + _IN_CHUNK_SIZE]
+        sql = """
+            SELECT name, tag FROM tags
             WHERE tagspace=%%s AND name IN (%s)
-            ORDER BY name
-            """ % ', '.join(['%s'] * len(resources)),
-            [realm] + resources.keys()), lambda row: row[0]):
-        resource = resources[name]
-        yield resource, set([tag[1] for tag in tags])
+            """ % ', '.join(['%s'] * len(chunk))
+        trace_sql(sql, [realm] + chunk)
+        for name, tag in env.db_query(sql, [realm] + chunk):
+            tags.setdefault(name, set()).add(tag)
+    return tags
 
 
 def resource_tags(env, resource, when=None):
@@ -19,12 +19,27 @@ def test_suite():
     import tractags.tests.api
     suite.addTest(tractags.tests.api.test_suite())
 
+    import tractags.tests.benchmarks
+    suite.addTest(tractags.tests.benchmarks.test_suite())
+
     import tractags.tests.db
     suite.addTest(tractags.tests.db.test_suite())
 
+    import tractags.tests.history
+    suite.addTest(tractags.tests.history.test_suite())
+
+    import tractags.tests.index
+    suite.addTest(tractags.tests.index.test_suite())
+
+    import tractags.tests.jobs
+    suite.addTest(tractags.tests.jobs.test_suite())
+
     import tractags.tests.macros
     suite.addTest(tractags.tests.macros.test_suite())
 
+    import tractags.tests.metrics
+    suite.addTest(tractags.tests.metrics.test_suite())
+
     import tractags.tests.model
     suite.addTest(tractags.tests.model.test_suite())
 
@@ -8,33 +8,225 @@
 #
 
 import shutil
+from StringIO import StringIO
 import tempfile
 import unittest
 
-from trac.test import EnvironmentStub
+from trac.admin import AdminCommandError
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
 
-from tractags.admin import TagChangeAdminPanel
+from tractags.admin import TagChangeAdminPanel, TagJobAdminPanel
+from tractags.admin import TagMetricsAdminPanel
+from tractags.admin import as_count, format_progress
+from tractags.admin import parse_command_args, read_rows, write_rows
+from tractags.db import TagSetup
+from tractags.jobs import TagJobQueue
+from tractags.metrics import TagMetrics, TagMetricsRecorder
 
 
 class TagChangeAdminPanelTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.env = EnvironmentStub(enable=['trac.*', 'tractags.*'])
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
         self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
 
         self.tag_cap = TagChangeAdminPanel(self.env)
 
     def tearDown(self):
+        self.env.shutdown()
         shutil.rmtree(self.env.path)
 
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    def _replace(self, **kwargs):
+        req = MockRequest(self.env, method='POST',
+                          args=dict(ticket='on', tag_name='tag1',
+                                    tag_new_name='tag2'), **kwargs)
+        self.assertRaises(RequestDone, self.tag_cap.render_admin_panel,
+                          req, 'tags', 'replace', None)
+
+    # Tests
+
     def test_init(self):
         # Empty test just to confirm that setUp and tearDown works
         pass
 
+    def test_replace_ticket_tags(self):
+        ticket = Ticket(self.env)
+        ticket.populate(dict(summary='summary', reporter='admin',
+                             status='new', keywords='tag1'))
+        ticket.insert()
+        self._replace()
+        self.assertEquals('tag2', Ticket(self.env, 1)['keywords'])
+        self.assertEquals([], TagJobQueue(self.env).get_jobs())
+
+        # Deferred to a job, if enabled.
+        self.env.config.set('tags', 'defer_ticket_replace', True)
+        ticket = Ticket(self.env, 1)
+        ticket['keywords'] = 'tag1'
+        ticket.save_changes('admin')
+        self._replace()
+        self.assertEquals('tag1', Ticket(self.env, 1)['keywords'])
+        self.assertEquals(['ticket_replace'],
+                          [job['kind'] for job
+                           in TagJobQueue(self.env).get_jobs()])
+
+        # The job checks permissions of the user enqueuing it, who may not
+        # modify tickets here.
+        TagJobQueue(self.env).run_batch()
+        self.assertEquals('tag1', Ticket(self.env, 1)['keywords'])
+        for action in ('TAGS_ADMIN', 'TICKET_ADMIN'):
+            PermissionSystem(self.env).grant_permission('admin', action)
+        self._replace(authname='admin')
+        TagJobQueue(self.env).run_batch()
+        self.assertEquals('tag2', Ticket(self.env, 1)['keywords'])
+
+
+class TagJobAdminPanelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+
+        self.panel = TagJobAdminPanel(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    # Tests
+
+    def test_cancel(self):
+        queue = TagJobQueue(self.env)
+        id = queue.enqueue('index_rebuild')
+        req = MockRequest(self.env, method='POST',
+                          args=dict(cancel='', sel=['x', str(id)]))
+        self.assertRaises(RequestDone, self.panel.render_admin_panel,
+                          req, 'tags', 'jobs', None)
+        self.assertEquals(["Invalid value for 'id': x"],
+                          map(unicode, req.chrome['warnings']))
+        self.assertEquals('cancelled', queue.get_job(id)['state'])
+
+
+class TagMetricsAdminPanelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.req = MockRequest(self.env)
+
+        self.panel = TagMetricsAdminPanel(self.env)
+
+    def tearDown(self):
+        shutil.rmtree(self.env.path)
+
+    def test_render(self):
+        data = self.panel.render_admin_panel(self.req, 'tags', 'metrics',
+                                             None)[1]
+        self.assertFalse(data['recording'])
+        self.env.config.set('tags', 'metrics_sinks', 'TagMetricsRecorder')
+        for seconds in (0.01, 0.002):
+            TagMetricsRecorder(self.env).record_timing('query', seconds)
+        TagMetrics(self.env).count('perm_checks.wiki', 3)
+        data = self.panel.render_admin_panel(self.req, 'tags', 'metrics',
+                                             None)[1]
+        self.assertEquals([dict(name='query', samples=2,
+                                percentiles=['2.0', '10.0', '10.0'],
+                                max='10.0')], data['timings'])
+        self.assertEquals([('perm_checks.wiki', 3)], data['counts'])
+
+
+class CommandArgsTestCase(unittest.TestCase):
+
+    def test_parse_command_args(self):
+        self.assertEquals((['wiki'], {'max-age': '30'}),
+                          parse_command_args(['--max-age=30', 'wiki'],
+                                             ('max-age',)))
+        self.assertRaises(AdminCommandError, parse_command_args,
+                          ['--unknown=1'], ('max-age',))
+
+    def test_as_count(self):
+        self.assertEquals(30, as_count('30', 'max-age'))
+        self.assertRaises(AdminCommandError, as_count, '-1', 'max-age')
+        self.assertRaises(AdminCommandError, as_count, 'many', 'max-age')
+
+    def test_format_progress(self):
+        self.assertEquals('5/20 (25%)', format_progress(dict(done=5, total=20)))
+        self.assertEquals('5', format_progress(dict(done=5, total=None)))
+
+
+class ExportFormatTestCase(unittest.TestCase):
+
+    fields = ('realm', 'id', 'time', 'author', 'oldtags', 'newtags')
+    rows = [(u'wiki', u'WikiStart', 42, u'editor', None, u'a,b t\xe4g'),
+            (u'ticket', u'1', 43, u'admin', u'a', u'')]
+
+    def _roundtrip(self, format):
+        out = StringIO()
+        self.assertEquals(2, write_rows(out, format, self.fields, self.rows))
+        out.seek(0)
+        return list(read_rows(out, format, self.fields))
+
+    def test_csv(self):
+        self.assertEquals([self.rows[0][:4] + (u'',) + self.rows[0][5:],
+                           self.rows[1]], self._roundtrip('csv'))
+
+    def test_jsonl(self):
+        self.assertEquals(self.rows, self._roundtrip('jsonl'))
+
+    def test_invalid(self):
+        self.assertRaises(AdminCommandError, list,
+                          read_rows(StringIO('realm,id\n'), 'csv',
+                                    self.fields))
+        self.assertRaises(AdminCommandError, list,
+                          read_rows(StringIO('{"realm": "wiki"}\n'), 'jsonl',
+                                    self.fields))
+
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TagChangeAdminPanelTestCase))
+    suite.addTest(unittest.makeSuite(TagJobAdminPanelTestCase))
+    suite.addTest(unittest.makeSuite(TagMetricsAdminPanelTestCase))
+    suite.addTest(unittest.makeSuite(CommandArgsTestCase))
+    suite.addTest(unittest.makeSuite(ExportFormatTestCase))
     return suite
 
 
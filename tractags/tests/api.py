@@ -11,16 +11,20 @@ import doctest
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
 
 from trac.core import implements
 from trac.perm import (
     PermissionCache, PermissionSystem, IPermissionRequestor, PermissionError)
 from trac.resource import Resource
 from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
 
 import tractags.api
 
 from tractags.db import TagSetup
+from tractags.index import TagCompletionIndex
+from tractags.model import prune_feed
 from tractags.ticket import TicketTagProvider
 from tractags.wiki import WikiTagProvider
 
@@ -52,6 +56,8 @@ class _BaseTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -129,6 +135,70 @@ class TagSystemTestCase(_BaseTestCase):
         # Shouldn't raise an error with appropriate permission.
         self.tag_s.set_tags(req, resource, tags)
 
+    def test_set_tags_many(self):
+        resources = [Resource('wiki', 'WikiStart'), Resource('wiki', 'SandBox')]
+        req = MockRequest(self.env, authname='anonymous')
+        self.assertRaises(PermissionError, self.tag_s.set_tags_many, req,
+                          [(r, ['tag1']) for r in resources])
+        req = MockRequest(self.env, authname='editor')
+        self.tag_s.set_tags_many(req, [(resources[0], ['tag1', 'tag2']),
+                                       (resources[1], ['tag2'])])
+        self.assertEquals({('wiki', 'WikiStart'): set(['tag1', 'tag2']),
+                           ('wiki', 'SandBox'): set(['tag2'])},
+                          self.tag_s.get_tags_many(req, resources))
+
+    def test_replace_tag(self):
+        resources = [Resource('wiki', 'WikiStart'), Resource('wiki', 'SandBox')]
+        req = MockRequest(self.env, authname='editor')
+        self.tag_s.set_tags_many(req, [(resources[0], ['tag1', 'tag2']),
+                                       (resources[1], ['tag2', 'tag3'])])
+        req = MockRequest(self.env, authname='anonymous')
+        self.assertRaises(PermissionError, self.tag_s.replace_tag, req,
+                          ['tag2'], 'tag4')
+        req = MockRequest(self.env, authname='editor')
+        self.tag_s.replace_tag(req, ['tag1', 'tag2'], 'tag4')
+        self.assertEquals({('wiki', 'WikiStart'): set(['tag4']),
+                           ('wiki', 'SandBox'): set(['tag3', 'tag4'])},
+                          self.tag_s.get_tags_many(req, resources))
+        # Tags are only deleted on request.
+        self.tag_s.replace_tag(req, ['tag4'])
+        self.assertEquals(set(['tag4']),
+                          self.tag_s.get_tags(req, resources[0]))
+        self.tag_s.replace_tag(req, ['tag4'], allow_delete=True)
+        self.assertEquals({('wiki', 'WikiStart'): set(),
+                           ('wiki', 'SandBox'): set(['tag3'])},
+                          self.tag_s.get_tags_many(req, resources))
+
+    def test_changes_since(self):
+        resources = [Resource('wiki', 'WikiStart'), Resource('wiki', 'SandBox')]
+        req = MockRequest(self.env, authname='editor')
+        self.tag_s.set_tags_many(req, [(resources[0], ['tag1']),
+                                       (resources[1], ['tag2'])])
+        self.tag_s.set_tags(req, resources[0], ['tag1', 'tag3'])
+        changes, cursor = self.tag_s.changes_since(req)
+        self.assertEquals([('wiki', 'SandBox', set(['tag2'])),
+                           ('wiki', 'WikiStart', set(['tag1', 'tag3']))],
+                          [change[1:] for change in changes])
+        self.assertEquals(changes[-1][0], cursor)
+        self.assertEquals(([], cursor), self.tag_s.changes_since(req, cursor))
+        self.tag_s.replace_tag(req, ['tag2'], allow_delete=True)
+        self.tag_s.set_tags(req, resources[0], ['tag1'])
+        changes, cursor = self.tag_s.changes_since(req, cursor, 1)
+        self.assertEquals([('wiki', 'SandBox', set())],
+                          [change[1:] for change in changes])
+        # Changes of resources, that can't be viewed, are skipped.
+        req = MockRequest(self.env, authname='anonymous')
+        self.perms.revoke_permission('anonymous', 'TAGS_VIEW')
+        changes, next_cursor = self.tag_s.changes_since(req, cursor)
+        self.assertEquals([], changes)
+        self.assertTrue(next_cursor > cursor)
+        # Clients missing pruned changes read all realms again.
+        prune_feed(self.env, datetime(9999, 1, 1, tzinfo=utc))
+        req = MockRequest(self.env, authname='editor')
+        self.assertEquals(([(next_cursor, 'ticket', None, None),
+                            (next_cursor, 'wiki', None, None)], next_cursor),
+                          self.tag_s.changes_since(req, cursor))
+
     def test_query_no_args(self):
         # Regression test for query without argument,
         #   reported as th:ticket:7857.
@@ -138,6 +208,136 @@ class TagSystemTestCase(_BaseTestCase):
                            self.tag_s.query(req, query='')],
                           [])
 
+    def test_query_tagged(self):
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'WikiStart', 'tag1')
+            """)
+        req = MockRequest(self.env, authname='editor')
+        self.assertEquals([('wiki', 'WikiStart', frozenset(['tag1']))],
+                          [(t.realm, t.id, t.tags) for t in
+                           self.tag_s.query_tagged(req, 'tag1 realm:wiki')])
+        self.assertEquals([(Resource('wiki', 'WikiStart'), set(['tag1']))],
+                          [(res, tags) for res, tags in
+                           self.tag_s.query(req, 'tag1')])
+
+    def test_query_tagged_page(self):
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'WikiStart', 'tag1'), ('wiki', 'CamelCase', 'tag1'),
+                  ('ticket', '2', 'tag1'), ('ticket', '10', 'tag2'),
+                  ('wiki', 'SandBox', 'tag2')])
+        req = MockRequest(self.env, authname='editor')
+        def _page(query, limit, after=None):
+            return [(t.realm, t.id) for t in
+                    self.tag_s.query_tagged_page(req, query, limit, after)]
+        self.assertEquals([('ticket', '10'), ('ticket', '2'),
+                           ('wiki', 'CamelCase')], _page('', 3))
+        self.assertEquals([('wiki', 'SandBox'), ('wiki', 'WikiStart')],
+                          _page('', 3, ('wiki', 'CamelCase')))
+        self.assertEquals([('wiki', 'CamelCase'), ('wiki', 'WikiStart')],
+                          _page('tag1', None, ('ticket', '2')))
+        self.assertEquals([], _page('tag1', 3, ('wiki', 'WikiStart')))
+
+    def test_exists(self):
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'WikiStart', 'tag1')
+            """)
+        req = MockRequest(self.env, authname='editor')
+        self.assertTrue(self.tag_s.exists(req, 'tag1'))
+        self.assertTrue(self.tag_s.exists(req, 'tag1 or tag2'))
+        self.assertFalse(self.tag_s.exists(req, 'tag2'))
+        self.assertFalse(self.tag_s.exists(req, 'tag1 realm:ticket'))
+        self.assertTrue(self.tag_s.tag_exists(req, 'tag1', ['wiki']))
+        self.assertFalse(self.tag_s.tag_exists(req, 'tag1', ['ticket']))
+
+    def test_get_all_tags_mincount(self):
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'WikiStart', 'tag1'),
+                  ('wiki', 'WikiStart', 'tag2'),
+                  ('wiki', 'SandBox', 'tag1'),
+                  ('ticket', '1', 'tag2'),
+                  ('ticket', '1', 'tag3')])
+        req = MockRequest(self.env, authname='editor')
+        self.assertEquals({'tag1': 2, 'tag2': 2},
+                          self.tag_s.get_all_tags(req, mincount=2))
+        self.assertEquals({'tag1': 2},
+                          self.tag_s.get_all_tags(req, ['wiki'], mincount=2))
+        self.assertEquals({'tag1': 2},
+                          self.tag_s.get_all_tags(req, limit=1))
+        # Providers overriding the method without the argument still work.
+        provider = WikiTagProvider(self.env)
+        get_all_tags = provider.get_all_tags
+        provider.get_all_tags = lambda req, filter=None: get_all_tags(req)
+        try:
+            self.assertEquals({'tag1': 2},
+                              self.tag_s.get_all_tags(req, ['wiki'],
+                                                      mincount=2))
+        finally:
+            del provider.get_all_tags
+
+    def test_get_tags_many(self):
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'WikiStart', 'tag1'),
+                  ('wiki', 'WikiStart', 'tag2'),
+                  ('ticket', '1', 'tag3')])
+        resources = [Resource('wiki', 'WikiStart'), Resource('wiki', 'SandBox'),
+                     Resource('ticket', 1)]
+        self.assertEquals({('wiki', 'WikiStart'): set(['tag1', 'tag2']),
+                           ('wiki', 'SandBox'): set(),
+                           ('ticket', 1): set(['tag3'])},
+                          self.tag_s.get_tags_many(None, resources))
+        req = MockRequest(self.env, authname='anonymous')
+        self.perms.revoke_permission('anonymous', 'TAGS_VIEW')
+        self.assertEquals({}, self.tag_s.get_tags_many(req, resources))
+
+    def test_get_related_tags(self):
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'WikiStart', 'tag1'),
+                  ('wiki', 'WikiStart', 'tag2'),
+                  ('wiki', 'SandBox', 'tag1'),
+                  ('wiki', 'SandBox', 'tag2'),
+                  ('wiki', 'SandBox', 'tag3'),
+                  ('ticket', '1', 'tag1'),
+                  ('ticket', '1', 'tag3')])
+        req = MockRequest(self.env, authname='editor')
+        expected = [('tag2', 2), ('tag3', 2)]
+        self.assertEquals(expected, self.tag_s.get_related_tags(req, 'tag1'))
+        self.assertEquals([('tag2', 2)],
+                          self.tag_s.get_related_tags(req, 'tag1', limit=1))
+        self.assertEquals([('tag2', 2), ('tag3', 1)],
+                          self.tag_s.get_related_tags(req, 'tag1', ['wiki']))
+        # Same results from tagged resources without precomputed counts.
+        self.env.config.set('components', 'tractags.index.*', 'disabled')
+        self.assertEquals(expected, self.tag_s.get_related_tags(req, 'tag1'))
+        # Permission policies may restrict viewing single resources.
+        self.env.config.set('components', 'tractags.index.*', 'enabled')
+        self.env.config.set('trac', 'permission_policies',
+                            'TagPolicy, DefaultPermissionPolicy')
+        TagCompletionIndex(self.env).get_related = \
+            lambda realm, tag: self.fail("Precomputed counts used")
+        self.assertEquals(expected, self.tag_s.get_related_tags(req, 'tag1'))
+
+    def test_exists_memoized(self):
+        req = MockRequest(self.env, authname='editor')
+        self.assertFalse(self.tag_s.exists(req, 'tag1'))
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'WikiStart', 'tag1')
+            """)
+        # Results are remembered for the lifetime of the request.
+        self.assertFalse(self.tag_s.exists(req, 'tag1'))
+        req = MockRequest(self.env, authname='editor')
+        self.assertTrue(self.tag_s.exists(req, 'tag1'))
+
     def test_get_taggable_realms(self):
 
         class HiddenTagProvider(tractags.api.DefaultTagProvider):
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import random
+import shutil
+import tempfile
+import unittest
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub
+
+from tractags.benchmarks.corpus import ZipfSampler, generate_corpus
+from tractags.benchmarks.runner import BENCHMARKS, compare_results
+from tractags.benchmarks.runner import run_benchmarks
+from tractags.db import TagSetup
+
+
+class CorpusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+        PermissionSystem(self.env).grant_permission('bench', 'TRAC_ADMIN')
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    # Tests
+
+    def test_zipf_sampler(self):
+        sampler = ZipfSampler(50, 1.1, random.Random(0))
+        counts = [0] * 51
+        for i in xrange(200):
+            ranks = sampler.sample(5)
+            self.assertEquals(5, len(set(ranks)))
+            for rank in ranks:
+                counts[rank] += 1
+        self.assertEquals(0, counts[0])
+        self.assertTrue(counts[1] > counts[10] > counts[50])
+        self.assertEquals(range(1, 4),
+                          ZipfSampler(3, 1.1, random.Random(0)).sample(5))
+
+    def test_generate_corpus(self):
+        corpus = generate_corpus(self.env, resources=20, tags=10,
+                                 tags_per_resource=3, history=3)
+        self.assertEquals(['wiki', 'ticket'], corpus['realms'])
+        self.assertEquals([('ticket', 20, 60), ('wiki', 20, 60)],
+                          self.env.db_query("""
+                              SELECT tagspace, COUNT(DISTINCT name), COUNT(*)
+                              FROM tags GROUP BY tagspace ORDER BY tagspace
+                              """))
+        changes = self.env.db_query("""
+            SELECT oldtags, newtags FROM tags_change
+            WHERE tagspace='ticket' AND name='1' ORDER BY time
+            """)
+        self.assertEquals(3, len(changes))
+        self.assertEquals('', changes[0][0])
+        self.assertEquals(changes[0][1], changes[1][0])
+        self.assertEquals([changes[-1][1]], [keywords for keywords, in
+                          self.env.db_query("""
+                              SELECT keywords FROM ticket WHERE id=1
+                              """)])
+
+    def test_run_benchmarks(self):
+        corpus = generate_corpus(self.env, resources=10, tags=10)
+        results = run_benchmarks(self.env, corpus, repeat=2)
+        self.assertEquals(list(BENCHMARKS), list(results))
+        self.assertEquals(2, len(results['query']['runs']))
+        self.assertEquals(['query', 'tag_cloud'],
+                          list(run_benchmarks(self.env, corpus,
+                                              ['query', 'tag_cloud'], 1)))
+        corpus = dict(corpus, realms=['wiki'])
+        self.assertFalse('fetch_ticket_tags' in
+                         run_benchmarks(self.env, corpus, repeat=1))
+
+    def test_compare_results(self):
+        baseline = dict(results=dict(query=dict(median=0.2),
+                                     tag_cloud=dict(median=0.1)))
+        results = dict(results=dict(query=dict(median=0.21),
+                                    tag_cloud=dict(median=0.2),
+                                    replace_tag=dict(median=0.1)))
+        self.assertEquals([('query', 0.2, 0.21, False),
+                           ('tag_cloud', 0.1, 0.2, True)],
+                          sorted((name, base, current, slower)
+                                 for name, base, current, ratio, slower
+                                 in compare_results(baseline, results)))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CorpusTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
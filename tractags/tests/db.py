@@ -39,6 +39,8 @@ class TagSetupTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -190,6 +192,103 @@ class TagSetupTestCase(unittest.TestCase):
                                'oldtags', 'newtags'], cols)
         self.assertEquals(db_default.schema_version, self.get_db_version())
 
+    def test_upgrade_schema_v4(self):
+        # Add indexes for tag change records to the schema.
+        schema = [
+            Table('tags', key=('tagspace', 'name', 'tag'))[
+                Column('tagspace'),
+                Column('name'),
+                Column('tag'),
+                Index(['tagspace', 'name']),
+                Index(['tagspace', 'tag']),
+            ],
+            Table('tags_change', key=('tagspace', 'name', 'time'))[
+                Column('tagspace'),
+                Column('name'),
+                Column('time', type='int64'),
+                Column('author'),
+                Column('oldtags'),
+                Column('newtags'),
+            ]
+        ]
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for clean install testing.
+        self._revert_tractags_schema_init()
+
+        connector = self.db_mgr.get_connector()[0]
+        with self.env.db_transaction as db:
+            for table in schema:
+                for stmt in connector.to_sql(table):
+                    db(stmt)
+            # Preset system db table with old version.
+            db("""INSERT INTO system (name, value)
+                  VALUES ('tags_version', '4')""")
+
+        self.assertEquals(4, setup.get_schema_version())
+        self.assertTrue(setup.environment_needs_upgrade())
+
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        indexes = [name for name, in self.env.db_query("""
+            SELECT name FROM sqlite_master
+            WHERE type='index' AND tbl_name='tags_change'
+            AND sql IS NOT NULL ORDER BY name
+            """)]
+        self.assertEquals(['tags_change_author_idx', 'tags_change_time_idx'],
+                          indexes)
+        self.assertEquals(db_default.schema_version, self.get_db_version())
+
+    def test_upgrade_schema_v5(self):
+        # Add table for tag maintenance jobs.
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for clean install testing.
+        self._revert_tractags_schema_init()
+
+        connector = self.db_mgr.get_connector()[0]
+        with self.env.db_transaction as db:
+            for table in db_default.schema:
+                if table.name in ('tags', 'tags_change'):
+                    for stmt in connector.to_sql(table):
+                        db(stmt)
+            # Preset system db table with old version.
+            db("""INSERT INTO system (name, value)
+                  VALUES ('tags_version', '5')""")
+
+        self.assertEquals(5, setup.get_schema_version())
+        self.assertTrue(setup.environment_needs_upgrade())
+
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        self.assertEquals([], self.env.db_query("SELECT * FROM tags_job"))
+        self.assertEquals(db_default.schema_version, self.get_db_version())
+
+    def test_upgrade_schema_v6(self):
+        # Add table for the change feed.
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for clean install testing.
+        self._revert_tractags_schema_init()
+
+        connector = self.db_mgr.get_connector()[0]
+        with self.env.db_transaction as db:
+            for table in db_default.schema:
+                if table.name != 'tags_feed':
+                    for stmt in connector.to_sql(table):
+                        db(stmt)
+            # Preset system db table with old version.
+            db("""INSERT INTO system (name, value)
+                  VALUES ('tags_version', '6')""")
+
+        self.assertEquals(6, setup.get_schema_version())
+        self.assertTrue(setup.environment_needs_upgrade())
+
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        self.assertEquals([], self.env.db_query("SELECT * FROM tags_feed"))
+        self.assertEquals(db_default.schema_version, self.get_db_version())
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from trac.resource import Resource
+from trac.test import EnvironmentStub
+from trac.util.datefmt import utc
+
+from tractags.db import TagSetup
+from tractags.history import TagHistoryCompactor, plan_compaction
+from tractags.model import resource_tags, tag_resource
+
+
+class PlanCompactionTestCase(unittest.TestCase):
+
+    rows = [(10, 'alice', '', 'a'),
+            (12, 'alice', 'a', 'a b'),
+            (14, 'bob', 'a b', 'b'),
+            (30, 'bob', 'b', 'b c'),
+            (31, 'alice', 'b c', 'c')]
+
+    def test_unchanged(self):
+        self.assertEquals((self.rows, []), plan_compaction(self.rows))
+
+    def test_merge_window(self):
+        kept, removed = plan_compaction(self.rows, window=5)
+        self.assertEquals([(12, 'alice', '', 'a b'),
+                           (14, 'bob', 'a b', 'b'),
+                           (30, 'bob', 'b', 'b c'),
+                           (31, 'alice', 'b c', 'c')], kept)
+        self.assertEquals([(10, 'alice', '', 'a')], removed)
+
+    def test_cutoff(self):
+        kept, removed = plan_compaction(self.rows, cutoff=20)
+        self.assertEquals(self.rows[2:], kept)
+        self.assertEquals(self.rows[:2], removed)
+
+    def test_max_changes(self):
+        kept, removed = plan_compaction(self.rows, window=5, max_changes=2)
+        self.assertEquals(self.rows[3:], kept)
+        self.assertEquals(self.rows[:3], removed)
+
+
+class TagHistoryCompactorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+        self.compactor = TagHistoryCompactor(self.env)
+
+        self.now = datetime.now(utc)
+        self.resource = Resource('wiki', 'WikiStart')
+        for days, author, tags in ((40, 'alice', ['a']),
+                                   (20, 'alice', ['a', 'b']),
+                                   (10, 'bob', ['b']),
+                                   (10, 'bob', ['b', 'c'])):
+            when = self.now - timedelta(days=days)
+            if author == 'bob' and 'c' in tags:
+                when += timedelta(seconds=30)
+            tag_resource(self.env, self.resource, author=author, tags=tags,
+                         log=True, when=when)
+        tag_resource(self.env, Resource('wiki', 'SandBox'), tags=['a'],
+                     log=True, when=self.now)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    def _changes(self):
+        return self.env.db_query("""
+            SELECT author, oldtags, newtags FROM tags_change
+            WHERE tagspace='wiki' AND name='WikiStart' ORDER BY time
+            """)
+
+    def _tags_at(self, days):
+        return sorted(resource_tags(self.env, self.resource,
+                                    self.now - timedelta(days=days)))
+
+    # Tests
+
+    def test_compact_nothing(self):
+        stats, start = self.compactor.compact()
+        self.assertEquals(None, start)
+        self.assertEquals(dict(resources=2, compacted=0, removed=0,
+                               archived=0), stats)
+        self.assertEquals(4, len(self._changes()))
+
+    def test_compact(self):
+        self.env.config.set('tags', 'history_archive', 'history.jsonl')
+        stats, start = self.compactor.compact(window=60, max_age=15)
+        self.assertEquals(dict(resources=2, compacted=1, removed=2,
+                               archived=2), stats)
+        self.assertEquals([('alice', 'a', 'a b'), ('bob', 'a b', 'b c')],
+                          self._changes())
+        # Point-in-time queries stay correct after the oldest kept change.
+        self.assertEquals(['a', 'b'], self._tags_at(15))
+        self.assertEquals(['b', 'c'], self._tags_at(5))
+        path = os.path.join(self.env.path, 'files', 'history.jsonl')
+        with open(path) as f:
+            self.assertEquals(2, len(f.readlines()))
+
+    def test_compact_batches(self):
+        self.env.config.set('tags', 'history_batch_size', 1)
+        stats, start = self.compactor.compact(limit=1, max_changes=1)
+        self.assertEquals(('wiki', 'SandBox'), start)
+        self.assertEquals(4, len(self._changes()))
+        stats, start = self.compactor.compact(start=start, max_changes=1)
+        self.assertEquals(None, start)
+        self.assertEquals(dict(resources=1, compacted=1, removed=3,
+                               archived=0), stats)
+        self.assertEquals([('bob', 'b', 'b c')], self._changes())
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PlanCompactionTestCase))
+    suite.addTest(unittest.makeSuite(TagHistoryCompactorTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
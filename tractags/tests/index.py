@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.cache import CacheManager
+from trac.perm import PermissionSystem
+from trac.resource import Resource
+from trac.test import EnvironmentStub, MockRequest
+
+from tractags.api import TagSystem
+from tractags.db import TagSetup
+from tractags.index import CompletionIndex, TagCompletionIndex, TagIndex
+from tractags.index import read_snapshot, write_snapshot
+from tractags.model import tag_resource, tag_resources
+from tractags.query import Query
+
+
+class _BaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+
+        self.perms = PermissionSystem(self.env)
+        self.req = MockRequest(self.env, authname='editor')
+        self.tag_s = TagSystem(self.env)
+
+        # Populate table with initial test data.
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, [('wiki', 'PageA', 'tag1'),
+                      ('wiki', 'PageA', 'tag2'),
+                      ('wiki', 'PageB', 'tag2'),
+                      ('wiki', 'PageC', 'tag3'),
+                      ('wiki', 'PageTemplates/Tpl', 'tag1'),
+                      ('ticket', '1', 'tag1')])
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+
+class TagIndexTestCase(_BaseTestCase):
+
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        self.index = TagIndex(self.env)
+
+    # Helpers
+
+    def _match(self, query):
+        return [name for name, tags
+                in self.index.query('wiki', Query(query))]
+
+    def _query(self, query):
+        return [(r.realm, r.id, sorted(tags))
+                for r, tags in self.tag_s.query(self.req, query)]
+
+    # Tests
+
+    def test_match_terms(self):
+        self.assertEquals(['PageA', 'PageTemplates/Tpl'], self._match('tag1'))
+        self.assertEquals(['PageA'], self._match('tag1 tag2'))
+        self.assertEquals(['PageA', 'PageB', 'PageC'],
+                          self._match('tag2 or tag3'))
+        self.assertEquals(['PageB'], self._match('tag2 -tag1'))
+        self.assertEquals([], self._match('missing'))
+
+    def test_match_realm(self):
+        self.assertEquals(['PageA', 'PageB', 'PageC', 'PageTemplates/Tpl'],
+                          self._match('realm:wiki'))
+        self.assertEquals([], self._match('tag1 realm:ticket'))
+        self.assertEquals(['PageC'], self._match('-tag1 -tag2'))
+
+    def test_match_unindexable(self):
+        self.assertEquals(None, self.index.query('wiki', Query('type:task')))
+
+    def test_query_equals_row_evaluation(self):
+        queries = ('tag1', 'tag1 or tag3', 'tag2 -tag1', 'realm:wiki',
+                   'tag1 realm:ticket', '(tag1) (realm:wiki or realm:ticket)',
+                   '-tag3')
+        expected = [self._query(q) for q in queries]
+        self.env.config.set('tags', 'query_index', True)
+        self.assertEquals(expected, [self._query(q) for q in queries])
+
+    def test_invalidated_on_change(self):
+        self.env.config.set('tags', 'query_index', True)
+        self.assertEquals([('wiki', 'PageC', ['tag3'])], self._query('tag3'))
+        tag_resource(self.env, Resource('wiki', 'PageB'), tags=['tag3'])
+        self.assertEquals([('wiki', 'PageB', ['tag3']),
+                           ('wiki', 'PageC', ['tag3'])], self._query('tag3'))
+
+    def test_snapshot_roundtrip(self):
+        indexes = self.index._build_indexes()
+        path = os.path.join(self.env.path, 'files', 'test.snapshot')
+        write_snapshot(path, 42, indexes)
+        generation, loaded = read_snapshot(path)
+        self.assertEquals(42, generation)
+        self.assertEquals(sorted(indexes), sorted(loaded))
+        for realm, index in indexes.iteritems():
+            self.assertEquals(index.names, list(loaded[realm].names))
+            self.assertEquals(index.tags, list(loaded[realm].tags))
+            self.assertEquals(index.postings, dict(loaded[realm].postings))
+            self.assertEquals(index.match(Query('tag1 or -tag3')),
+                              loaded[realm].match(Query('tag1 or -tag3')))
+
+    def test_snapshot_reused_with_changes(self):
+        self.env.config.set('tags', 'query_index', True)
+        self.env.config.set('tags', 'query_index_snapshot', True)
+        expected = self._query('tag1')
+        self.assertTrue(os.path.isfile(self.index.snapshot_path))
+        cursor = read_snapshot(self.index.snapshot_path)[0]
+
+        # Simulate another process, that may not touch the database.
+        def _build_indexes(realm=None):
+            self.fail("Index rebuilt despite current snapshot")
+        CacheManager(self.env)._cache.clear()
+        CacheManager(self.env).reset_metadata()
+        self.index._loaded = None
+        self.index._build_indexes = _build_indexes
+        self.assertEquals(expected, self._query('tag1'))
+
+        # Changes are applied to the snapshot.
+        tag_resource(self.env, Resource('wiki', 'PageC'), tags=['tag1'])
+        CacheManager(self.env)._cache.clear()
+        CacheManager(self.env).reset_metadata()
+        self.index._loaded = None
+        self.assertEquals(expected + [('wiki', 'PageC', ['tag1'])],
+                          self._query('tag1'))
+        self.assertEquals(cursor, read_snapshot(self.index.snapshot_path)[0])
+        # Only the changes are held over the mapped snapshot.
+        index = self.index._realm_indexes['wiki']
+        self.assertEquals(['tag1', 'tag3'], sorted(index.postings.changes))
+        self.assertEquals([2], list(index.tags.changes))
+        del self.index._build_indexes
+        built = self.index._build_indexes()['wiki']
+        self.assertEquals(built.match(Query('realm:wiki')),
+                          index.match(Query('realm:wiki')))
+
+    def test_updated_from_change_feed(self):
+        self.env.config.set('tags', 'query_index', True)
+        self.assertEquals(['PageA', 'PageTemplates/Tpl'], self._match('tag1'))
+
+        def _build_indexes(realm=None):
+            self.fail("Index rebuilt instead of updated")
+        self.index._build_indexes = _build_indexes
+        tag_resources(self.env, 'wiki', [('PageA', []), ('PageB', ['tag1']),
+                                         ('PageD', ['tag1', 'tag3'])])
+        self.assertEquals(['PageB', 'PageD', 'PageTemplates/Tpl'],
+                          self._match('tag1'))
+        self.assertEquals(['PageC', 'PageD'], self._match('tag3'))
+        self.assertEquals(['PageB', 'PageC', 'PageD', 'PageTemplates/Tpl'],
+                          self._match('realm:wiki'))
+        self.assertEquals([], self._match('tag2'))
+        self.assertEquals(['PageC'], self._match('-tag1'))
+
+        # Equals the index built entirely.
+        del self.index._build_indexes
+        updated = self.index._realm_indexes['wiki'].compacted()
+        built = self.index._build_indexes()['wiki']
+        self.assertEquals((built.names, built.tags, built.postings),
+                          (updated.names, updated.tags, updated.postings))
+
+    def test_snapshot_stale_after_disabled_change(self):
+        self.env.config.set('tags', 'query_index', True)
+        self.env.config.set('tags', 'query_index_snapshot', True)
+        self.assertEquals([('wiki', 'PageC', ['tag3'])], self._query('tag3'))
+        self.env.config.set('tags', 'query_index', False)
+        tag_resource(self.env, Resource('wiki', 'PageB'), tags=['tag3'])
+        self.env.config.set('tags', 'query_index', True)
+        expected = [('wiki', 'PageB', ['tag3']), ('wiki', 'PageC', ['tag3'])]
+        self.assertEquals(expected, self._query('tag3'))
+        # Another process loads the snapshot then.
+        CacheManager(self.env)._cache.clear()
+        CacheManager(self.env).reset_metadata()
+        self.assertEquals(expected, self._query('tag3'))
+
+
+class CompletionIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = CompletionIndex({'alpha': 3, 'Alpine': 1, 'palp': 2,
+                                      'beta': 5, 'al': 1})
+
+    def test_complete_prefix(self):
+        self.assertEquals([('alpha', 3), ('Alpine', 1)],
+                          self.index.complete('alp'))
+        self.assertEquals([('alpha', 3), ('Alpine', 1), ('al', 1)],
+                          self.index.complete('AL'))
+        self.assertEquals([], self.index.complete('alpx'))
+
+    def test_complete_contains(self):
+        self.assertEquals([('alpha', 3), ('palp', 2), ('Alpine', 1)],
+                          self.index.complete('alp', contains=True))
+        self.assertEquals([('alpha', 3), ('Alpine', 1)],
+                          self.index.complete('alph', contains=True) +
+                          self.index.complete('pine', contains=True))
+        self.assertEquals([('beta', 5), ('alpha', 3), ('palp', 2),
+                           ('Alpine', 1), ('al', 1)],
+                          self.index.complete('a', contains=True))
+        self.assertEquals([], self.index.complete('pla', contains=True))
+
+    def test_complete_limit(self):
+        self.assertEquals([('beta', 5), ('alpha', 3)],
+                          self.index.complete('', 2))
+        self.assertEquals([('alpha', 3)], self.index.complete('a', 1))
+
+
+class TagCompletionIndexTestCase(_BaseTestCase):
+
+    def setUp(self):
+        _BaseTestCase.setUp(self)
+        self.completion = TagCompletionIndex(self.env)
+
+    def test_complete(self):
+        self.assertEquals([('tag1', 2), ('tag2', 2), ('tag3', 1)],
+                          self.completion.complete(self.req, 'TAG'))
+        self.assertEquals(['tag1', 'tag2', 'tag3'],
+                          self.completion.get_all_tags(self.req))
+
+    def test_complete_permitted_realms(self):
+        self.perms.revoke_permission('anonymous', 'WIKI_VIEW')
+        self.perms.grant_permission('editor', 'WIKI_VIEW')
+        req = MockRequest(self.env, authname='anonymous')
+        self.assertEquals([('tag1', 1)],
+                          self.completion.complete(req, 'tag'))
+        self.assertEquals([('tag1', 2)],
+                          self.completion.complete(self.req, 'tag', 1))
+
+    def test_suggest_frequent(self):
+        self.assertEquals(['tag1', 'tag2', 'tag3'],
+                          self.completion.suggest(self.req, 'tag'))
+        self.assertEquals(['tag1'],
+                          self.completion.suggest(self.req, '1', 5, True))
+
+    def test_suggest_related(self):
+        tag_resource(self.env, Resource('wiki', 'PageD'),
+                     tags=['tag3', 'tag4'])
+        self.assertEquals(['tag1', 'tag2', 'tag3', 'tag4'],
+                          self.completion.suggest(self.req, 'tag'))
+        self.assertEquals(['tag4', 'tag1', 'tag2'],
+                          self.completion.suggest(self.req, 'tag',
+                                                  context=['tag3']))
+
+    def test_suggest_recent(self):
+        tag_resource(self.env, Resource('wiki', 'PageD'), author='editor',
+                     tags=['tag4'], log=True)
+        self.assertEquals(['tag4', 'tag1', 'tag2', 'tag3'],
+                          self.completion.suggest(self.req, 'tag'))
+        req = MockRequest(self.env, authname='other')
+        self.assertEquals(['tag1', 'tag2', 'tag3', 'tag4'],
+                          self.completion.suggest(req, 'tag'))
+
+    def test_recent_tags(self):
+        self.env.db_transaction("""
+            INSERT INTO tags_change
+             (tagspace, name, time, author, oldtags, newtags)
+            VALUES ('wiki', 'PageA', 1, 'editor', 'tag1', 'tag1, tag2')
+            """)
+        data = self.completion._data
+        self.assertEquals({'tag2': 1.0}, self.completion._get_recent_tags(
+            'editor', set(['wiki']), data))
+        # Only the most recently active authors are kept.
+        self.completion.recent_authors = 1
+        self.completion._get_recent_tags('other', set(['wiki']), data)
+        self.assertEquals(['other'], list(data.recent))
+
+    def test_invalidated_on_change(self):
+        self.assertEquals([('tag3', 1)],
+                          self.completion.complete(self.req, 'tag3'))
+        tag_resource(self.env, Resource('wiki', 'PageB'), tags=['tag3'])
+        self.assertEquals([('tag3', 2)],
+                          self.completion.complete(self.req, 'tag3'))
+
+    def test_updated_from_change_feed(self):
+        data = self.completion._data
+        tag_resources(self.env, 'wiki', [('PageA', ['tag1', 'tag3']),
+                                         ('PageB', []),
+                                         ('PageTemplates/New', ['tag4'])])
+        updated = self.completion._data
+        self.assertEquals({'tag1': 1, 'tag3': 2}, updated.realm_counts['wiki'])
+        self.assertEquals({'tag1': 1, 'tag2': 2, 'tag3': 1},
+                          data.realm_counts['wiki'])
+        self.assertTrue(updated.realm_tags['ticket'] is
+                        data.realm_tags['ticket'])
+        # Equals data read entirely.
+        self.completion._loaded = None
+        del self.completion._data
+        rebuilt = self.completion._data
+        for name in ('realm_tags', 'realm_counts', 'realm_pairs'):
+            self.assertEquals(getattr(rebuilt, name), getattr(updated, name))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TagIndexTestCase))
+    suite.addTest(unittest.makeSuite(CompletionIndexTestCase))
+    suite.addTest(unittest.makeSuite(TagCompletionIndexTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+from datetime import datetime
+import tempfile
+import unittest
+
+from trac.core import TracError
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc
+
+from tractags.db import TagSetup
+from tractags.jobs import TagJobQueue
+from tractags.ticket import TicketTagProvider
+
+
+class TagJobQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+
+        self.queue = TagJobQueue(self.env)
+        self.env.config.set('tags', 'job_batch_size', 2)
+        for keywords in ('tag1 tag2', 'tag2', 'tag3', 'tag1'):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'summary'
+            ticket['reporter'] = 'admin'
+            ticket['status'] = 'new'
+            ticket['keywords'] = keywords
+            ticket.insert()
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    def _run_all(self):
+        states = []
+        while True:
+            job = self.queue.run_batch()
+            if job is None:
+                return states
+            states.append((job['id'], job['done'], job['state']))
+
+    def _tags(self):
+        tags = {}
+        for name, tag in self.env.db_query("""
+                SELECT name, tag FROM tags WHERE tagspace='ticket'
+                """):
+            tags.setdefault(name, set()).add(tag)
+        return tags
+
+    # Tests
+
+    def test_enqueue(self):
+        id = self.queue.enqueue('compact', {'realm': 'wiki'})
+        self.assertEquals(id, self.queue.enqueue('compact', {'realm': 'wiki'}))
+        self.assertNotEquals(id, self.queue.enqueue('compact'))
+        self.assertRaises(TracError, self.queue.enqueue, 'unknown')
+        job = self.queue.get_job(id)
+        self.assertEquals(('compact', {'realm': 'wiki'}, 'pending', 0),
+                          (job['kind'], job['args'], job['state'],
+                           job['done']))
+
+    def test_ticket_replace(self):
+        id = self.queue.enqueue('ticket_replace',
+                                dict(old_tags=['tag1', 'tag2'],
+                                     new_tag='tag4', author='editor'))
+        self.assertEquals(3, self.queue.get_job(id)['total'])
+        self.assertEquals([(id, 2, 'pending'), (id, 3, 'done')],
+                          self._run_all())
+        self.assertEquals({'1': set(['tag4']), '2': set(['tag4']),
+                           '3': set(['tag3']), '4': set(['tag4'])},
+                          self._tags())
+        self.assertEquals('tag4', Ticket(self.env, 1)['keywords'])
+
+    def test_ticket_resync(self):
+        self.env.db_transaction("DELETE FROM tags")
+        self.env.db_transaction("""
+            UPDATE ticket SET keywords='tag5' WHERE id=4
+            """)
+        id = self.queue.enqueue('ticket_resync')
+        self.assertEquals([(id, 2, 'pending'), (id, 4, 'pending'),
+                           (id, 4, 'done')], self._run_all())
+        self.assertEquals({'1': set(['tag1', 'tag2']), '2': set(['tag2']),
+                           '3': set(['tag3']), '4': set(['tag5'])},
+                          self._tags())
+
+    def test_resync_queued_on_load(self):
+        self.env.config.set('tags', 'ticket_sync_on_load', False)
+        self.env.disable_component(TicketTagProvider)
+        self.env.enable_component(TicketTagProvider)
+        TicketTagProvider(self.env)
+        self.assertEquals(['ticket_resync'],
+                          [job['kind'] for job in self.queue.get_jobs()])
+        # Loading the provider again doesn't queue another resync.
+        self.env.db_transaction("UPDATE tags_job SET state='running'")
+        self.env.disable_component(TicketTagProvider)
+        self.env.enable_component(TicketTagProvider)
+        TicketTagProvider(self.env)
+        self.assertEquals(1, len(self.queue.get_jobs()))
+
+    def test_failed_and_cancelled(self):
+        id = self.queue.enqueue('index_rebuild')
+        self.env.db_transaction("""
+            UPDATE tags_job SET kind='unknown' WHERE id=%s
+            """, (id,))
+        self.assertEquals([(id, 0, 'failed')], self._run_all())
+        self.assertEquals("TracError: Unknown tag job 'unknown'",
+                          self.queue.get_job(id)['message'])
+        self.assertFalse(self.queue.cancel(id))
+        id = self.queue.enqueue('index_rebuild')
+        self.assertTrue(self.queue.cancel(id))
+        self.assertEquals([], self._run_all())
+
+    def test_prune(self):
+        done = self.queue.enqueue('index_rebuild')
+        self._run_all()
+        pending = self.queue.enqueue('index_rebuild')
+        self.env.db_transaction("UPDATE tags_job SET changed=0")
+        self.assertEquals(0, self.queue.prune(datetime(1970, 1, 1,
+                                                       tzinfo=utc)))
+        self.assertEquals(1, self.queue.prune(datetime.now(utc)))
+        self.assertEquals([pending],
+                          [job['id'] for job in self.queue.get_jobs()])
+        self.assertEquals(None, self.queue.get_job(done))
+
+    def test_unique_enqueued_once(self):
+        id = self.queue.enqueue('ticket_resync', unique=True)
+        # Another process queues the job after the check of this one.
+        find_job = self.queue._find_job
+        calls = []
+
+        def _find_job(kind, args, unique):
+            calls.append(kind)
+            if len(calls) > 1:
+                return find_job(kind, args, unique)
+        self.queue._find_job = _find_job
+        self.assertEquals(id, self.queue.enqueue('ticket_resync',
+                                                 unique=True))
+        self.assertEquals([id], [job['id'] for job in self.queue.get_jobs()])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TagJobQueueTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -26,6 +26,8 @@ def _revert_tractags_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS tags")
         db("DROP TABLE IF EXISTS tags_change")
+        db("DROP TABLE IF EXISTS tags_job")
+        db("DROP TABLE IF EXISTS tags_feed")
         db("DELETE FROM system WHERE name='tags_version'")
         db("DELETE FROM permission WHERE action %s" % db.like(),
            ('TAGS_%',))
@@ -257,6 +259,21 @@ class TagCloudMacroTestCase(_BaseTestCase):
         self.assertEquals('No tags found', result)
 
 
+    def test_limit(self):
+        self._insert_tags('wiki',   'CamelCase',     ('blah', 'foo', 'bar'))
+        self._insert_tags('wiki',   'InterMapTxt',   ('blah', 'foo'))
+        self._insert_tags('ticket', '1',             ('blah',))
+
+        result = unicode(self._expand_macro('limit=2'))
+        self.assertTrue('">blah</a>' in result, repr(result))
+        self.assertTrue('">foo</a>' in result, repr(result))
+        self.assertFalse('">bar</a>' in result, repr(result))
+
+        result = unicode(self._expand_macro('realm=wiki,limit=1'))
+        self.assertTrue('">blah</a>' in result, repr(result))
+        self.assertFalse('">foo</a>' in result, repr(result))
+
+
 class QueryRealmsTestCase(unittest.TestCase):
     def test_query_realms(self):
         all_realms = ['ticket', 'wiki']
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import shutil
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub, Mock, MockRequest
+
+from tractags.api import TagSystem
+from tractags.db import TagSetup
+from tractags.metrics import QueryTrace, SlowTagQueryLog, TagMetrics
+from tractags.metrics import TagMetricsRecorder, percentile, trace_sql
+
+
+class TagMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'WikiStart', 'tag1'), ('wiki', 'SandBox', 'tag2')])
+        self.metrics = TagMetrics(self.env)
+        self.recorder = TagMetricsRecorder(self.env)
+        self.req = MockRequest(self.env, authname='editor')
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    def _timings(self):
+        return dict((name, samples) for name, samples, percentiles, max_
+                    in self.recorder.get_timings())
+
+    # Tests
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals([1, 50, 90, 99, 100],
+                          [percentile(values, p) for p in (0, 50, 90, 99, 100)])
+        self.assertEquals(7, percentile([7], 99))
+        self.assertEquals(None, percentile([], 50))
+
+    def test_no_sinks(self):
+        items = [1, 2]
+        self.assertEquals(items, list(self.metrics.timed('name', items)))
+        with self.metrics.timer('name'):
+            self.metrics.count('name')
+        TagSystem(self.env).get_all_tags(self.req)
+        self.assertEquals([], self.recorder.get_timings())
+        self.assertEquals([], self.recorder.get_counts())
+
+    def test_sinks_cached(self):
+        self.assertEquals([], self.metrics._get_sinks())
+        self.env.config.set('tags', 'metrics_sinks', 'TagMetricsRecorder')
+        sinks = self.metrics._get_sinks()
+        self.assertEquals([self.recorder], sinks)
+        self.assertTrue(sinks is self.metrics._get_sinks())
+        self.env.config.set('tags', 'metrics_sinks', '')
+        self.assertEquals([], self.metrics._get_sinks())
+
+    def test_recorder(self):
+        self.env.config.set('tags', 'metrics_sinks', 'TagMetricsRecorder')
+        self.env.config.set('tags', 'metrics_samples', 2)
+        for i in xrange(3):
+            self.assertEquals([1, 2], list(self.metrics.timed('name', [1, 2],
+                                                              'items')))
+        self.metrics.count('items', 4)
+        self.assertEquals([('name', 2)],
+                          [timing[:2] for timing in
+                           self.recorder.get_timings()])
+        self.assertEquals([('items', 10)], self.recorder.get_counts())
+        self.recorder.reset()
+        self.assertEquals([], self.recorder.get_counts())
+
+    def test_hot_paths(self):
+        self.env.config.set('tags', 'metrics_sinks', 'TagMetricsRecorder')
+        tag_system = TagSystem(self.env)
+        self.assertEquals(1, len(list(tag_system.query(self.req,
+                                                       'tag1 realm:wiki'))))
+        tag_system.get_all_tags(self.req, ['wiki'])
+        self.assertEquals(dict(get_all_tags=1, query=1,
+                               **{'query.wiki': 1, 'tag_frequency.wiki': 1,
+                                  'tagged_resources.wiki': 1}),
+                          self._timings())
+        self.assertEquals([('perm_checks.wiki', 1),
+                           ('query.wiki.matched', 1)],
+                          self.recorder.get_counts())
+
+
+class SlowTagQueryLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        setup = TagSetup(self.env)
+        # Current tractags schema is setup with enabled component anyway.
+        #   Revert these changes for getting default permissions inserted.
+        self._revert_tractags_schema_init()
+        setup.upgrade_environment()
+
+        self.env.db_transaction.executemany("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES (%s,%s,%s)
+            """, [('wiki', 'WikiStart', 'tag1'), ('wiki', 'SandBox', 'tag2')])
+        self.query_log = SlowTagQueryLog(self.env)
+        self.messages = []
+        self.query_log.log = Mock(warning=self.messages.append)
+        self.req = MockRequest(self.env, authname='editor')
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    # Helpers
+
+    def _revert_tractags_schema_init(self):
+        with self.env.db_transaction as db:
+            db("DROP TABLE IF EXISTS tags")
+            db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
+            db("DELETE FROM system WHERE name='tags_version'")
+            db("DELETE FROM permission WHERE action %s" % db.like(),
+               ('TAGS_%',))
+
+    # Tests
+
+    def test_disabled(self):
+        self.assertEquals(None, self.query_log.start('tag1'))
+        with self.query_log.trace('tag1') as trace:
+            self.assertEquals(None, trace)
+        self.assertEquals(1, len(list(TagSystem(self.env).query(self.req,
+                                                                'tag1'))))
+        self.assertEquals([], self.messages)
+
+    def test_trace(self):
+        trace = QueryTrace('tag1')
+        trace_sql('SELECT 1')
+        with trace:
+            trace_sql('SELECT %s', [1])
+            trace_sql('SELECT %s', [2])
+        self.assertEquals([('SELECT %s', [1])], trace.statements)
+        self.assertEquals([1, 2], list(trace.iterate([1, 2])))
+
+    def test_query_logged(self):
+        self.env.config.set('tags', 'slow_query_threshold', 1000)
+        tag_system = TagSystem(self.env)
+        trace = self.query_log.start(u'tag1 realm:wiki')
+        providers = tag_system._query_providers(self.req, 'tag1 realm:wiki',
+                                                trace=trace)
+        records = [record for provider, records in providers
+                          for record in trace.iterate(records)]
+        self.assertEquals(['WikiStart'], [record.id for record in records])
+        self.assertEquals((['wiki'], 1, 1),
+                          (trace.realms, trace.candidates, trace.matched))
+        self.assertEquals(2, len(trace.statements))
+        self.query_log.finish(trace)
+        self.assertEquals([], self.messages)
+        trace.seconds = 1.5
+        self.query_log.finish(trace)
+        lines = self.messages[0].splitlines()
+        self.assertEquals("Slow tag query 'tag1 realm:wiki' in realms wiki: "
+                          "1500 ms, 1 candidates, 1 matched", lines[0])
+        self.assertTrue(lines[1].startswith('  SQL: SELECT DISTINCT name'))
+        self.assertTrue([line for line in lines
+                         if line.startswith('  Plan: ') and 'tags' in line])
+
+    def test_query_page_and_timeline_traced(self):
+        self.env.config.set('tags', 'slow_query_threshold', 1)
+        self.query_log.finish = lambda trace: self.messages.append(trace)
+        TagSystem(self.env).query_tagged_page(self.req, 'tag1', 10)
+        with self.query_log.trace('tag2', ['wiki']) as trace:
+            trace.matched = 1
+        self.assertEquals([('tag1', 1), ('tag2', 1)],
+                          [(trace.query, trace.matched)
+                           for trace in self.messages])
+
+    def test_query_closed_early_traced(self):
+        self.env.config.set('tags', 'slow_query_threshold', 1)
+        self.query_log.finish = lambda trace: self.messages.append(trace)
+        self.assertTrue(TagSystem(self.env).exists(self.req, 'tag1 or tag2'))
+        self.assertEquals([('tag1 or tag2', 1)],
+                          [(trace.query, trace.matched)
+                           for trace in self.messages])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TagMetricsTestCase))
+    suite.addTest(unittest.makeSuite(SlowTagQueryLogTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -9,13 +9,21 @@
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
 
 from trac.perm import PermissionCache, PermissionSystem
 from trac.resource import Resource
 from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import to_utimestamp, utc
 
 from tractags.db import TagSetup
-from tractags.model import resource_tags, tag_resource, tagged_resources
+from tractags.model import FEED_GRACE_PERIOD, FEED_MAX_NAMES, TagPool
+from tractags.model import TaggedResource, changed_resources, dump_rows
+from tractags.model import feed_cursor, load_rows, prune_feed
+from tractags.model import resource_tags
+from tractags.model import replace_tags, resources_tags, tag_feed
+from tractags.model import tag_frequency, tag_resource, tag_resources
+from tractags.model import tagged_resources
 from tractags.wiki import WikiTagProvider
 
 
@@ -52,6 +60,8 @@ class TagModelTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -92,12 +102,162 @@ class TagModelTestCase(unittest.TestCase):
                                               self.realm, tags)],
                          [(resource, tags)])
 
+    def test_tag_frequency_mincount(self):
+        tag_resource(self.env, Resource(self.realm, 'TaggedPage'),
+                     tags=['tag1', 'tag2'])
+        self.assertEquals([('tag1', 2), ('tag2', 1)],
+                          sorted(tag_frequency(self.env, self.realm)))
+        self.assertEquals([('tag1', 2)],
+                          list(tag_frequency(self.env, self.realm,
+                                             mincount=2)))
+
+    def test_resources_tags(self):
+        tag_resource(self.env, Resource(self.realm, 'TaggedPage'),
+                     tags=['tag1', 'tag2'])
+        self.assertEquals({'WikiStart': set(['tag1']),
+                           'TaggedPage': set(['tag1', 'tag2'])},
+                          resources_tags(self.env, self.realm,
+                                         ['WikiStart', 'TaggedPage',
+                                          'UntaggedPage']))
+
+    def test_tag_resources(self):
+        items = [('WikiStart', ['tag1', 'tag2']), ('TaggedPage', ['tag3']),
+                 ('UntaggedPage', []), ('OtherPage', ['tag1'])]
+        self.assertEquals(3, tag_resources(self.env, self.realm, items,
+                                           author='editor', log=True,
+                                           batch_size=2))
+        self.assertEquals(dict(WikiStart=set(['tag1', 'tag2']),
+                               TaggedPage=set(['tag3']),
+                               OtherPage=set(['tag1'])), self._tags())
+        items = [('WikiStart', ['tag2']), ('TaggedPage', ['tag3'])]
+        self.assertEquals(1, tag_resources(self.env, self.realm, items,
+                                           log=True))
+        self.assertEquals([('TaggedPage', '', 'tag3'),
+                           ('WikiStart', 'tag1', 'tag1 tag2'),
+                           ('WikiStart', 'tag1 tag2', 'tag2')],
+                          sorted(self.env.db_query("""
+                              SELECT name, oldtags, newtags FROM tags_change
+                              WHERE name IN ('TaggedPage', 'WikiStart')
+                              """)))
+
+    def test_tag_resources_duplicates(self):
+        items = [('NewPage', ['tag1']), ('OtherPage', ['tag2']),
+                 ('NewPage', ['tag3'])]
+        self.assertEquals(2, tag_resources(self.env, self.realm, items,
+                                           log=True, when=1, batch_size=1))
+        self.assertEquals(set(['tag3']), self._tags()['NewPage'])
+        self.assertEquals([('', 'tag3')], self.env.db_query("""
+            SELECT oldtags, newtags FROM tags_change WHERE name='NewPage'
+            """))
+
+    def test_dump_load_rows(self):
+        rows = list(dump_rows(self.env, 'tags'))
+        self.assertEquals([('wiki', 'WikiStart', 'tag1')], rows)
+        self.env.db_transaction("DELETE FROM tags")
+        self.assertEquals(4, load_rows(self.env, 'tags',
+                                       rows + [('wiki', 'A', 'tag2'),
+                                               ('wiki', 'A', 'tag3'),
+                                               ('wiki', 'A', 'tag2')],
+                                       batch_size=2))
+        self.assertEquals(dict(WikiStart=set(['tag1']),
+                               A=set(['tag2', 'tag3'])), self._tags())
+        self.assertEquals([('wiki', 'A', 'tag2'), ('wiki', 'A', 'tag3')],
+                          list(dump_rows(self.env, 'tags', 'wiki'))[:2])
+        self.assertEquals([], list(dump_rows(self.env, 'tags_change',
+                                             'ticket')))
+
+    def test_replace_tags(self):
+        tag_resources(self.env, self.realm,
+                      [('TaggedPage', ['tag2', 'tag3']),
+                       ('OtherPage', ['tag2']), ('PageTemplates/Tpl', ['tag3'])])
+        self.assertEquals(2, replace_tags(self.env, self.realm,
+                                          ['tag1', 'tag3'], 'tag2',
+                                          author='editor', log=True,
+                                          filter=["name NOT LIKE 'Page%%'"]))
+        self.assertEquals(dict(WikiStart=set(['tag2']),
+                               TaggedPage=set(['tag2']),
+                               OtherPage=set(['tag2']),
+                               **{'PageTemplates/Tpl': set(['tag3'])}),
+                          self._tags())
+        self.assertEquals([('TaggedPage', 'tag2 tag3', 'tag2'),
+                           ('WikiStart', 'tag1', 'tag2')],
+                          sorted(self.env.db_query("""
+                              SELECT name, oldtags, newtags FROM tags_change
+                              WHERE author='editor'
+                              """)))
+        self.assertEquals(3, replace_tags(self.env, self.realm, ['tag2']))
+        self.assertEquals({'PageTemplates/Tpl': set(['tag3'])}, self._tags())
+        self.assertEquals(0, replace_tags(self.env, self.realm, ['tag2']))
+
     def test_reparent(self):
         resource = Resource(self.realm, 'TaggedPage')
         old_name = 'WikiStart'
         tag_resource(self.env, resource, 'WikiStart', self.req.authname)
         self.assertEquals(dict(TaggedPage=set(['tag1'])), self._tags())
 
+    def test_tag_feed(self):
+        self.assertEquals(([], 0), tag_feed(self.env))
+        tag_resources(self.env, self.realm,
+                      [('TaggedPage', ['tag1']), ('WikiStart', [])])
+        replace_tags(self.env, self.realm, ['tag1'], 'tag2')
+        load_rows(self.env, 'tags', [('ticket', '1', 'tag1')])
+        # Replacing tags of a resource is recorded once.
+        tag_resource(self.env, Resource(self.realm, 'TaggedPage'),
+                     tags=['tag3'])
+        feed, cursor = tag_feed(self.env)
+        self.assertEquals(set([('wiki', 'TaggedPage'), ('wiki', 'WikiStart')]),
+                          set(row[1:] for row in feed[:2]))
+        self.assertEquals([('wiki', 'TaggedPage'), ('ticket', ''),
+                           ('wiki', 'TaggedPage')],
+                          [row[1:] for row in feed[2:]])
+        self.assertEquals(feed[-1][0], cursor)
+        self.assertEquals((feed[2:3], feed[2][0]),
+                          tag_feed(self.env, feed[1][0], 1))
+        self.assertEquals(([], cursor), tag_feed(self.env, cursor))
+
+    def test_tag_feed_gap(self):
+        tag_resources(self.env, self.realm, [('TaggedPage', ['tag1'])])
+        feed, cursor = tag_feed(self.env)
+        # A concurrent transaction may still commit a change in the gap.
+        now = to_utimestamp(datetime.now(utc))
+        self.env.db_transaction("""
+            INSERT INTO tags_feed (id, tagspace, name, time)
+            VALUES (%s,'wiki','WikiStart',%s)
+            """, (cursor + 2, now))
+        self.assertEquals(([(cursor + 2, 'wiki', 'WikiStart')], cursor),
+                          tag_feed(self.env, cursor))
+        # The gap is skipped after the grace period.
+        self.env.db_transaction("""
+            UPDATE tags_feed SET time=%s WHERE id=%s
+            """, (now - (FEED_GRACE_PERIOD + 1) * 1000000, cursor + 2))
+        self.assertEquals(cursor + 2, tag_feed(self.env, cursor)[1])
+
+    def test_prune_feed(self):
+        tag_resources(self.env, self.realm, [('TaggedPage', ['tag1'])])
+        cursor = tag_feed(self.env)[1]
+        tag_resources(self.env, self.realm, [('OtherPage', ['tag1'])])
+        self.assertEquals(0, prune_feed(self.env, datetime(1970, 1, 1,
+                                                           tzinfo=utc)))
+        self.env.db_transaction("""
+            UPDATE tags_feed SET time=0 WHERE id<=%s
+            """, (cursor,))
+        self.assertEquals(cursor, prune_feed(self.env, datetime(2000, 1, 1,
+                                                                tzinfo=utc)))
+        # Cursors before pruned changes get a change to all realms.
+        self.assertEquals(([(cursor, None, '')], cursor), tag_feed(self.env))
+        self.assertEquals((None, None), changed_resources(self.env, 0))
+        self.assertEquals([(cursor + 1, 'wiki', 'OtherPage')],
+                          tag_feed(self.env, cursor)[0])
+        self.assertEquals(cursor, feed_cursor(self.env))
+
+    def test_feed_bulk_change(self):
+        tag_resources(self.env, self.realm,
+                      [('Page%d' % i, ['tag1'])
+                       for i in xrange(FEED_MAX_NAMES + 1)])
+        # A change to the realm per batch.
+        self.assertEquals([('wiki', '')] * 2,
+                          [row[1:] for row in tag_feed(self.env)[0]])
+
     def test_tag_changes(self):
         # Add previously untagged resource.
         resource = Resource(self.realm, 'TaggedPage')
@@ -126,9 +286,32 @@ class TagModelTestCase(unittest.TestCase):
         self.assertEquals(dict(TaggedPage=set(['tag1'])), self._tags())
 
 
+class TaggedResourceTestCase(unittest.TestCase):
+
+    def test_unpack(self):
+        record = TaggedResource('wiki', 'WikiStart', ['tag1', 'tag2'])
+        resource, tags = record
+        self.assertEqual(Resource('wiki', 'WikiStart'), resource)
+        self.assertEqual(frozenset(['tag1', 'tag2']), tags)
+        self.assertEqual('WikiStart', record[0].id)
+        self.assertEqual(tags, record[1])
+        self.assertEqual(2, len(record))
+
+    def test_tag_pool(self):
+        # Build equal, but distinct strings like read from the database.
+        tag1, tag2, tag3 = [u''.join(['tag', str(i)]) for i in (1, 2, 3)]
+        pool = TagPool()
+        first = pool([tag1, tag2])
+        second = pool([u''.join(['tag', '2']), u''.join(['tag', '1'])])
+        self.assertTrue(first is second)
+        third = pool([u''.join(['tag', '2']), tag3])
+        self.assertTrue([t for t in third if t == tag2][0] is tag2)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TagModelTestCase))
+    suite.addTest(unittest.makeSuite(TaggedResourceTestCase))
     return suite
 
 if __name__ == '__main__':
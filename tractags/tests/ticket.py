@@ -20,6 +20,7 @@ from trac.util.text import to_unicode
 
 from tractags.api import TagSystem
 from tractags.db import TagSetup
+from tractags.metrics import TagMetricsRecorder
 from tractags.ticket import TicketTagProvider
 
 
@@ -65,6 +66,8 @@ class TicketTagProviderTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -98,6 +101,17 @@ class TicketTagProviderTestCase(unittest.TestCase):
                                                 set(self.tags[:1]))][0][1],
             set(self.tags))
 
+    def test_filter_tagged_resources_counted(self):
+        self.env.config.set('tags', 'metrics_sinks', 'TagMetricsRecorder')
+        req = MockRequest(self.env, authname='editor')
+        self.provider.fast_permcheck = False
+        self.assertEquals(['1', '2'],
+                          [record.id for record in
+                           self.provider.filter_tagged_resources(
+                               req, [('1', self.tags), ('2', self.tags)])])
+        self.assertEquals([('perm_checks.ticket', 2)],
+                          TagMetricsRecorder(self.env).get_counts())
+
     def test_get_tags(self):
         req = MockRequest(self.env, authname='editor')
         resource = Resource('ticket', 2)
@@ -153,6 +167,61 @@ class TicketTagProviderTestCase(unittest.TestCase):
         tags = self.provider.get_resource_tags(req, ticket.resource)
         self.assertEquals(tags, set(self.tags))
 
+    def test_sync_committed(self):
+        self.env.db_transaction("DELETE FROM tags")
+        self.env.db_transaction("UPDATE ticket SET status='new'")
+        self.assertEquals((1, None), self.provider._fetch_tkt_tags())
+        # A transaction rolled back later doesn't revert the sync.
+        try:
+            with self.env.db_transaction as db:
+                db("UPDATE ticket SET summary='changed'")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals({'1': set(self.tags)}, self._tags())
+        self.assertEquals((0, None), self.provider._fetch_tkt_tags())
+
+    def test_sync_writes_once(self):
+        self._create_ticket(['tag3'], status='new')
+        self.env.db_transaction("DELETE FROM ticket WHERE id=1")
+        self.env.db_transaction("DELETE FROM tags WHERE name='2'")
+        feed = "SELECT COUNT(*) FROM tags_feed"
+        before = self.env.db_query(feed)[0][0]
+        self.assertEquals((1, None), self.provider._fetch_tkt_tags())
+        self.assertEquals({'2': set(['tag3'])}, self._tags())
+        self.assertEquals(before + 1, self.env.db_query(feed)[0][0])
+        # Later syncs, like on every load of the provider, write nothing.
+        self.assertEquals((0, None), self.provider._fetch_tkt_tags())
+        self.assertEquals({'2': set(['tag3'])}, self._tags())
+        self.assertEquals(before + 1, self.env.db_query(feed)[0][0])
+
+    def test_tag_drift(self):
+        self._create_ticket(['tag3'], status='new')
+        self._create_ticket(['tag4'], status='closed')
+        with self.env.db_transaction as db:
+            db("UPDATE ticket SET keywords='tag5' WHERE id=1")
+            db("UPDATE ticket SET keywords='tag6' WHERE id=3")
+            db("DELETE FROM tags WHERE name='2'")
+            db("INSERT INTO tags VALUES ('ticket', '9', 'tag1')")
+        self.assertEquals((2, 2, [(1, set(['tag5']), set(self.tags)),
+                                  (2, set(['tag3']), set())]),
+                          self.provider.get_tag_drift(limit=2))
+        # Tags of closed tickets are dropped like by the initial sync.
+        self.assertEquals((1, None, [(3, set(), set(['tag4']))]),
+                          self.provider.get_tag_drift(2, 2))
+        self.assertEquals(['9'], self.provider.get_orphaned_tags())
+
+        self.assertEquals((3, None, 3), self.provider.reindex_tags())
+        self.assertEquals(1, self.provider.remove_orphaned_tags())
+        self.assertEquals({'1': set(['tag5']), '2': set(['tag3'])},
+                          self._tags())
+        self.assertEquals((3, None, []), self.provider.get_tag_drift())
+
+        # Nothing to fix, if closed tickets aren't ignored.
+        self.env.config.set('tags', 'ignore_closed_tickets', False)
+        self.assertEquals([(3, set(['tag6']), set())],
+                          self.provider.get_tag_drift()[2])
+
 
 def test_suite():
     suite = unittest.TestSuite()
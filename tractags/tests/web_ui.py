@@ -12,6 +12,7 @@ import shutil
 import tempfile
 import unittest
 
+from genshi.input import HTML
 from trac.test import EnvironmentStub, MockPerm, MockRequest
 from trac.perm import PermissionSystem, PermissionError
 from trac.web.api import RequestDone
@@ -51,10 +52,19 @@ class _BaseTestCase(unittest.TestCase):
 
     # Helpers
 
+    def _insert_tags(self, rows):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag)
+                VALUES (%s,%s,%s)
+                """, rows)
+
     def _revert_tractags_schema_init(self):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -89,31 +99,79 @@ class TagInputAutoCompleteTestCase(_BaseTestCase):
         self.env.config.set('tags', 'separator', "' '")
         self.assertEqual(' ', self.tac.separator)
 
-    def test_get_keywords_no_keywords(self):
-        self.assertEqual('', self.tac._get_keywords_string(self.req))
+    def test_get_suggestions_no_keywords(self):
+        self.assertEqual([], self.tac._get_suggestions(self.req, ''))
 
-    def test_get_keywords_define_in_config(self):
+    def test_get_suggestions_define_in_config(self):
         self.env.config.set('tags', 'complete_sticky_tags',
                             'tag1, tag2, tag3')
-        self.assertEqual("'tag1','tag2','tag3'",
-                         self.tac._get_keywords_string(self.req))
+        self.assertEqual(['tag1', 'tag2', 'tag3'],
+                         self.tac._get_suggestions(self.req, ''))
 
-    def test_keywords_are_sorted(self):
+    def test_suggestions_are_sorted(self):
         self.env.config.set('tags', 'complete_sticky_tags',
                             'tagb, tagc, taga')
-        self.assertEqual("'taga','tagb','tagc'",
-                         self.tac._get_keywords_string(self.req))
+        self.assertEqual(['taga', 'tagb', 'tagc'],
+                         self.tac._get_suggestions(self.req, ''))
 
-    def test_keywords_duplicates_removed(self):
+    def test_suggestions_duplicates_removed(self):
         self.env.config.set('tags', 'complete_sticky_tags',
                             'tag1, tag1, tag2')
-        self.assertEqual("'tag1','tag2'",
-                         self.tac._get_keywords_string(self.req))
-
-    def test_keywords_quoted_for_javascript(self):
-        self.env.config.set('tags', 'complete_sticky_tags', 'it\'s, "this"')
-        self.assertEqual('\'\\"this\\"\',\'it\\\'s\'',
-                         self.tac._get_keywords_string(self.req))
+        self.assertEqual(['tag1', 'tag2'],
+                         self.tac._get_suggestions(self.req, ''))
+
+    def test_suggestions_ranked_by_frequency(self):
+        self._insert_tags([('wiki', 'PageA', 'alpha'),
+                           ('wiki', 'PageA', 'beta'),
+                           ('wiki', 'PageB', 'beta'),
+                           ('wiki', 'PageB', 'gamma')])
+        self.env.config.set('tags', 'complete_sticky_tags', 'alpine')
+        self.assertEqual(['beta', 'alpha', 'gamma', 'alpine'],
+                         self.tac._get_suggestions(self.req, ''))
+        self.env.config.set('tags', 'complete_limit', 2)
+        self.assertEqual(['beta', 'alpha'],
+                         self.tac._get_suggestions(self.req, ''))
+
+    def test_suggestions_matching_term(self):
+        self._insert_tags([('wiki', 'PageA', 'alpha'),
+                           ('wiki', 'PageA', 'Alpine'),
+                           ('wiki', 'PageB', 'palp')])
+        self.assertEqual(['Alpine', 'alpha', 'palp'],
+                         self.tac._get_suggestions(self.req, 'alp'))
+        self.env.config.set('tags', 'complete_matchcontains', False)
+        self.assertEqual(['Alpine', 'alpha'],
+                         self.tac._get_suggestions(self.req, 'AL'))
+
+    def test_suggestions_exclude_context(self):
+        self._insert_tags([('wiki', 'PageA', 'alpha'),
+                           ('wiki', 'PageA', 'alpine')])
+        self.env.config.set('tags', 'complete_sticky_tags', 'alps')
+        self.assertEqual(['alpine', 'alps'],
+                         self.tac._get_suggestions(self.req, 'al',
+                                                   ['alpha']))
+
+    def test_suggest_request(self):
+        self._insert_tags([('wiki', 'PageA', 'it\'s'),
+                           ('wiki', 'PageA', '"this"')])
+        req = MockRequest(self.env, path_info='/tags/suggest',
+                          args={'q': ''})
+        self.assertTrue(self.tac.match_request(req))
+        self.assertFalse(self.tag_rh.match_request(req))
+        self.assertRaises(RequestDone, self.tac.process_request, req)
+        self.assertEqual('["\\"this\\"","it\'s"]',
+                         req.response_sent.getvalue())
+        # Without the 'q' argument the path refers to the tag 'suggest'.
+        req = MockRequest(self.env, path_info='/tags/suggest')
+        self.assertFalse(self.tac.match_request(req))
+        self.assertTrue(self.tag_rh.match_request(req))
+
+    def test_filter_stream_quotes_url(self):
+        req = MockRequest(self.env, path_info='/newticket',
+                          script_name="/it's")
+        stream = HTML(u'<html><head></head><body></body></html>')
+        stream = self.tac.filter_stream(req, 'GET', 'ticket.html', stream,
+                                        {})
+        self.assertIn("var url = '/it\\'s/tags/suggest'", stream.render())
 
     def test_implements_irequestfilter(self):
         from trac.web.main import RequestDispatcher
@@ -148,6 +206,17 @@ class TagRequestHandlerTestCase(_BaseTestCase):
                            'tag_body', 'tag_query', 'tag_realms'],
                           sorted(data.keys()))
 
+    def test_get_tag_page_related_tags(self):
+        self._insert_tags([('ticket', '1', 'alpha'),
+                           ('ticket', '1', 'beta')])
+        req = MockRequest(self.env, path_info='/tags/alpha',
+                          authname='reader')
+        data = self.tag_rh.process_request(req)[1]
+        self.assertIn('>beta</a>', unicode(data['related_tags']))
+        self.env.config.set('tags', 'related_tags_limit', 0)
+        data = self.tag_rh.process_request(req)[1]
+        self.assertNotIn('related_tags', data)
+
     def test_get_main_page_no_permission(self):
         req = MockRequest(self.env, path_info='/tags', authname='anonymous')
         self.assertRaises(PermissionError, self.tag_rh.process_request, req)
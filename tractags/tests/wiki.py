@@ -10,21 +10,26 @@
 import shutil
 import tempfile
 import unittest
+from datetime import datetime
 
 from trac.perm import PermissionError, PermissionSystem
 from trac.resource import Resource
 from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
 from trac.wiki.test import wikisyntax_test_suite
 
 from tractags.api import TagSystem
 from tractags.db import TagSetup
-from tractags.wiki import WikiTagProvider
+from tractags.model import tag_resource
+from tractags.wiki import WikiTagInterface, WikiTagProvider
 
 
 def _revert_tractags_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS tags")
         db("DROP TABLE IF EXISTS tags_change")
+        db("DROP TABLE IF EXISTS tags_job")
+        db("DROP TABLE IF EXISTS tags_feed")
         db("DELETE FROM system WHERE name='tags_version'")
         db("DELETE FROM permission WHERE action %s" % db.like(),
            ('TAGS_%',))
@@ -249,6 +254,20 @@ class WikiTagProviderTestCase(unittest.TestCase):
         self.assertEqual(rows[0], ('editor', 'tag1', 'tag2'))
         self.assertEqual(rows[1], ('editor', '', 'tag1'))
 
+    def test_history_merged(self):
+        resource = Resource('wiki', 'TaggedPage')
+        for when, tags in ((10, ['tag1']), (25, ['tag2']), (35, ['tag3'])):
+            tag_resource(self.env, resource, tags=tags, log=True,
+                         when=datetime(2020, 1, 1, 0, when, tzinfo=utc))
+        page_history = [{'version': version, 'comment': '',
+                         'date': datetime(2020, 1, 1, 0, when, tzinfo=utc)}
+                        for version, when in ((3, 40), (2, 30), (1, 20))]
+        data = {'history': list(page_history), 'resource': resource}
+        req = MockRequest(self.env, authname='editor')
+        WikiTagInterface(self.env)._post_process_request_history(req, data)
+        self.assertEquals([3, '*', 2, '*', 1],
+                          [h['version'] for h in data['history']])
+
 
 def wiki_setup(tc):
     tc.env.enable_component('tractags')
@@ -10,12 +10,15 @@ import shutil
 import tempfile
 import unittest
 
+from trac.core import TracError
 from trac.perm import PermissionCache, PermissionSystem
+from trac.resource import Resource
 from trac.test import EnvironmentStub, MockRequest
+from trac.wiki.model import WikiPage
 
 from tractags.api import TagSystem
 from tractags.db import TagSetup
-from tractags.xmlrpc import TagRPC
+from tractags.xmlrpc import MAX_CHANGES, TagRPC
 
 
 class TagRPCTestCase(unittest.TestCase):
@@ -40,6 +43,10 @@ class TagRPCTestCase(unittest.TestCase):
             """)
 
         self.req = MockRequest(self.env, authname='editor')
+        for name in ('WikiStart', 'CamelCase'):
+            page = WikiPage(self.env, name)
+            page.text = 'text'
+            page.save('admin', 'comment')
 
     def tearDown(self):
         self.env.shutdown()
@@ -51,6 +58,8 @@ class TagRPCTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_job")
+            db("DROP TABLE IF EXISTS tags_feed")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -60,6 +69,113 @@ class TagRPCTestCase(unittest.TestCase):
     def test_init(self):
         TagRPC(self.env)
 
+    def test_get_tags_multi(self):
+        self.perms.grant_permission('editor', 'WIKI_VIEW')
+        rpc = TagRPC(self.env)
+        self.assertEquals([dict(realm='wiki', id='WikiStart', tags=['tag1']),
+                           dict(realm='wiki', id='CamelCase', tags=[]),
+                           dict(realm='wiki', id='NoPage',
+                                error="Resource \"<Resource u'wiki:NoPage'>\" "
+                                      "does not exists"),
+                           dict(realm='nope', id='1',
+                                error='Realm "nope" is not taggable')],
+                          rpc.getTagsMulti(self.req, [['wiki', 'WikiStart'],
+                                                      ['wiki', 'CamelCase'],
+                                                      ['wiki', 'NoPage'],
+                                                      ['nope', '1']]))
+
+    def test_malformed_items(self):
+        self.perms.grant_permission('editor', 'WIKI_MODIFY')
+        self.perms.grant_permission('editor', 'WIKI_VIEW')
+        rpc = TagRPC(self.env)
+        results = rpc.getTagsMulti(self.req, [['wiki'], 'WikiStart',
+                                              ['wiki', 'WikiStart']])
+        self.assertEquals(dict(realm='wiki', id='',
+                               error="Invalid item ['wiki'], expected 2 "
+                                     "elements"), results[0])
+        self.assertEquals('', results[1]['realm'])
+        self.assertTrue('error' in results[1])
+        self.assertEquals(dict(realm='wiki', id='WikiStart', tags=['tag1']),
+                          results[2])
+        results = rpc.setTagsMulti(self.req, [['wiki', 'WikiStart'],
+                                              ['wiki', 'CamelCase', ['tag2']]])
+        self.assertEquals(dict(realm='wiki', id='WikiStart',
+                               error="Invalid item ['wiki', 'WikiStart'], "
+                                     "expected 3 elements"), results[0])
+        self.assertEquals(dict(realm='wiki', id='CamelCase', tags=['tag2']),
+                          results[1])
+
+    def test_query(self):
+        self.perms.grant_permission('editor', 'WIKI_VIEW')
+        self.env.db_transaction("""
+            INSERT INTO tags (tagspace, name, tag)
+            VALUES ('wiki', 'CamelCase', 'tag1')
+            """)
+        rpc = TagRPC(self.env)
+        self.assertEquals([['wiki', 'CamelCase', ['tag1']],
+                           ['wiki', 'WikiStart', ['tag1']]],
+                          sorted(rpc.query(self.req, 'tag1')))
+        self.assertEquals(1, len(rpc.query(self.req, 'tag1', 1, 5, 'ids')))
+        self.assertEquals(2, len(rpc.query(self.req, 'tag1', 0, 0, 'ids')[0]))
+
+        page = rpc.queryPage(self.req, 'tag1', 1, 'ids')
+        self.assertEquals([['wiki', 'CamelCase']], page['results'])
+        page = rpc.queryPage(self.req, 'tag1', 1, 'tags', page['token'])
+        self.assertEquals([['wiki', 'WikiStart', ['tag1']]], page['results'])
+        page = rpc.queryPage(self.req, 'tag1', 1, 'tags', page['token'])
+        self.assertEquals(dict(results=[], token=''), page)
+        self.assertRaises(TracError, rpc.queryPage, self.req, 'tag1', 1,
+                          'ids', 'invalid')
+
+    def test_get_changes(self):
+        self.perms.grant_permission('editor', 'WIKI_MODIFY')
+        self.perms.grant_permission('editor', 'WIKI_VIEW')
+        rpc = TagRPC(self.env)
+        rpc.setTags(self.req, 'wiki', 'CamelCase', ['tag2'])
+        result = rpc.getChanges(self.req)
+        self.assertEquals([dict(realm='wiki', id='CamelCase', tags=['tag2'])],
+                          [dict((k, v) for k, v in change.iteritems()
+                                if k != 'seq')
+                           for change in result['changes']])
+        self.assertEquals(result['changes'][0]['seq'], result['cursor'])
+        self.assertEquals(dict(changes=[], cursor=result['cursor']),
+                          rpc.getChanges(self.req, result['cursor']))
+        # Requested number of changes is bounded.
+        calls = []
+        self.tag_s.changes_since = \
+            lambda req, cursor, limit: calls.append(limit) or ([], cursor)
+        rpc.getChanges(self.req, 0, 10 ** 6)
+        rpc.getChanges(self.req, 0, 0)
+        self.assertEquals([MAX_CHANGES, 1], calls)
+
+    def test_set_and_add_tags_multi(self):
+        self.perms.grant_permission('editor', 'WIKI_MODIFY')
+        self.perms.grant_permission('editor', 'WIKI_VIEW')
+        rpc = TagRPC(self.env)
+        self.assertEquals([dict(realm='wiki', id='WikiStart', tags=['tag2']),
+                           dict(realm='wiki', id='CamelCase',
+                                tags=['tag2', 'tag3'])],
+                          rpc.setTagsMulti(self.req, [
+                              ['wiki', 'WikiStart', ['tag2']],
+                              ['wiki', 'CamelCase', ['tag2', 'tag3']]]))
+        self.assertEquals([dict(realm='wiki', id='WikiStart',
+                                tags=['tag1', 'tag2'])],
+                          rpc.addTagsMulti(self.req, [
+                              ['wiki', 'WikiStart', ['tag1']]]))
+        # Failing items don't affect other ones.
+        req = MockRequest(self.env, authname='anonymous')
+        results = rpc.setTagsMulti(req, [['wiki', 'WikiStart', ['tag4']]])
+        self.assertTrue('error' in results[0])
+        self.assertEquals(set(['tag1', 'tag2']),
+                          self.tag_s.get_tags(None, Resource('wiki',
+                                                             'WikiStart')))
+        results = rpc.addTagsMulti(self.req, [
+            ['wiki', 'CamelCase', ['tag1']],
+            ['wiki', 'NoSuchPage', ['tag1']]])
+        self.assertEquals(dict(realm='wiki', id='CamelCase',
+                               tags=['tag1', 'tag2', 'tag3']), results[0])
+        self.assertTrue('error' in results[1])
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -10,8 +10,8 @@
 from itertools import groupby
 
 from trac.config import BoolOption, ListOption
-from trac.core import implements
-from trac.perm import PermissionError
+from trac.core import Component, implements
+from trac.perm import PermissionCache, PermissionError
 from trac.resource import Resource
 from trac.ticket.api import ITicketChangeListener, TicketSystem
 from trac.ticket.model import Ticket
@@ -19,7 +19,11 @@ from trac.util import get_reporter_id
 from trac.util.text import to_unicode
 
 from tractags.api import DefaultTagProvider, _
-from tractags.model import delete_tags
+from tractags.jobs import ITagJobHandler, TagJobQueue
+from tractags.metrics import TagMetrics, trace_sql
+from tractags.model import TagPool, TaggedResource, delete_tags
+from tractags.model import notify_tags_changed, resources_tags
+from tractags.model import tag_resources
 from tractags.util import MockReq, split_into_tags
 
 
@@ -44,21 +48,110 @@ class TicketTagProvider(DefaultTagProvider):
     ignore_closed_tickets = BoolOption('tags', 'ignore_closed_tickets', True,
         _("Do not collect tags from closed tickets."))
 
+    sync_on_load = BoolOption('tags', 'ticket_sync_on_load', True,
+        _("""Synchronize tags of all tickets whenever the tag provider is
+        loaded. The sync only adds tags of untagged tickets and removes
+        those of deleted tickets, without writing anything if there is
+        nothing to do. `trac-admin <env> tags reindex` fixes other
+        differences. If disabled and the `TagJobQueue` component is
+        enabled, a `ticket_resync` job is queued instead."""))
+
     map = {'view': 'TICKET_VIEW', 'modify': 'TICKET_CHGPROP'}
     realm = 'ticket'
     use_cache = False
+    # Tags are ticket fields, so every replacement is a ticket change.
+    replace_resource_tags = None
 
     def __init__(self):
-        try:
-            self._fetch_tkt_tags()
-        except self.env.db_exc.IntegrityError, e:
-            self.log.warn('tags for ticket already exist: %s', to_unicode(e))
+        if self.sync_on_load:
+            try:
+                self._fetch_tkt_tags()
+            except self.env.db_exc.IntegrityError, e:
+                self.log.warn('tags for ticket already exist: %s',
+                              to_unicode(e))
+        elif self.env.is_component_enabled(TagJobQueue):
+            # Every process loads the provider, one resync at a time will do.
+            TagJobQueue(self.env).enqueue('ticket_resync', unique=True)
         cfg = self.config
         cfg_key = 'permission_policies'
         default_policies = cfg.defaults().get('trac', {}).get(cfg_key)
         self.fast_permcheck = all(p in default_policies for
                                   p in cfg.get('trac', cfg_key))
 
+    # Public methods
+
+    def get_tag_drift(self, after=None, limit=None):
+        """Compare tags of tickets with their fields, without writing.
+
+        Checks up to `limit` tickets with an id greater than `after`.
+        Returns the number of checked tickets, the id of the last one if
+        there may be more tickets left, and `(id, expected, actual)` tuples
+        for tickets with differing tags.  Closed tickets are expected to
+        have no tags, if closed tickets are ignored, like after the initial
+        sync.
+        """
+        sql = "SELECT id, status, %s FROM ticket" % ','.join(self.fields)
+        args = []
+        if after is not None:
+            sql += " WHERE id > %s"
+            args.append(after)
+        sql += " ORDER BY id"
+        if limit:
+            sql += " LIMIT %d" % limit
+        rows = self.env.db_query(sql, args)
+        current = resources_tags(self.env, self.realm,
+                                 [row[0] for row in rows])
+        drift = []
+        for row in rows:
+            if self.ignore_closed_tickets and row[1] == 'closed':
+                expected = set()
+            else:
+                expected = split_into_tags(' '.join(filter(None, row[2:])))
+            actual = current.get(unicode(row[0]), set())
+            if expected != actual:
+                drift.append((row[0], expected, actual))
+        last = rows[-1][0] if limit and len(rows) == limit else None
+        return len(rows), last, drift
+
+    def get_orphaned_tags(self):
+        """Return names of tagged tickets, that don't exist anymore."""
+        with self.env.db_query as db:
+            return [name for name, in db("""
+                SELECT DISTINCT name FROM tags
+                WHERE tagspace=%%s AND NOT EXISTS (SELECT * FROM ticket
+                                                   WHERE id=%s)
+                ORDER BY name
+                """ % db.cast('tags.name', 'int'), (self.realm,))]
+
+    def reindex_tags(self, after=None, limit=None):
+        """Rewrite tags of tickets differing from their fields.
+
+        Works like `get_tag_drift()`, but returns the number of fixed
+        tickets instead of the differences.
+        """
+        count, last, drift = self.get_tag_drift(after, limit)
+        if drift:
+            tag_resources(self.env, self.realm,
+                          [(id, expected) for id, expected, actual in drift])
+            if self.use_cache:
+                # Invalidate resource cache.
+                del self._tagged_resources
+        return count, last, len(drift)
+
+    def remove_orphaned_tags(self):
+        """Delete tags of tickets, that don't exist anymore."""
+        names = self.get_orphaned_tags()
+        if names:
+            with self.env.db_transaction as db:
+                db.executemany("""
+                    DELETE FROM tags WHERE tagspace=%s AND name=%s
+                    """, [(self.realm, name) for name in names])
+            notify_tags_changed(self.env, self.realm, names)
+            if self.use_cache:
+                # Invalidate resource cache.
+                del self._tagged_resources
+        return len(names)
+
     def _check_permission(self, req, resource, action):
         """Optionally coarse-grained permission check."""
         if self.fast_permcheck or not (resource and resource.id):
@@ -72,25 +165,53 @@ class TicketTagProvider(DefaultTagProvider):
         if not self._check_permission(req, None, 'view'):
             return
 
+        metrics = TagMetrics(self.env)
+        checks = 0
         if not tags:
             # Cache 'all tagged resources' for better performance.
-            for resource, tags in self._tagged_resources:
-                if self.fast_permcheck or \
-                        self._check_permission(req, resource, 'view'):
-                    yield resource, tags
+            metrics.count('cache.ticket.lookup')
+            for record in self._tagged_resources:
+                if not self.fast_permcheck:
+                    checks += 1
+                    if not self._check_permission(req, record.resource,
+                                                  'view'):
+                        continue
+                yield record
         else:
-            for name, tags in groupby(self.env.db_query("""
-                    SELECT ts.name, ts.tag FROM tags
-                     LEFT JOIN tags ts ON (tags.tagspace=ts.tagspace
-                                           AND tags.name=ts.name)
-                    WHERE tags.tagspace=%%s AND tags.tag IN (%s)
-                    ORDER by ts.name
-                    """ % ', '.join(['%s'] * len(tags)),
-                    [self.realm] + list(tags)), lambda row: row[0]):
-                resource = Resource(self.realm, name)
-                if self.fast_permcheck or \
-                        self._check_permission(req, resource, 'view'):
-                    yield resource, set([tag[1] for tag in tags])
+            sql = """
+                SELECT ts.name, ts.tag FROM tags
+                 LEFT JOIN tags ts ON (tags.tagspace=ts.tagspace
+                                       AND tags.name=ts.name)
+                WHERE tags.tagspace=%%s AND tags.tag IN (%s)
+                ORDER by ts.name
+                """ % ', '.join(['%s'] * len(tags))
+            args = [self.realm] + list(tags)
+            trace_sql(sql, args)
+            for name, tags in groupby(self.env.db_query(sql, args),
+                                      lambda row: row[0]):
+                if not self.fast_permcheck:
+                    checks += 1
+                    if not self._check_permission(
+                            req, Resource(self.realm, name), 'view'):
+                        continue
+                yield TaggedResource(self.realm, name,
+                                     [tag[1] for tag in tags])
+        if checks:
+            metrics.count('perm_checks.' + self.realm, checks)
+
+    def filter_tagged_resources(self, req, tagged):
+        if not self._check_permission(req, None, 'view'):
+            return
+        checks = 0
+        for name, tags in tagged:
+            if not self.fast_permcheck:
+                checks += 1
+                if not self._check_permission(
+                        req, Resource(self.realm, name), 'view'):
+                    continue
+            yield TaggedResource(self.realm, name, tags)
+        if checks:
+            TagMetrics(self.env).count('perm_checks.' + self.realm, checks)
 
     def get_resource_tags(self, req, resource):
         assert resource.realm == self.realm
@@ -129,6 +250,12 @@ class TicketTagProvider(DefaultTagProvider):
             super(TicketTagProvider,
                   self).set_resource_tags(req, resource, tags)
 
+    def set_resource_tags_many(self, req, resources_tags, comment=u'',
+                               when=None):
+        # Ticket tags are saved through ticket changes one by one.
+        for resource, tags in resources_tags:
+            self.set_resource_tags(req, resource, tags, comment, when)
+
     def remove_resource_tags(self, req, ticket_or_resource, comment=u''):
         try:
             resource = ticket_or_resource.resource
@@ -190,41 +317,62 @@ class TicketTagProvider(DefaultTagProvider):
 
     # Private methods
 
-    def _fetch_tkt_tags(self):
-        """Transfer all relevant ticket attributes to tags db table."""
+    def _fetch_tkt_tags(self, after=None, limit=None):
+        """Transfer all relevant ticket attributes to tags db table.
+
+        Optionally only up to `limit` tickets with an id greater than
+        `after` are transferred.  Returns the number of transferred tickets
+        and the id of the last one, if there may be more tickets left.
+        """
         # Initial sync is done by forced, stupid one-way mirroring.
         # Data acquisition for this utilizes the known ticket tags query.
         fields = ["COALESCE(%s, '')" % f for f in self.fields]
         ignore = ''
         if self.ignore_closed_tickets:
             ignore = " AND status != 'closed'"
-        with self.env.db_query as db:
+        args = [self.realm]
+        next = ''
+        if after is not None:
+            next = " AND id > %s"
+            args.append(after)
+        with self.env.db_transaction as db:
             sql = """
                   SELECT *
                   FROM (SELECT id, %s, %s AS std_fields
                         FROM ticket AS tkt
                         WHERE NOT EXISTS (SELECT * FROM tags
                                           WHERE tagspace=%%s AND name=%s)
-                        %s) AS s
+                        %s%s) AS s
                   WHERE std_fields != ''
                   ORDER BY id
                   """ % (','.join(self.fields), db.concat(*fields),
-                         db.cast('tkt.id', 'text'), ignore)
+                         db.cast('tkt.id', 'text'), ignore, next)
+            if limit:
+                sql += " LIMIT %d" % limit
             # Obtain cursors for reading tickets and altering tags db table.
             # DEVEL: Use appropriate cursor typs from Trac 1.0 db API.
             ro_cursor = db.cursor()
             rw_cursor = db.cursor()
-            # Delete tags for non-existent ticket
-            rw_cursor.execute("""
-                DELETE FROM tags
-                 WHERE tagspace=%%s
-                   AND NOT EXISTS (SELECT * FROM ticket AS tkt
-                                   WHERE tkt.id=%s%s)
-                """ % (db.cast('tags.name', 'int'), ignore),
-                (self.realm,))
-
-            ro_cursor.execute(sql, (self.realm,))
-
+            changed = False
+            if after is None:
+                # Delete tags for non-existent ticket, checking first, as
+                # the sync on load mostly finds nothing to write.
+                orphaned = """
+                    FROM tags
+                    WHERE tagspace=%%s
+                      AND NOT EXISTS (SELECT * FROM ticket AS tkt
+                                      WHERE tkt.id=%s%s)
+                    """ % (db.cast('tags.name', 'int'), ignore)
+                ro_cursor.execute("SELECT 1 %s LIMIT 1" % orphaned,
+                                  (self.realm,))
+                if ro_cursor.fetchone():
+                    rw_cursor.execute("DELETE %s" % orphaned, (self.realm,))
+                    changed = rw_cursor.rowcount > 0
+
+            ro_cursor.execute(sql, args)
+
+            count = 0
+            tkt_id = None
             for row in ro_cursor:
                 tkt_id, ttags = row[0], ' '.join([f for f in row[1:-1] if f])
                 ticket_tags = split_into_tags(ttags)
@@ -232,6 +380,11 @@ class TicketTagProvider(DefaultTagProvider):
                     INSERT INTO tags (tagspace, name, tag)
                     VALUES (%s, %s, %s)
                     """, [(self.realm, str(tkt_id), tag) for tag in ticket_tags])
+                changed = True
+                count += 1
+        if changed:
+            notify_tags_changed(self.env, self.realm)
+        return count, tkt_id if limit and count == limit else None
 
     try:
         from trac.cache import cached
@@ -240,15 +393,19 @@ class TicketTagProvider(DefaultTagProvider):
         @cached
         def _tagged_resources(self):
             """Cached version."""
+            TagMetrics(self.env).count('cache.ticket.miss')
+            # Share tag strings and sets between all cached records.
+            pool = TagPool()
             resources = []
-            counter = 0
-            for name, tags in groupby(self.env.db_query("""
-                    SELECT name, tag FROM tags
-                    WHERE tagspace=%s ORDER by name
-                    """, (self.realm,)), lambda row: row[0]):
-                resource = Resource(self.realm, name)
-                resources.append((resource, set([tag[1] for tag in tags])))
-                counter += 1
+            sql = """
+                SELECT name, tag FROM tags
+                WHERE tagspace=%s ORDER by name
+                """
+            trace_sql(sql, (self.realm,))
+            for name, tags in groupby(self.env.db_query(sql, (self.realm,)),
+                                      lambda row: row[0]):
+                resources.append(TaggedResource(self.realm, name,
+                                                pool([tag[1] for tag in tags])))
             return resources
 
     except ImportError:
@@ -259,9 +416,87 @@ class TicketTagProvider(DefaultTagProvider):
                     SELECT name, tag FROM tags
                     WHERE tagspace=%s ORDER by name
                     """, (self.realm,)), lambda row: row[0]):
-                resource = Resource(self.realm, name)
-                yield resource, set([tag[1] for tag in tags])
+                yield TaggedResource(self.realm, name,
+                                     [tag[1] for tag in tags])
+
+    def _replace_tkt_tags(self, args, after, size):
+        """Replace tags of up to `size` tickets with an id greater than
+        `after` through ticket changes, the same way `TagSystem.replace_tag()`
+        does for a single ticket.  Tickets the author of the job may not
+        modify are skipped.
+        """
+        old_tags = set(args['old_tags'])
+        new_tag = args.get('new_tag')
+        sql_args = [self.realm] + list(old_tags)
+        next = ''
+        with self.env.db_query as db:
+            ticket_id = db.cast('name', 'int')
+            if after is not None:
+                next = " AND %s > %%s" % ticket_id
+                sql_args.append(after)
+            names = [name for name, in db("""
+                SELECT name FROM tags
+                WHERE tagspace=%%s AND tag IN (%s)%s
+                GROUP BY name ORDER BY %s LIMIT %d
+                """ % (', '.join(['%s'] * len(old_tags)), next, ticket_id,
+                       size), sql_args)]
+        # Check permissions of the author, like in the request enqueuing
+        # the job.
+        author = args.get('author', 'anonymous')
+        req = MockReq(authname=author, perm=PermissionCache(self.env, author))
+        current = resources_tags(self.env, self.realm, names)
+        for name in names:
+            resource = Resource(self.realm, name)
+            if not (self._check_permission(req, resource, 'view') and
+                    self._check_permission(req, resource, 'modify')):
+                continue
+            tags = current.get(name, set())
+            eff_tags = tags - old_tags
+            if new_tag:
+                eff_tags.add(new_tag)
+            if eff_tags != tags:
+                self.set_resource_tags(req, resource, eff_tags,
+                                       args.get('comment', u''))
+        if len(names) < size:
+            return len(names), None
+        return len(names), int(names[-1])
 
     def _ticket_tags(self, ticket):
         return split_into_tags(
             ' '.join(filter(None, [ticket[f] for f in self.fields])))
+
+
+class TicketTagJobs(Component):
+    """[main] Runs ticket tag maintenance jobs queued with `TagJobQueue`.
+
+    A `ticket_resync` job copies tags of tickets to the tags db table in
+    batches, a `ticket_replace` job replaces tags by ticket changes.
+    """
+
+    implements(ITagJobHandler)
+
+    # ITagJobHandler methods
+
+    def get_tag_job_kinds(self):
+        return ('ticket_resync', 'ticket_replace')
+
+    def count_tag_job(self, kind, args):
+        if kind == 'ticket_replace':
+            for count, in self.env.db_query("""
+                    SELECT COUNT(DISTINCT name) FROM tags
+                    WHERE tagspace=%%s AND tag IN (%s)
+                    """ % ', '.join(['%s'] * len(args['old_tags'])),
+                    [TicketTagProvider(self.env).realm] +
+                    list(args['old_tags'])):
+                return count
+
+    def run_tag_job(self, kind, args, position, size):
+        provider = TicketTagProvider(self.env)
+        if kind == 'ticket_resync':
+            count, position = provider._fetch_tkt_tags(position, size)
+        else:
+            count, position = provider._replace_tkt_tags(args, position, size)
+        if count and provider.use_cache:
+            # Invalidate resource cache.
+            del provider._tagged_resources
+        return count, position
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import re
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('tags_change', key=('tagspace', 'name', 'time'))[
+        Column('tagspace'),
+        Column('name'),
+        Column('time', type='int64'),
+        Column('author'),
+        Column('oldtags'),
+        Column('newtags'),
+        Index(['time']),
+        Index(['author']),
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add indexes for time range and author queries on tag changes."""
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            # Add only the indexes to the existing table.
+            if re.match(r'\s*CREATE\s+INDEX\s', stmt, re.I):
+                cursor.execute(stmt)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.db import Table, Column, Index, DatabaseManager
+
+schema = [
+    Table('tags_job', key='id')[
+        Column('id', auto_increment=True),
+        Column('kind'),
+        Column('args'),
+        Column('state'),
+        Column('position'),
+        Column('done', type='int'),
+        Column('total', type='int'),
+        Column('message'),
+        Column('author'),
+        Column('created', type='int64'),
+        Column('changed', type='int64'),
+        Index(['state']),
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add new table for queued tag maintenance jobs."""
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.db import Table, Column, DatabaseManager
+
+schema = [
+    Table('tags_feed', key='id')[
+        Column('id', auto_increment=True),
+        Column('tagspace'),
+        Column('name'),
+        Column('time', type='int64'),
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add new table for the feed of changed tagged resources."""
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
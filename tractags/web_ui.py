@@ -11,29 +11,33 @@
 #
 
 import re
+from hashlib import md5
 
 from genshi.filters.transform import Transformer
 
 from trac import __version__ as trac_version
-from trac.config import BoolOption, ListOption, Option
+from trac.config import BoolOption, IntOption, ListOption, Option
 from trac.core import implements
 from trac.resource import Resource, ResourceSystem, get_resource_name
 from trac.resource import get_resource_url
 from trac.timeline.api import ITimelineEventProvider
 from trac.util import to_unicode
 from trac.util.html import Markup, html as builder
+from trac.util.presentation import to_json
 from trac.util.text import javascript_quote, unicode_quote_plus
 from trac.web import IRequestFilter
-from trac.web.api import IRequestHandler, ITemplateStreamFilter
+from trac.web.api import IRequestHandler, ITemplateStreamFilter, RequestDone
 from trac.web.chrome import Chrome, INavigationContributor
 from trac.web.chrome import add_ctxtnav, add_script, add_stylesheet
 from trac.web.chrome import add_warning, web_context
 from trac.wiki.formatter import Formatter
 from trac.wiki.model import WikiPage
 
-from tractags.api import REALM_RE, TagSystem, _, tag_, tagn_
+from tractags.api import Counter, REALM_RE, TagSystem, _, tag_, tagn_
+from tractags.index import TagCompletionIndex
 from tractags.macros import TagTemplateProvider, TagWikiMacros, as_int
 from tractags.macros import query_realms
+from tractags.metrics import SlowTagQueryLog
 from tractags.model import tag_changes
 from tractags.query import InvalidQuery, Query
 from tractags.util import split_into_tags
@@ -46,7 +50,7 @@ class TagInputAutoComplete(TagTemplateProvider):
     0.5dev.
     """
 
-    implements(IRequestFilter, ITemplateStreamFilter)
+    implements(IRequestFilter, IRequestHandler, ITemplateStreamFilter)
 
     field_opt = Option('tags', 'complete_field', 'keywords',
         "Ticket field to which a drop-down tag list should be attached.")
@@ -73,6 +77,12 @@ class TagInputAutoComplete(TagTemplateProvider):
     sticky_tags_opt = ListOption('tags', 'complete_sticky_tags', '', ',',
         doc="A list of comma separated values available for input.")
 
+    limit_opt = IntOption('tags', 'complete_limit', 20,
+        "Maximum number of tags suggested for input, most frequent first.")
+
+    max_age_opt = IntOption('tags', 'complete_max_age', 60,
+        "Number of seconds browsers may reuse tag suggestions.")
+
     def __init__(self):
         self.tags_enabled = self.env.is_enabled(TagSystem)
 
@@ -98,6 +108,32 @@ class TagInputAutoComplete(TagTemplateProvider):
                 add_stylesheet(req, 'tags/css/jquery-ui-1.8.16.custom.css')
         return template, data, content_type
 
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return is_suggest_request(req)
+
+    def process_request(self, req):
+        context = split_into_tags(req.args.get('tags', ''))
+        content = to_json(self._get_suggestions(req, req.args.get('q', ''),
+                                                context))
+        etag = '"%s"' % md5(content).hexdigest()
+        not_modified = req.get_header('If-None-Match') == etag
+        req.send_response(not_modified and 304 or 200)
+        req.send_header('Cache-Control',
+                        'private, max-age=%d' % self.max_age_opt)
+        req.send_header('ETag', etag)
+        if not_modified:
+            req.send_header('Content-Length', 0)
+            req.end_headers()
+            raise RequestDone
+        req.send_header('Content-Type', 'application/json;charset=utf-8')
+        req.send_header('Content-Length', len(content))
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(content)
+        raise RequestDone
+
     # ITemplateStreamFilter method
     def filter_stream(self, req, method, filename, stream, data):
 
@@ -105,19 +141,14 @@ class TagInputAutoComplete(TagTemplateProvider):
                 (self.tags_enabled and filename == 'wiki_edit.html')):
             return stream
 
-        keywords = self._get_keywords_string(req)
-        if not keywords:
+        if not (self.tags_enabled or self.sticky_tags_opt):
             self.log.debug(
                 "No keywords found. TagInputAutoComplete is disabled.")
             return stream
 
-        matchfromstart = '"^" +'
-        if self.matchcontains_opt:
-            matchfromstart = ''
-
         js = """
             jQuery(document).ready(function($) {
-                var keywords = [ %(keywords)s ]
+                var url = '%(url)s'
                 var sep = '%(separator)s'.trim() + ' '
                 function split( val ) {
                     return val.split( /%(separator)s\s*|\s+/ );
@@ -135,13 +166,16 @@ class TagInputAutoComplete(TagTemplateProvider):
                         }
                     })
                     .autocomplete({
-                        delay: 0,
+                        delay: 100,
                         minLength: 0,
                         source: function( request, response ) {
-                            // delegate back to autocomplete, but extract
-                            // the last term
-                            response( $.ui.autocomplete.filter(
-                                keywords, extractLast( request.term ) ) );
+                            // ask the server for matches of the last term,
+                            // ranked with regard to the other terms
+                            var terms = split( request.term );
+                            var term = terms.pop();
+                            $.getJSON( url,
+                                       { q: term, tags: terms.join( ' ' ) },
+                                       response );
                         },
                         focus: function() {
                             // prevent value inserted on focus
@@ -162,12 +196,12 @@ class TagInputAutoComplete(TagTemplateProvider):
                     });
             });"""
 
+        url = javascript_quote(req.href.tags('suggest'))
         # Inject transient part of JavaScript into ticket.html template.
         if req.path_info.startswith('/ticket/') or \
            req.path_info.startswith('/newticket'):
             js_ticket = js % {'field': '#field-' + self.field_opt,
-                              'keywords': keywords,
-                              'matchfromstart': matchfromstart,
+                              'url': url,
                               'separator': self.separator}
             stream = stream | Transformer('.//head')\
                               .append(builder.script(Markup(js_ticket),
@@ -186,8 +220,7 @@ class TagInputAutoComplete(TagTemplateProvider):
         # Inject transient part of JavaScript into wiki.html template.
         elif self.tags_enabled and req.path_info.startswith('/wiki/'):
             js_wiki = js % {'field': '#tags',
-                            'keywords': keywords,
-                            'matchfromstart': matchfromstart,
+                            'url': url,
                             'separator': self.separator}
             stream = stream | Transformer('.//head')\
                               .append(builder.script(Markup(js_wiki),
@@ -196,21 +229,34 @@ class TagInputAutoComplete(TagTemplateProvider):
 
     # Private methods
 
-    def _get_keywords_string(self, req):
-        keywords = set(self.sticky_tags_opt)  # prevent duplicates
+    def _get_suggestions(self, req, term, context=()):
+        """Return tags matching the term, best suggestions first."""
+        term = term.strip().lower()
+        if self.tags_enabled and self.env.is_enabled(TagCompletionIndex):
+            index = TagCompletionIndex(self.env)
+            suggestions = index.suggest(req, term, self.limit_opt,
+                                        self.matchcontains_opt, context)
+            # Offer sticky tags not in use yet, if there is still room.
+            for tag in sorted(self.sticky_tags_opt):
+                if len(suggestions) >= self.limit_opt:
+                    break
+                key = tag.lower()
+                if tag not in suggestions and tag not in context and \
+                        (key.startswith(term) or
+                         self.matchcontains_opt and term in key):
+                    suggestions.append(tag)
+            return suggestions
+        keywords = Counter(dict((tag, 0) for tag in self.sticky_tags_opt))
         if self.tags_enabled:
-            # Use TagsPlugin >= 0.7 performance-enhanced API.
-            tags = TagSystem(self.env).get_all_tags(req)
-            keywords.update(tags.keys())
-
-        if keywords:
-            keywords = sorted(keywords)
-            keywords = ','.join(("'%s'" % javascript_quote(_keyword)
-                                 for _keyword in keywords))
+            keywords.update(TagSystem(self.env).get_all_tags(req))
+        if self.matchcontains_opt:
+            matches = [(tag, count) for tag, count in keywords.iteritems()
+                       if term in tag.lower()]
         else:
-            keywords = ''
-
-        return keywords
+            matches = [(tag, count) for tag, count in keywords.iteritems()
+                       if tag.lower().startswith(term)]
+        matches.sort(key=lambda m: (-m[1], m[0]))
+        return [tag for tag, count in matches[:self.limit_opt]]
 
     def _get_help_link(self, req):
         link = resource_id = None
@@ -276,6 +322,12 @@ class TagRequestHandler(TagTemplateProvider):
         doc="""Comma-separated list of realms to exclude from tags queries
             by default, unless specifically included using "realm:realm-name"
             in a query.""")
+    cloud_limit = IntOption('tags', 'cloud_limit', 0,
+        doc="""Maximum number of most frequent tags shown in the cloud.
+            Set to 0 for no limit.""")
+    related_limit = IntOption('tags', 'related_tags_limit', 10,
+        doc="""Maximum number of related tags shown beside resources
+            tagged with a single tag. Set to 0 to disable.""")
 
     # INavigationContributor methods
     def get_active_navigation_item(self, req):
@@ -290,7 +342,8 @@ class TagRequestHandler(TagTemplateProvider):
 
     # IRequestHandler methods
     def match_request(self, req):
-        return req.path_info.startswith('/tags')
+        return req.path_info.startswith('/tags') and \
+               not is_suggest_request(req)
 
     def process_request(self, req):
         req.perm.require('TAGS_VIEW')
@@ -332,6 +385,13 @@ class TagRequestHandler(TagTemplateProvider):
         if tag_id:
             data['tag_page'] = WikiPage(self.env,
                                         tag_system.wiki_page_prefix + tag_id)
+        if tag_id and checked_realms and self.related_limit > 0:
+            related = tag_system.get_related_tags(req, tag_id.strip('\'"'),
+                                                  checked_realms,
+                                                  self.related_limit)
+            data['related_tags'] = related and \
+                TagWikiMacros(self.env).render_cloud(req, dict(related),
+                                                     realms=checked_realms)
         if query or tag_id:
             macro = 'ListTagged'
             # TRANSLATOR: The meta-nav link label.
@@ -344,7 +404,11 @@ class TagRequestHandler(TagTemplateProvider):
             macro = 'TagCloud'
             mincount = as_int(req.args.get('mincount', None),
                               self.cloud_mincount)
-            args = mincount and "mincount=%s" % mincount or None
+            args = ','.join(arg for arg in
+                            (mincount and "mincount=%s" % mincount,
+                             self.cloud_limit > 0 and
+                             "limit=%s" % self.cloud_limit)
+                            if arg) or None
             data['mincount'] = mincount
         formatter = Formatter(self.env, web_context(req, Resource('tag')))
         self.env.log.debug("%s macro arguments: %s", macro,
@@ -420,13 +484,23 @@ class TagTimelineEventFilter(TagTemplateProvider):
                     events = []
                     self.log.debug("Filtering timeline events by tags '%s'",
                                    query_str)
-                    for event in data['events']:
-                        resource = resource_from_event(event)
-                        if resource and resource.realm in realms:
-                            # Shortcut view permission checks here.
-                            tags = tag_system.get_tags(None, resource)
+                    with SlowTagQueryLog(self.env).trace(query_str,
+                                                         realms) as trace:
+                        resources = []
+                        for event in data['events']:
+                            resource = resource_from_event(event)
+                            if resource and resource.realm in realms:
+                                resources.append((event, resource))
+                        # Shortcut view permission checks here.
+                        all_tags = tag_system.get_tags_many(
+                            None, [resource for event, resource in resources])
+                        for event, resource in resources:
+                            tags = all_tags[resource.realm, resource.id]
                             if query(tags, context=resource):
                                 events.append(event)
+                        if trace:
+                            trace.candidates = len(resources)
+                            trace.matched = len(events)
                     # Overwrite with filtered list.
                     data['events'] = events
             if query_str:
@@ -437,6 +511,14 @@ class TagTimelineEventFilter(TagTemplateProvider):
         return template, data, content_type
 
 
+def is_suggest_request(req):
+    """Whether a request asks for tag suggestions (of TagInputAutoComplete).
+
+    The 'q' argument distinguishes this from the page of a tag 'suggest'.
+    """
+    return req.path_info == '/tags/suggest' and 'q' in req.args
+
+
 def resource_from_event(event):
     resource = None
     event_data = event['data']
@@ -29,7 +29,7 @@ from trac.wiki.web_ui import WikiModule
 
 from tractags.api import Counter, DefaultTagProvider, TagSystem, _, requests
 from tractags.macros import TagTemplateProvider
-from tractags.model import delete_tags, tag_changes
+from tractags.model import delete_tags, iter_tag_changes
 from tractags.web_ui import render_tag_changes
 from tractags.util import MockReq, query_realms, split_into_tags
 
@@ -52,24 +52,39 @@ class WikiTagProvider(DefaultTagProvider):
 
     def get_tagged_resources(self, req, tags=None, filter=None):
         if self.exclude_templates:
-            with self.env.db_query as db:
-                like_templates = ''.join(
-                    ["'", db.like_escape(WikiModule.PAGE_TEMPLATES_PREFIX),
-                     "%%'"])
-                filter = (' '.join(['name NOT', db.like() % like_templates]),)
+            filter = self._exclude_templates_filter()
         return super(WikiTagProvider, self).get_tagged_resources(req, tags,
                                                                  filter)
 
-    def get_all_tags(self, req, filter=None):
+    def get_all_tags(self, req, filter=None, mincount=None):
         if not self.check_permission(req.perm, 'view'):
             return Counter()
         if self.exclude_templates:
-            with self.env.db_transaction as db:
-                like_templates = ''.join(
-                    ["'", db.like_escape(WikiModule.PAGE_TEMPLATES_PREFIX),
-                     "%%'"])
-                filter = (' '.join(['name NOT', db.like() % like_templates]),)
-        return super(WikiTagProvider, self).get_all_tags(req, filter)
+            filter = self._exclude_templates_filter()
+        return super(WikiTagProvider, self).get_all_tags(req, filter,
+                                                         mincount)
+
+    def replace_resource_tags(self, req, old_tags, new_tag=None, comment=u'',
+                              filter=None):
+        if self.exclude_templates:
+            filter = self._exclude_templates_filter()
+        return super(WikiTagProvider, self).replace_resource_tags(
+            req, old_tags, new_tag, comment, filter)
+
+    def tag_exists(self, req, tag, filter=None):
+        if not self.check_permission(req.perm, 'view'):
+            return False
+        if self.exclude_templates:
+            filter = self._exclude_templates_filter()
+        return super(WikiTagProvider, self).tag_exists(req, tag, filter)
+
+    def filter_tagged_resources(self, req, tagged):
+        if self.exclude_templates:
+            prefix = WikiModule.PAGE_TEMPLATES_PREFIX
+            tagged = [(name, tags) for name, tags in tagged
+                      if not name.startswith(prefix)]
+        return super(WikiTagProvider, self).filter_tagged_resources(req,
+                                                                    tagged)
 
     def describe_tagged_resource(self, req, resource):
         if not self.check_permission(req.perm(resource), 'view'):
@@ -80,6 +95,13 @@ class WikiTagProvider(DefaultTagProvider):
             return ret and ret.group(1) or ''
         return ''
 
+    def _exclude_templates_filter(self):
+        with self.env.db_query as db:
+            like_templates = ''.join(
+                ["'", db.like_escape(WikiModule.PAGE_TEMPLATES_PREFIX),
+                 "%%'"])
+            return (' '.join(['name NOT', db.like() % like_templates]),)
+
 
 class WikiTagInterface(TagTemplateProvider):
     """[main] Implements the user interface for tagging Wiki pages."""
@@ -210,12 +232,12 @@ class WikiTagInterface(TagTemplateProvider):
         history = []
         page_histories = data.get('history', [])
         resource = data['resource']
-        tags_histories = tag_changes(self.env, resource)
+        # Merge both histories, that are ordered newest first, in one pass.
+        tags_histories = iter_tag_changes(self.env, resource)
+        tags_history = next(tags_histories, None)
 
         for page_history in page_histories:
-            while tags_histories and \
-                    tags_histories[0][0] >= page_history['date']:
-                tags_history = tags_histories.pop(0)
+            while tags_history and tags_history[0] >= page_history['date']:
                 date = tags_history[0]
                 author = tags_history[1]
                 comment = render_tag_changes(tags_history[2], tags_history[3])
@@ -225,6 +247,7 @@ class WikiTagInterface(TagTemplateProvider):
                 history.append({'version': '*', 'url': url, 'date': date,
                                 'author': author, 'comment': comment,
                                 'ipnr': ''})
+                tags_history = next(tags_histories, None)
             history.append(page_history)
 
         data.update(dict(history=history,
@@ -354,9 +377,8 @@ class TagWikiSyntaxProvider(Component):
         context = formatter.context
         href = self.tag_system.get_resource_url(tag_res, context.href, kwargs)
         if all_realms and (
-                target in self.tag_system.get_all_tags(formatter.req) or
-                not iter_is_empty(self.tag_system.query(formatter.req,
-                                                        query))):
+                self.tag_system.tag_exists(formatter.req, target) or
+                self.tag_system.exists(formatter.req, query)):
             # At least one tag provider is available and tag exists or
             # tags query yields at least one match.
             if label:
@@ -365,12 +387,3 @@ class TagWikiSyntaxProvider(Component):
 
         return tag.a(label+'?', href=href, class_='missing tags',
                      rel='nofollow')
-
-
-def iter_is_empty(i):
-    """Test for empty iterator without consuming more than first element."""
-    try:
-        i.next()
-    except StopIteration:
-        return True
-    return False
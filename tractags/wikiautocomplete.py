@@ -12,6 +12,7 @@ from trac.core import Component, implements
 from wikiautocomplete.api import IWikiAutoCompleteStrategyProvider
 
 from tractags.api import TagSystem
+from tractags.index import TagCompletionIndex
 
 
 class TagsWikiAutoComplete(Component):
@@ -37,5 +38,8 @@ class TagsWikiAutoComplete(Component):
         )]
 
     def _suggest_tags(self, req):
+        if self.env.is_enabled(TagCompletionIndex):
+            all_tags = TagCompletionIndex(self.env).get_all_tags(req)
+            return [{'value': tag} for tag in all_tags]
         all_tags = TagSystem(self.env).get_all_tags(req)
         return [{'value': tag} for tag in sorted(all_tags)]
@@ -6,14 +6,25 @@
 # you should have received as part of this distribution.
 #
 
-from trac.core import Component, implements
-from trac.resource import Resource, ResourceNotFound, resource_exists
+import base64
+import json
+from itertools import islice
+
+from trac.core import Component, TracError, implements
+from trac.perm import PermissionError
+from trac.resource import Resource, ResourceNotFound, ResourceSystem
+from trac.resource import resource_exists
+from trac.util.presentation import to_json
+from trac.util.text import exception_to_unicode
 
 from tracrpc.api import IXMLRPCHandler
 
 from tractags.api import TagSystem
 from tractags.util import split_into_tags
 
+# Maximum number of changes returned by `getChanges`.
+MAX_CHANGES = 1000
+
 
 class TagRPC(Component):
     """[extra] RPC interface for the tag system.
@@ -36,12 +47,24 @@ class TagRPC(Component):
         yield (None, ((list, str),), self.splitIntoTags)
         yield ('TAGS_VIEW', ((list,),), self.getTaggableRealms)
         yield ('TAGS_VIEW', ((dict,), (dict, list)), self.getAllTags)
+        yield ('TAGS_VIEW', ((dict,), (dict, int), (dict, int, int)),
+               self.getChanges)
         yield ('TAGS_VIEW', ((list, str, str),), self.getTags)
-        yield ('TAGS_VIEW', ((list, str),), self.query)
+        yield ('TAGS_VIEW', ((list, list),), self.getTagsMulti)
+        yield ('TAGS_VIEW', ((list, str), (list, str, list),
+                             (list, str, list, int)), self.getRelatedTags)
+        yield ('TAGS_VIEW', ((list, str), (list, str, int, int),
+                             (list, str, int, int, str)), self.query)
+        yield ('TAGS_VIEW', ((dict, str, int), (dict, str, int, str),
+                             (dict, str, int, str, str)), self.queryPage)
         yield ('TAGS_MODIFY', ((list, str, str, list),
                                (list, str, str, list, str)), self.addTags)
         yield ('TAGS_MODIFY', ((list, str, str, list),
                                (list, str, str, list, str)), self.setTags)
+        yield ('TAGS_MODIFY', ((list, list), (list, list, str)),
+               self.addTagsMulti)
+        yield ('TAGS_MODIFY', ((list, list), (list, list, str)),
+               self.setTagsMulti)
 
     # Exported functions and TagSystem methods
 
@@ -57,6 +80,25 @@ class TagRPC(Component):
         self.tag_system.set_tags(req, resource, tags, comment)
         return self._get_tags(req, resource)
 
+    def addTagsMulti(self, req, items, comment=u''):
+        """Add tags to many Trac resources, given as a list of
+        `[realm, id, tags]` items.
+
+        Returns a list of `{'realm', 'id', 'tags'}` structs with the updated
+        resource tags, or `{'realm', 'id', 'error'}` for failed items, in
+        the order of the supplied items.
+        """
+        resources, results = self._get_resources(req, items, 3)
+        current = self.tag_system.get_tags_many(
+            req, [r for r in resources if r is not None])
+        changes = []
+        for resource, item in zip(resources, items):
+            if resource is not None:
+                tags = set(item[2])
+                tags.update(current.get((resource.realm, resource.id), ()))
+                changes.append((resource, tags))
+        return self._set_tags_multi(req, changes, comment, results)
+
     def getAllTags(self, req, realms=[]):
         """Returns a dict of all tags as keys and occurrences as values.
 
@@ -70,17 +112,79 @@ class TagRPC(Component):
         """Returns the list of taggable Trac realms."""
         return list(self.tag_system.get_taggable_realms())
 
+    def getChanges(self, req, cursor=0, limit=100):
+        """Returns tags of resources changed after a change feed cursor.
+
+        Returns a struct with a list of `{'seq', 'realm', 'id', 'tags'}`
+        `changes` and the `cursor` to pass for getting later changes.  An
+        empty id means, that an unknown set of resources of the realm has
+        changed, so the whole realm needs to be read again.  At most 1000
+        changes are returned per call.
+        """
+        changes, cursor = self.tag_system.changes_since(
+            req, cursor, min(max(limit, 1), MAX_CHANGES))
+        return dict(changes=[dict(seq=seq, realm=realm, id=id or '',
+                                  tags=sorted(tags or ()))
+                             for seq, realm, id, tags in changes],
+                    cursor=cursor)
+
+    def getRelatedTags(self, req, tag, realms=[], limit=0):
+        """Returns a list of `[tag, count]` pairs for tags used together
+        with the supplied tag, most frequent first.
+
+        If a realm list is supplied, only these taggable realms are
+        considered.  A positive limit restricts the number of returned tags.
+        """
+        return [list(pair) for pair in self.tag_system.get_related_tags(
+                    req, tag, realms, limit > 0 and limit or None)]
+
     def getTags(self, req, realm, id):
         """Returns the list of tags for a Trac resource."""
         return self._get_tags(req, Resource(realm, id))
 
-    def query(self, req, query_str):
+    def getTagsMulti(self, req, resources):
+        """Returns tags for many Trac resources, given as a list of
+        `[realm, id]` pairs.
+
+        Returns a list of `{'realm', 'id', 'tags'}` structs, or
+        `{'realm', 'id', 'error'}` for failed items, in the order of the
+        supplied resources.
+        """
+        resources, results = self._get_resources(req, resources)
+        self._get_tags_multi(req, resources, results)
+        return results
+
+    def query(self, req, query_str, offset=0, limit=0, fields='tags'):
         """Returns a list of tagged Trac resources, whose tags match the
         supplied tag query expression.
+
+        Results are `[realm, id, tags]` lists, or `[realm, id]` lists for
+        fields 'ids'.  A positive limit returns at most that many results
+        after skipping the first `offset` ones.
         """
-        # Type conversion needed for content transfer of Python set objects.
-        return [(resource.realm, resource.id, list(tags))
-                for resource, tags in self.tag_system.query(req, query_str)]
+        results = self.tag_system.query_tagged(req, query_str)
+        if offset > 0 or limit > 0:
+            results = islice(results, max(offset, 0),
+                             offset + limit if limit > 0 else None)
+        return [self._format_record(tagged, fields) for tagged in results]
+
+    def queryPage(self, req, query_str, limit, fields='tags', token=''):
+        """Returns a page of tagged Trac resources, whose tags match the
+        supplied tag query expression, ordered by realm and id.
+
+        Returns a struct with `results` formatted like for `query`, and
+        a continuation `token` to pass for the next page, or an empty token
+        after the last page.
+        """
+        after = token and self._decode_token(token) or None
+        page = self.tag_system.query_tagged_page(req, query_str,
+                                                 max(limit, 1), after)
+        next = ''
+        if len(page) == max(limit, 1):
+            next = base64.urlsafe_b64encode(to_json([page[-1].realm,
+                                                     page[-1].id]))
+        return dict(results=[self._format_record(tagged, fields)
+                             for tagged in page], token=next)
 
     def setTags(self, req, realm, id, tags, comment=u''):
         """Replace tags for a Trac resource with the supplied list of tags.
@@ -92,6 +196,20 @@ class TagRPC(Component):
         self.tag_system.set_tags(req, resource, tags, comment)
         return self._get_tags(req, resource)
 
+    def setTagsMulti(self, req, items, comment=u''):
+        """Replace tags for many Trac resources, given as a list of
+        `[realm, id, tags]` items.
+
+        Returns a list of `{'realm', 'id', 'tags'}` structs with the updated
+        resource tags, or `{'realm', 'id', 'error'}` for failed items, in
+        the order of the supplied items.
+        """
+        resources, results = self._get_resources(req, items, 3)
+        return self._set_tags_multi(req, [(resource, item[2]) for resource, item
+                                          in zip(resources, items)
+                                          if resource is not None],
+                                    comment, results)
+
     def splitIntoTags(self, req, tag_str):
         """Returns a list of tags from a string.
 
@@ -102,6 +220,105 @@ class TagRPC(Component):
 
     # Private methods
 
+    def _decode_token(self, token):
+        try:
+            realm, id = json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise TracError('Invalid continuation token "%s"' % token)
+        return realm, id
+
+    def _format_record(self, tagged, fields):
+        if fields == 'ids':
+            return [tagged.realm, tagged.id]
+        elif fields != 'tags':
+            raise TracError('Unknown fields "%s"' % fields)
+        # Type conversion needed for content transfer of Python set objects.
+        return [tagged.realm, tagged.id, list(tagged.tags)]
+
+    def _get_resources(self, req, items, size=2):
+        """Return existing resources of `[realm, id, ...]` items of at least
+        `size` elements, or `None` for invalid ones, and a list of per-item
+        result structs.
+        """
+        realms = set(self.tag_system.get_taggable_realms())
+        resources = []
+        results = []
+        by_realm = {}
+        for idx, item in enumerate(items):
+            if not isinstance(item, (list, tuple)) or len(item) < size:
+                # Echo as much of the malformed item as available.
+                fields = isinstance(item, (list, tuple)) and item or ()
+                result = dict(realm=fields[0] if fields else '',
+                              id=fields[1] if len(fields) > 1 else '',
+                              error='Invalid item %r, expected %d elements'
+                                    % (item, size))
+                resource = None
+            else:
+                result = dict(realm=item[0], id=item[1])
+                resource = Resource(item[0], item[1])
+                if item[0] not in realms:
+                    result['error'] = 'Realm "%s" is not taggable' % item[0]
+                    resource = None
+                else:
+                    by_realm.setdefault(item[0], []).append(idx)
+            resources.append(resource)
+            results.append(result)
+        # Resolve the resource manager only once for all items of a realm.
+        resource_system = ResourceSystem(self.env)
+        for realm, indexes in by_realm.iteritems():
+            manager = resource_system.get_resource_manager(realm)
+            if not hasattr(manager, 'resource_exists'):
+                manager = None
+            for idx in indexes:
+                resource = resources[idx]
+                if not manager or not manager.resource_exists(resource):
+                    results[idx]['error'] = \
+                        'Resource "%r" does not exists' % resource
+                    resources[idx] = None
+        return resources, results
+
+    def _get_tags_multi(self, req, resources, results):
+        all_tags = self.tag_system.get_tags_many(
+            req, [r for r in resources if r is not None])
+        for resource, result in zip(resources, results):
+            if resource is None:
+                continue
+            tags = all_tags.get((resource.realm, resource.id))
+            if tags is None:
+                result['error'] = exception_to_unicode(
+                    PermissionError(resource=resource, env=self.env))
+            else:
+                # Type conversion needed for content transfer of sets.
+                result['tags'] = sorted(tags)
+
+    def _set_tags_multi(self, req, changes, comment, results):
+        by_realm = {}
+        for resource, tags in changes:
+            by_realm.setdefault(resource.realm, []).append((resource, tags))
+        failed = {}
+        for realm, realm_changes in by_realm.iteritems():
+            try:
+                self.tag_system.set_tags_many(req, realm_changes, comment)
+            except Exception:
+                # Retry one by one for errors of the failing items only.
+                for resource, tags in realm_changes:
+                    try:
+                        self.tag_system.set_tags(req, resource, tags, comment)
+                    except Exception, e:
+                        failed[realm, resource.id] = exception_to_unicode(e)
+        resources = []
+        for result in results:
+            key = (result['realm'], result['id'])
+            if 'error' in result:
+                resources.append(None)
+            elif key in failed:
+                result['error'] = failed[key]
+                resources.append(None)
+            else:
+                resources.append(Resource(*key))
+        self._get_tags_multi(req, resources, results)
+        return results
+
     def _get_tags(self, req, resource):
         if not resource_exists(self.env, resource):
             raise ResourceNotFound('Resource "%r" does not exists' % resource)